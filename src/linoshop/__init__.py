@@ -0,0 +1 @@
+"""Headless entry points of Linoshop, run with `python -m linoshop` from the src directory."""
@@ -0,0 +1,184 @@
+import argparse
+import sys
+import cv2
+from tools.blur import BlurType
+from tools.image_filter_color import FilterType
+from tools.reshape import MaskType
+from tools.rotate import Interpolation
+from tools.pipeline import GrayscaleStage, BlurStage, FilterStage, MaskStage, RotateStage
+from tools.tiling import process_file, TILE_BUDGET_BYTES
+from tools.image_index import ImageIndex, DUPLICATE_THRESHOLD
+from linoshop.batch import run_batch, find_images
+from linoshop.benchmark import run_benchmarks, compare_results, save_results, load_results, DEFAULT_SIZES, \
+    MIN_SECONDS, REGRESSION_TOLERANCE
+
+def option_name(member) -> str:
+    """Command-line spelling of an enum member, e.g. RECURSIVE_GAUSSIAN -> recursive-gaussian."""
+    return member.name.lower().replace("_", "-")
+
+def enum_option(enum):
+    """Map the command-line spellings of an enum back to its members."""
+    return {option_name(member): member for member in enum}
+
+BLUR_OPTIONS = enum_option(BlurType)
+FILTER_OPTIONS = enum_option(FilterType)
+MASK_OPTIONS = enum_option(MaskType)
+INTERPOLATION_OPTIONS = enum_option(Interpolation)
+
+def build_stages(args) -> list:
+    """
+    Build the pipeline stages from the command-line options, in the order the GUI applies them.
+
+    :param args: Parsed arguments of the batch or tiled command.
+    :return: List of pipeline stages.
+    """
+    stages = []
+    if args.rotate:
+        stages.append(RotateStage(args.rotate, INTERPOLATION_OPTIONS[args.interpolation]))
+    if args.grayscale:
+        stages.append(GrayscaleStage())
+    if args.blur:
+        blur_type = BLUR_OPTIONS[args.blur]
+        if blur_type == BlurType.RECURSIVE_GAUSSIAN:
+            # Like in the GUI, the size sets the sigma of the recursive blur
+            stages.append(BlurStage(blur_type, sigma=args.blur_size))
+        else:
+            stages.append(BlurStage(blur_type, args.blur_size))
+    if args.filter:
+        stages.append(FilterStage(FILTER_OPTIONS[args.filter]))
+    if args.mask:
+        stages.append(MaskStage(MASK_OPTIONS[args.mask], args.antialias))
+    return stages
+
+def batch(args) -> int:
+    extension = args.format if not args.format or args.format.startswith(".") else "." + args.format
+    try:
+        summary = run_batch(args.input, args.output, build_stages(args), workers=args.workers,
+                            max_in_flight=args.max_in_flight, overwrite=args.overwrite, extension=extension)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 1 if summary["failed"] else 0
+
+def tiled(args) -> int:
+    shape = tuple(int(size) for size in args.shape.split("x")) if args.shape else None
+    try:
+        process_file(args.input, args.output, build_stages(args), tile_bytes=args.tile_budget * 1024 * 1024,
+                     shape=shape, workers=args.workers)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    return 0
+
+def index_add(args) -> int:
+    index = ImageIndex(args.index)
+    # Images indexed by a previous run are skipped, so a library can be indexed again as it grows
+    indexed = set(index.ids)
+    failed = index.add_files([path for path in find_images(args.input) if path not in indexed])
+    for path in failed:
+        print(f"Could not read the image: {path}", file=sys.stderr)
+    print(f"{len(index)} images indexed")
+    return 1 if failed else 0
+
+def index_query(args) -> int:
+    image = cv2.imread(args.image)
+    if image is None:
+        print(f"Could not read the image: {args.image}", file=sys.stderr)
+        return 1
+    threshold = DUPLICATE_THRESHOLD if args.duplicates else None
+    for image_id, similarity in ImageIndex(args.index).query(image, args.k, threshold):
+        print(f"{similarity:.4f}  {image_id}")
+    return 0
+
+def parse_size(text: str) -> tuple:
+    """Parse an image size given as HEIGHTxWIDTH, or a single number for a square."""
+    height, _, width = text.partition("x")
+    return int(height), int(width or height)
+
+def benchmark(args) -> int:
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    channels = [int(count) for count in args.channels.split(",")]
+    results = run_benchmarks(sizes, channels, args.only, args.min_time)
+    if args.output:
+        save_results(results, args.output)
+
+    problems = [(key, "output differs from the reference implementation")
+                for key, entry in results["results"].items() if not entry.get("matches_reference", True)]
+    if args.baseline:
+        problems = compare_results(results, load_results(args.baseline), args.tolerance)
+    for key, problem in problems:
+        print(f"REGRESSION {key}: {problem}")
+    return 1 if problems else 0
+
+def add_pipeline_arguments(parser, rotation: bool = True):
+    """Add the options that select the pipeline stages."""
+    if rotation:
+        parser.add_argument("--rotate", type=float, default=0, help="Rotation in degrees, counterclockwise.")
+        parser.add_argument("--interpolation", choices=INTERPOLATION_OPTIONS, default="nearest",
+                            help="Sampling for rotations that are not multiples of 90 degrees.")
+    parser.add_argument("--grayscale", action="store_true", help="Convert to grayscale.")
+    parser.add_argument("--blur", choices=BLUR_OPTIONS, help="Blur method.")
+    parser.add_argument("--blur-size", type=int, default=25, help="Blur radius (default: 25).")
+    parser.add_argument("--filter", choices=FILTER_OPTIONS, help="Color filter.")
+    parser.add_argument("--mask", choices=MASK_OPTIONS, help="Shape mask.")
+    parser.add_argument("--antialias", action="store_true", help="Anti-alias the edge of the mask.")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="linoshop", description="Linoshop image editing without the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = commands.add_parser("batch", help="Apply the same edits to many images.")
+    batch_parser.add_argument("input", help="Input directory or glob pattern (quote it, e.g. 'photos/**/*.jpg').")
+    batch_parser.add_argument("output", help="Output directory.")
+    add_pipeline_arguments(batch_parser)
+    batch_parser.add_argument("--workers", type=int, help="Worker processes (default: number of CPUs).")
+    batch_parser.add_argument("--max-in-flight", type=int,
+                              help="Maximum images queued at once, bounds memory use (default: twice the workers).")
+    batch_parser.add_argument("--overwrite", action="store_true",
+                              help="Process images again even if their output exists (default: skip them to resume).")
+    batch_parser.add_argument("--format", help="Output format extension, e.g. png (default: same as the input).")
+    batch_parser.set_defaults(handler=batch)
+
+    tiled_parser = commands.add_parser("tiled", help="Edit an image larger than memory in strips.")
+    tiled_parser.add_argument("input", help="Input .npy file, or a raw file of uint8 pixels with --shape.")
+    tiled_parser.add_argument("output", help="Output .npy file, or a raw file for any other extension.")
+    tiled_parser.add_argument("--shape", help="Shape of a raw input as HEIGHTxWIDTHxCHANNELS, e.g. 40000x60000x3.")
+    tiled_parser.add_argument("--tile-budget", type=int, default=TILE_BUDGET_BYTES // (1024 * 1024),
+                              help="Memory for the strips being processed, in MB (default: %(default)s).")
+    tiled_parser.add_argument("--workers", type=int, help="Strips processed in parallel (default: number of CPUs).")
+    add_pipeline_arguments(tiled_parser, rotation=False)
+    tiled_parser.set_defaults(handler=tiled, rotate=0)
+
+    index_parser = commands.add_parser("index", help="Find similar images in an index of an image library.")
+    index_commands = index_parser.add_subparsers(dest="index_command", required=True)
+    add_parser = index_commands.add_parser("add", help="Add images to an index, creating it if needed.")
+    add_parser.add_argument("index", help="Index directory.")
+    add_parser.add_argument("input", help="Input directory or glob pattern (quote it, e.g. 'photos/**/*.jpg').")
+    add_parser.set_defaults(handler=index_add)
+    query_parser = index_commands.add_parser("query", help="List the indexed images most similar to an image.")
+    query_parser.add_argument("index", help="Index directory.")
+    query_parser.add_argument("image", help="Query image.")
+    query_parser.add_argument("-k", type=int, default=10, help="Number of results (default: 10).")
+    query_parser.add_argument("--duplicates", action="store_true",
+                              help=f"Only list near-duplicates, with a similarity of at least {DUPLICATE_THRESHOLD}.")
+    query_parser.set_defaults(handler=index_query)
+
+    benchmark_parser = commands.add_parser("benchmark", help="Measure the speed and memory use of every tool.")
+    benchmark_parser.add_argument("--sizes", default=",".join(f"{height}x{width}" for height, width in DEFAULT_SIZES),
+                                  help="Comma-separated image sizes, HEIGHTxWIDTH or one number for a square "
+                                       "(default: %(default)s).")
+    benchmark_parser.add_argument("--channels", default="1,3", help="Comma-separated channel layouts (default: 1,3).")
+    benchmark_parser.add_argument("--only", help="Only run the cases whose name contains this text, e.g. blur/box.")
+    benchmark_parser.add_argument("--min-time", type=float, default=MIN_SECONDS,
+                                  help="Minimum seconds spent timing each case (default: %(default)s).")
+    benchmark_parser.add_argument("--output", help="Write the results to this JSON file.")
+    benchmark_parser.add_argument("--baseline", help="Compare with the results in this JSON file and report regressions.")
+    benchmark_parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                                  help="Allowed slowdown against the baseline, as a fraction (default: %(default)s).")
+    benchmark_parser.set_defaults(handler=benchmark)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
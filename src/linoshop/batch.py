@@ -0,0 +1,158 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+import numpy as np
+import cv2
+from tools.compiled import set_thread_count
+from tools.pipeline import Pipeline
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+# Pipeline built once in every worker process
+_worker_pipeline = None
+
+def find_images(source: str) -> list:
+    """
+    List the images to process.
+
+    :param source: A directory (its images, not recursive) or a glob pattern.
+    :return: Sorted list of image paths.
+    """
+    if os.path.isdir(source):
+        paths = [str(path) for path in Path(source).iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS]
+    else:
+        paths = [path for path in glob.glob(source, recursive=True) if path.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(paths)
+
+def source_root(source: str) -> str:
+    """
+    Get the directory the images of a source are found under: the directory itself, or the part of a
+    glob pattern before its first wildcard (e.g. "photos" for "photos/**/*.jpg").
+
+    :param source: A directory or a glob pattern.
+    :return: Root directory.
+    """
+    if os.path.isdir(source):
+        return source
+    parts = []
+    for part in Path(source).parts[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return str(Path(*parts)) if parts else "."
+
+def output_path_for(input_path: str, output_dir: str, extension: str = None, root: str = None) -> str:
+    """
+    Get the output path of an image: its path relative to the source root, under the output directory.
+
+    :param input_path: Path of the input image.
+    :param output_dir: Output directory.
+    :param extension: Optional output extension (e.g. ".png") to convert the format.
+    :param root: Root of the source (see source_root), or None to keep only the file name.
+    :return: Output path.
+    """
+    path = Path(os.path.relpath(input_path, root) if root is not None else Path(input_path).name)
+    suffix = extension if extension else path.suffix
+    return str(Path(output_dir) / path.with_suffix(suffix))
+
+def _init_worker(stages: tuple, threads: int):
+    global _worker_pipeline
+    _worker_pipeline = Pipeline(stages)
+
+    # Workers already run in parallel, so the kernels of each one get a share of the cores
+    set_thread_count(threads)
+    cv2.setNumThreads(threads)
+
+def _process_image(input_path: str, output_path: str) -> tuple:
+    start = time.perf_counter()
+    image = cv2.imread(input_path)
+    if image is None:
+        raise ValueError(f"Could not read the image: {input_path}")
+
+    result = np.ascontiguousarray(_worker_pipeline(image))
+
+    # Write under a temporary name first, so an interrupted run never leaves a partial file to be skipped
+    path = Path(output_path)
+    temporary_path = str(path.with_name(path.stem + ".partial" + path.suffix))
+    if not cv2.imwrite(temporary_path, result):
+        raise ValueError(f"Could not write the image: {output_path}")
+    os.replace(temporary_path, output_path)
+    return image.shape[0] * image.shape[1], time.perf_counter() - start
+
+def run_batch(source: str, output_dir: str, stages, workers: int = None, max_in_flight: int = None,
+              overwrite: bool = False, extension: str = None, log=print) -> dict:
+    """
+    Run a pipeline over many images on a pool of worker processes.
+
+    Each worker reads, processes and writes its image itself, so only file paths and timings travel
+    between processes, and at most max_in_flight images are queued at any time.
+
+    :param source: Input directory or glob pattern.
+    :param output_dir: Output directory, created if needed.
+    :param stages: Pipeline stages applied to every image.
+    :param workers: Number of worker processes, the number of CPUs if not given.
+    :param max_in_flight: Maximum number of images submitted but not finished, twice the workers if not given.
+    :param overwrite: Process images whose output already exists instead of skipping them.
+    :param extension: Optional output extension (e.g. ".png") to convert the format.
+    :param log: Function called with each progress line.
+    :return: Summary with the processed, skipped and failed counts, the elapsed seconds and images per second.
+    :raises ValueError: If several images would be written to the same output file, e.g. a.png and a.jpg
+                        converted to the same format.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or 2 * workers, 1)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Outputs mirror the layout under the source root, so same-named images in different folders stay apart
+    root = source_root(source)
+    outputs = {}
+    for input_path in find_images(source):
+        output_path = output_path_for(input_path, output_dir, extension, root)
+        if output_path in outputs:
+            raise ValueError(f"{outputs[output_path]} and {input_path} would both be written to {output_path}")
+        outputs[output_path] = input_path
+
+    tasks = []
+    skipped = 0
+    for output_path, input_path in outputs.items():
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if not overwrite and os.path.exists(output_path):
+            # Resume: images finished by an earlier run are not processed again
+            skipped += 1
+        else:
+            tasks.append((input_path, output_path))
+
+    processed = failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(tuple(stages), threads)) as executor:
+        pending = {}
+        task_iterator = iter(tasks)
+        while True:
+            # Keep the queue topped up without submitting the whole run at once
+            for input_path, output_path in task_iterator:
+                pending[executor.submit(_process_image, input_path, output_path)] = input_path
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                input_path = pending.pop(future)
+                try:
+                    pixels, seconds = future.result()
+                except Exception as error:
+                    failed += 1
+                    log(f"FAILED {input_path}: {error}")
+                else:
+                    processed += 1
+                    log(f"{input_path}  {seconds:.3f}s  {pixels / seconds / 1e6:.1f} MP/s")
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    log(f"Processed {processed} images in {elapsed:.2f}s ({rate:.2f} images/sec), "
+        f"skipped {skipped}, failed {failed}")
+    return {"processed": processed, "skipped": skipped, "failed": failed, "seconds": elapsed, "images_per_second": rate}
@@ -0,0 +1,448 @@
+import hashlib
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from dataclasses import dataclass
+import numpy as np
+import cv2
+import numba
+from tools.blur import apply_blur, young_van_vliet_coefficients, BlurType, RECURSIVE_MIN_SIGMA
+from tools.cosine_similarity import cosine_similarity, cosine_similarity_matrix
+from tools.grayscale import rgb_to_grayscale
+from tools.image_filter_color import apply_filter, FilterType, FILTER_SETTINGS
+from tools.reshape import apply_mask, get_mask, MaskType
+from tools.rotate import rotate_image, get_new_dimensions, Interpolation
+from tools.pipeline import Pipeline, GrayscaleStage, BlurStage, FilterStage, MaskStage
+from tools.tiling import parallel_apply, RECURSIVE_HALO_SIGMAS
+
+# Image sizes (height, width) measured by default, from a thumbnail up to 8K UHD
+DEFAULT_SIZES = ((256, 256), (1024, 1024), (2048, 2048), (4320, 7680))
+
+# Channel layouts measured by default: grayscale and color
+DEFAULT_CHANNELS = (1, 3)
+
+# Blur radii sampled from the range of the GUI slider (1 to 50)
+BLUR_RADII = (1, 5, 15, 25, 50)
+
+# Rotations: the two buttons of the GUI, and an arbitrary angle for the resampling paths
+ROTATIONS = ((90, Interpolation.NEAREST), (-90, Interpolation.NEAREST),
+             (30, Interpolation.NEAREST), (30, Interpolation.BILINEAR))
+
+# Every case runs for at least this long and this many times; the median run is reported
+MIN_SECONDS = 0.5
+MIN_REPEATS = 3
+
+# A case is a regression when its fastest time grows by more than this fraction over the baseline
+REGRESSION_TOLERANCE = 0.2
+
+@dataclass(frozen=True)
+class Tolerance:
+    """
+    Largest accepted difference between a case and its reference: at most a fraction of the values may
+    differ by more than levels.
+    """
+    levels: float = 0.0
+    fraction: float = 0.0
+
+# Same result, value for value
+EXACT = Tolerance()
+
+# Results truncated or rounded to whole levels, where the float64 reference keeps the fraction
+ONE_LEVEL = Tolerance(1.0)
+
+# Nearest-neighbour rotations may pick the other neighbour for coordinates within rounding of a half pixel
+NEAREST_ROTATION_TOLERANCE = Tolerance(0.0, 1e-4)
+
+# The outline thresholds truncated gradients, so a gradient that rounds across the threshold flips a pixel
+OUTLINE_TOLERANCE = Tolerance(1.0, 1e-3)
+
+# Cosine similarities computed with different summation orders
+SIMILARITY_TOLERANCE = Tolerance(1e-9)
+
+# Stages of the pipeline case, a typical GUI edit
+PIPELINE_STAGES = (GrayscaleStage(), BlurStage(BlurType.GAUSSIAN, 15), FilterStage(FilterType.WARM_TONE),
+                   MaskStage(MaskType.HEART))
+
+def synthetic_image(height: int, width: int, channels: int, seed: int = 0) -> np.ndarray:
+    """
+    Create a reproducible test image: smooth gradients, so blurs and masks see structure, plus noise.
+
+    :param height: Image height.
+    :param width: Image width.
+    :param channels: 1 for a (height, width) image, 3 for (height, width, 3).
+    :param seed: Seed of the noise.
+    :return: uint8 image.
+    """
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    x = np.linspace(0, 1, width, dtype=np.float32)[np.newaxis, :]
+    layers = [128 + 100 * np.sin(2 * np.pi * (x * (channel + 1) + y * (2 - channel))) for channel in range(channels)]
+    image = np.stack(layers, axis=-1) + rng.normal(0, 20, (height, width, channels)).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    return image[:, :, 0] if channels == 1 else image
+
+def reference_pipeline(image: np.ndarray) -> np.ndarray:
+    """Apply the pipeline case one stage at a time, without the fused pointwise kernel."""
+    for stage in PIPELINE_STAGES:
+        image = stage.apply(image)
+    return image
+
+def reference_grayscale(image: np.ndarray) -> np.ndarray:
+    """Grayscale as the weighted float sum of the channels."""
+    if image.ndim == 2:
+        return image.astype(np.float64)
+    return 0.114 * image[:, :, 0] + 0.587 * image[:, :, 1] + 0.299 * image[:, :, 2]
+
+def reference_blur(image: np.ndarray, blur_type: BlurType, radius: int) -> np.ndarray:
+    """
+    Blur with OpenCV's direct float64 filters, with the kernels and borders of tools.blur.
+
+    :param image: Input image.
+    :param blur_type: Blur method.
+    :param radius: Kernel size, or the sigma of the recursive blur.
+    :return: float64 result.
+    """
+    pixels = image.astype(np.float64)
+    if blur_type == BlurType.RECURSIVE_GAUSSIAN:
+        return reference_recursive_gaussian(pixels, radius)
+
+    if blur_type == BlurType.GAUSSIAN:
+        # Same kernel as BlurFilter.gaussian_blur with its default sigma
+        kernel = np.exp(-(np.arange(radius) - (radius - 1) / 2) ** 2 / (2 * 5 ** 2))
+        row_kernel = column_kernel = kernel / kernel.sum()
+    else:
+        column_kernel = np.full(radius, 1 / radius)
+        row_kernel = np.ones(1) if blur_type == BlurType.VERTICAL else column_kernel
+    # BORDER_REFLECT_101 is numpy's 'reflect' padding
+    return cv2.sepFilter2D(pixels, cv2.CV_64F, row_kernel, column_kernel, borderType=cv2.BORDER_REFLECT_101)
+
+def reference_recursive_gaussian(pixels: np.ndarray, sigma: float) -> np.ndarray:
+    """
+    Run the recursive Gaussian's recurrences with numpy, one row or column at a time.
+
+    The recursive blur is an approximation of the Gaussian, so it is checked against its own definition
+    rather than against a convolution. The signal is extended past its end by repeating its last value
+    for as long as the tiled pipeline's halo, instead of starting the anti-causal pass from the exact
+    boundary values the tool computes. Narrow Gaussians use their sampled kernel, like the tool.
+
+    :param pixels: float64 image.
+    :param sigma: Standard deviation of the Gaussian.
+    :return: float64 result.
+    """
+    if sigma < 0.5:
+        return pixels
+    if sigma < RECURSIVE_MIN_SIGMA:
+        radius = int(np.ceil(4 * sigma))
+        kernel = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma**2))
+        kernel /= kernel.sum()
+        return cv2.sepFilter2D(pixels, cv2.CV_64F, kernel, kernel, borderType=cv2.BORDER_REPLICATE)
+    B, a1, a2, a3 = young_van_vliet_coefficients(sigma)
+    extension = int(np.ceil(RECURSIVE_HALO_SIGMAS * sigma))
+
+    def recurse(signal):
+        # Outputs before the start of the signal are clamped to its first value
+        output = np.empty((len(signal) + 3,) + signal.shape[1:])
+        output[:3] = signal[0]
+        for i in range(len(signal)):
+            output[i + 3] = B * signal[i] + a1 * output[i + 2] + a2 * output[i + 1] + a3 * output[i]
+        return output[3:]
+
+    for axis in (0, 1):
+        signal = np.moveaxis(pixels, axis, 0)
+        extended = np.concatenate([signal, np.repeat(signal[-1:], extension, axis=0)])
+        pixels = np.moveaxis(recurse(recurse(extended)[::-1])[::-1][:len(signal)], 0, axis)
+    return pixels
+
+def reference_filter(image: np.ndarray, filter_type: FilterType) -> np.ndarray:
+    """Apply a filter with its float formula instead of the lookup tables, or the outline with OpenCV's Sobel."""
+    if filter_type == FilterType.OUTLINE:
+        grayscale = rgb_to_grayscale(image).astype(np.float64)
+        gx = cv2.Sobel(grayscale, cv2.CV_64F, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE)
+        gy = cv2.Sobel(grayscale, cv2.CV_64F, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE)
+        magnitude = np.floor(np.minimum(np.hypot(gx, gy), 255))
+        if magnitude.max() > 0:
+            magnitude *= 255 / magnitude.max()
+        outline = np.floor(magnitude)
+        outline[outline <= 50] = 255
+        return outline
+
+    settings = FILTER_SETTINGS[filter_type]
+    scaling = np.array(settings['scaling'], dtype=np.float64)
+    offset = np.array(settings['offset'], dtype=np.float64)
+    if image.ndim == 2:
+        if len(set(scaling)) == 1 and len(set(offset)) == 1:
+            # Same adjustment on every channel, a grayscale image stays grayscale
+            return np.clip(image * scaling[0] + offset[0], 0, 255)
+        image = image[:, :, np.newaxis]
+    return np.clip(image * scaling + offset, 0, 255)
+
+def reference_mask(image: np.ndarray, mask_type: MaskType, antialias: bool) -> np.ndarray:
+    """Black out the pixels outside a mask by boolean indexing, or scale them by their coverage."""
+    mask = get_mask(image.shape[0], image.shape[1], mask_type, antialias)
+    if antialias:
+        coverage = mask / 255
+        return image * (coverage if image.ndim == 2 else coverage[:, :, np.newaxis])
+    result = image.copy()
+    result[mask == 0] = 0
+    return result
+
+def reference_rotation(image: np.ndarray, angle: float, interpolation: Interpolation) -> np.ndarray:
+    """
+    Rotate with np.rot90 for quarter turns, otherwise by sampling the source one output row at a time.
+
+    :param image: Input image.
+    :param angle: Angle in degrees, counterclockwise.
+    :param interpolation: Sampling method.
+    :return: Rotated image, float64 for bilinear sampling.
+    """
+    if angle % 90 == 0:
+        return np.rot90(image, int(angle // 90) % 4)
+
+    height, width = image.shape[:2]
+    new_width, new_height = get_new_dimensions(width, height, angle)
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    output = np.zeros((new_height, new_width) + image.shape[2:], dtype=np.float64)
+    padded = np.pad(image.astype(np.float64), ((1, 1), (1, 1)) + ((0, 0),) * (image.ndim - 2))
+    x = np.arange(new_width) - new_width // 2
+
+    for row in range(new_height):
+        y = row - new_height // 2
+        source_x = cos * x - sin * y + width // 2
+        source_y = sin * x + cos * y + height // 2
+        if interpolation == Interpolation.NEAREST:
+            sx = np.floor(source_x + 0.5).astype(int)
+            sy = np.floor(source_y + 0.5).astype(int)
+            inside = (sx >= 0) & (sx < width) & (sy >= 0) & (sy < height)
+            output[row, inside] = image[sy[inside], sx[inside]]
+        else:
+            x0 = np.floor(source_x)
+            y0 = np.floor(source_y)
+            inside = (x0 >= -1) & (x0 < width) & (y0 >= -1) & (y0 < height)
+            fx, fy = source_x - x0, source_y - y0
+            if image.ndim == 3:
+                fx, fy = fx[:, np.newaxis], fy[:, np.newaxis]
+            # Neighbours in the padded source, whose zero border blends with the outside
+            px = np.clip(x0.astype(int) + 1, 0, width)
+            py = np.clip(y0.astype(int) + 1, 0, height)
+            top = padded[py, px] * (1 - fx) + padded[py, px + 1] * fx
+            bottom = padded[py + 1, px] * (1 - fx) + padded[py + 1, px + 1] * fx
+            output[row, inside] = (top * (1 - fy) + bottom * fy)[inside]
+    return output
+
+def benchmark_cases() -> list:
+    """
+    List the benchmark cases.
+
+    Each case is (name, function, reference, tolerance): function maps an image to a result, reference
+    is an independent, simpler implementation, and tolerance is the largest accepted difference between them.
+
+    :return: List of cases.
+    """
+    cases = [("grayscale", rgb_to_grayscale, reference_grayscale, ONE_LEVEL)]
+    for blur_type in BlurType:
+        for radius in BLUR_RADII:
+            if blur_type == BlurType.RECURSIVE_GAUSSIAN:
+                # Like in the GUI, the radius sets the sigma of the recursive blur
+                function = lambda image, blur_type=blur_type, radius=radius: apply_blur(image, blur_type, sigma=radius)
+            else:
+                function = lambda image, blur_type=blur_type, radius=radius: apply_blur(image, blur_type, radius)
+            cases.append((f"blur/{blur_type.name.lower()}/{radius}", function,
+                          lambda image, blur_type=blur_type, radius=radius: reference_blur(image, blur_type, radius),
+                          ONE_LEVEL))
+    for filter_type in FilterType:
+        cases.append((f"filter/{filter_type.name.lower()}",
+                      lambda image, filter_type=filter_type: apply_filter(image, filter_type),
+                      lambda image, filter_type=filter_type: reference_filter(image, filter_type),
+                      OUTLINE_TOLERANCE if filter_type == FilterType.OUTLINE else ONE_LEVEL))
+    for mask_type in MaskType:
+        for antialias in (False, True):
+            name = f"mask/{mask_type.name.lower()}" + ("/antialias" if antialias else "")
+            cases.append((name, lambda image, mask_type=mask_type, antialias=antialias:
+                          apply_mask(image, mask_type, antialias),
+                          lambda image, mask_type=mask_type, antialias=antialias:
+                          reference_mask(image, mask_type, antialias),
+                          ONE_LEVEL if antialias else EXACT))
+    for angle, interpolation in ROTATIONS:
+        if angle % 90 == 0:
+            tolerance = EXACT
+        else:
+            tolerance = NEAREST_ROTATION_TOLERANCE if interpolation == Interpolation.NEAREST else ONE_LEVEL
+        cases.append((f"rotate/{angle}/{interpolation.name.lower()}",
+                      lambda image, angle=angle, interpolation=interpolation: rotate_image(image, angle, interpolation),
+                      lambda image, angle=angle, interpolation=interpolation:
+                      reference_rotation(image, angle, interpolation),
+                      tolerance))
+
+    def similarity(image):
+        return cosine_similarity(image, 255 - image)
+
+    def similarity_matrix(image):
+        return float(cosine_similarity_matrix([image], [255 - image])[0, 0])
+
+    cases.append(("cosine-similarity", similarity, similarity_matrix, SIMILARITY_TOLERANCE))
+    pipeline = Pipeline(PIPELINE_STAGES)
+    cases.append(("pipeline", pipeline, reference_pipeline, EXACT))
+    cases.append(("pipeline/parallel", lambda image: parallel_apply(image, PIPELINE_STAGES), pipeline, EXACT))
+    return cases
+
+def digest(result) -> str:
+    """
+    Fingerprint the result of a case, so a later run can tell whether it changed.
+
+    :param result: Image or number.
+    :return: Hex digest of the shape, type and pixels of an image, or the repr of a number.
+    """
+    if isinstance(result, np.ndarray):
+        hasher = hashlib.sha1(f"{result.shape}{result.dtype}".encode())
+        hasher.update(np.ascontiguousarray(result).data)
+        return hasher.hexdigest()
+    return repr(round(float(result), 9))
+
+def describe_error(error: Exception) -> str:
+    """Summarize an exception on one line."""
+    lines = str(error).strip().splitlines()
+    return f"{type(error).__name__}: {lines[0] if lines else ''}"
+
+def reference_difference(result, reference, tolerance: Tolerance) -> tuple:
+    """
+    Compare a result with the result of the reference implementation.
+
+    :param result: Image or number.
+    :param reference: Reference image or number.
+    :param tolerance: Largest accepted difference.
+    :return: (matches, largest difference); an image of another shape never matches.
+    """
+    if isinstance(result, np.ndarray):
+        if not isinstance(reference, np.ndarray) or result.shape != reference.shape:
+            return False, None
+        if result.size == 0:
+            return True, 0.0
+        difference = np.abs(result.astype(np.float64) - reference)
+        beyond = np.count_nonzero(difference > tolerance.levels)
+        return beyond <= tolerance.fraction * difference.size, float(difference.max())
+    difference = abs(float(result) - float(reference))
+    return difference <= tolerance.levels, difference
+
+def measure(function, image: np.ndarray, min_seconds: float = MIN_SECONDS, min_repeats: int = MIN_REPEATS) -> dict:
+    """
+    Time a function on an image, after a first call that compiles and warms the caches.
+
+    :param function: Function of the image.
+    :param image: Input image.
+    :param min_seconds: Keep repeating until this much time has been spent.
+    :param min_repeats: Minimum number of timed calls.
+    :return: Result of the first call, median and minimum seconds, number of repeats and peak traced memory.
+    """
+    result = function(image)
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_repeats or time.perf_counter() - start < min_seconds:
+        call_start = time.perf_counter()
+        function(image)
+        times.append(time.perf_counter() - call_start)
+
+    # Tracing slows allocations down, so memory is measured in a separate call; it covers the NumPy
+    # arrays and Python objects, not the internal buffers of OpenCV
+    tracemalloc.start()
+    try:
+        function(image)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"result": result, "seconds": statistics.median(times), "min_seconds": min(times), "repeats": len(times),
+            "peak_bytes": peak}
+
+def environment() -> dict:
+    """Describe the machine and library versions, stored with the results."""
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor(),
+            "cpus": os.cpu_count(), "numpy": np.__version__, "opencv": cv2.__version__, "numba": numba.__version__,
+            "numba_threads": numba.get_num_threads()}
+
+def run_benchmarks(sizes=DEFAULT_SIZES, channels=DEFAULT_CHANNELS, only: str = None, min_seconds: float = MIN_SECONDS,
+                   check: bool = True, log=print) -> dict:
+    """
+    Run every benchmark case on synthetic images of every size and channel layout.
+
+    :param sizes: Image sizes as (height, width).
+    :param channels: Channel layouts, 1 and/or 3.
+    :param only: Optional text that the case names must contain, e.g. "blur/box".
+    :param min_seconds: Minimum time spent timing each case.
+    :param check: Compare every case with its reference implementation, within the tolerance of the case.
+    :param log: Function called with each progress line.
+    :return: Results as a JSON-compatible dict: the environment, and for each case key its timings,
+             throughput, peak memory and output digest, or the error of an unsupported layout.
+    """
+    results = {}
+    for height, width in sizes:
+        for channel_count in channels:
+            image = synthetic_image(height, width, channel_count)
+            for name, function, reference, tolerance in benchmark_cases():
+                if only and only not in name:
+                    continue
+                key = f"{name}/{height}x{width}x{channel_count}"
+                try:
+                    measurement = measure(function, image, min_seconds)
+                except Exception as error:
+                    results[key] = {"error": describe_error(error)}
+                    log(f"{key}  unsupported ({results[key]['error']})")
+                    continue
+
+                result = measurement.pop("result")
+                entry = dict(measurement, megapixels_per_second=height * width / 1e6 / measurement["seconds"],
+                             digest=digest(result))
+                if check:
+                    try:
+                        matches, difference = reference_difference(result, reference(image), tolerance)
+                        entry["matches_reference"] = matches
+                        entry["reference_difference"] = difference
+                    except Exception as error:
+                        entry["reference_error"] = describe_error(error)
+                results[key] = entry
+                log(f"{key}  {entry['seconds'] * 1000:.2f} ms  {entry['megapixels_per_second']:.1f} MP/s  "
+                    f"peak {entry['peak_bytes'] / 2 ** 20:.1f} MB"
+                    + ("" if entry.get("matches_reference", True) else "  DIFFERS FROM REFERENCE"))
+    return {"environment": environment(), "results": results}
+
+def compare_results(current: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    """
+    Compare benchmark results with a stored baseline.
+
+    :param current: Results of run_benchmarks.
+    :param baseline: Earlier results, e.g. loaded with load_results.
+    :param tolerance: Allowed relative growth of the fastest time.
+    :return: List of (key, problem) for every slower case, changed output, failed reference check or newly
+             failing case; cases missing from either run are ignored.
+    """
+    problems = []
+    for key, entry in current["results"].items():
+        before = baseline["results"].get(key)
+        if before is None:
+            continue
+        if "error" in entry:
+            if "error" not in before:
+                problems.append((key, f"now fails: {entry['error']}"))
+            continue
+        if not entry.get("matches_reference", True):
+            problems.append((key, "output differs from the reference implementation"))
+        if "error" in before:
+            continue
+        if entry["digest"] != before["digest"]:
+            problems.append((key, "output changed"))
+        # The fastest run is compared, as it is the least disturbed by the rest of the system
+        if entry["min_seconds"] > before["min_seconds"] * (1 + tolerance):
+            problems.append((key, f"{entry['min_seconds'] / before['min_seconds']:.2f}x slower "
+                                  f"({before['min_seconds'] * 1000:.2f} ms -> {entry['min_seconds'] * 1000:.2f} ms)"))
+    return problems
+
+def save_results(results: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+def load_results(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
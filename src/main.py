@@ -1,48 +1,150 @@
 import cv2
-import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 from ttkthemes import ThemedTk  # For modern themes
 from PIL import Image, ImageTk
 
-from tools.blur import apply_blur, BlurType
-from tools.grayscale import rgb_to_grayscale
-from tools.image_filter_color import apply_filter, FilterType
-from tools.reshape import apply_mask, MaskType
-from tools.rotate import rotate_image
+from tools.blur import BlurType
+from tools.image_filter_color import FilterType
+from tools.reshape import MaskType
+from tools.pipeline import Pipeline, GrayscaleStage, BlurStage, FilterStage, MaskStage
+from tools.transform import TransformStack
+from tools.history import History
+from tools.jobs import JobScheduler
 from tools.cosine_similarity import cosine_similarity
+from tools.profiling import profiler
+from tools.stage_cache import StageCache
 
 filter_list = [filter.value for filter in FilterType]
 blur_option_list = [blur.value for blur in BlurType]
 mask_list = [mask.value for mask in MaskType]
 
-undo_stack = []
-redo_stack = []
-
-def save_to_undo():
-    """Save the current processed image state to the undo stack."""
-    global undo_stack
-    undo_stack.append(processed_image.copy())
-    if len(undo_stack) > 10:  # Limit history to 10 states (optional)
-        undo_stack.pop(0)
+# Outputs of the pipeline stages, so re-applying an edit with only its last steps changed resumes after the blur
+stage_cache = StageCache()
+
+# Undo/redo states, compressed or stored as the operation that produced them, within a memory budget
+history = History()
+
+# Rotations are recorded here and only resampled when the full-resolution pixels are needed
+pending_transform = TransformStack()
+
+# Full-resolution renders run on a single background worker, a newer request cancels the older one
+scheduler = JobScheduler()
+RENDER_JOB = "render"
+SAVE_JOB = "save"
+SIMILARITY_JOB = "similarity"
+HISTORY_JOB = "history"
+JOB_POLL_INTERVAL_MS = 50
+
+# Proxy mode: edits are previewed on a display-sized copy and replayed on the full image on save or render
+proxy_image = None
+proxy_scale = 1.0
+pending_edits = []  # (TransformStack, Pipeline) pairs, in the order they were applied
+redo_edits = []
+
+# History state being restored by a background undo/redo, None when none is running
+history_target = None
+
+# Latest full-image render requested, as (base, edits, result): render, save and similarity jobs for the
+# same base and edits share one render, the first of them to run fills the result and the others reuse it
+shared_render = None
+
+# Number of recent stages listed in the profiling panel
+PROFILE_PANEL_ROWS = 8
+shown_profile_count = 0
+
+def commit_to_history(operation=None):
+    """Record the current processed image as a new history state, dropping the redo states."""
+    history.commit(processed_image, operation)
+    update_history_label()
+
+def update_history_label():
+    """Show how much memory the undo/redo history uses."""
+    history_label.config(text=f"History: {history.nbytes / 1024 ** 2:.1f} MB ({len(history)} states)")
+
+def update_cache_label():
+    """Show the hits, misses and memory of the stage cache."""
+    stats = stage_cache.stats()
+    text = (f"Cache: {stats['hits']} hits / {stats['misses']} misses, "
+            f"{stats['nbytes'] / 1024 ** 2:.1f} MB")
+    if cache_label.cget("text") != text:
+        cache_label.config(text=text)
 
 def undo():
     """Undo the last operation by popping from the undo stack."""
-    global processed_image, redo_stack
-    if undo_stack:
-        redo_stack.append(processed_image.copy())
-        processed_image = undo_stack.pop()
+    if pending_edits or not pending_transform.is_identity():
+        # Edits not rendered at full resolution yet are dropped without touching the full image
+        flush_pending_transform()
+        redo_edits.append(pending_edits.pop())
+        rebuild_proxy()
         update_processed_image(processed_image)
+        schedule_render_if_needed()
+    else:
+        step_history(-1)
 
 def redo():
     """Redo the last undone operation by popping from the redo stack."""
-    global processed_image
-    if redo_stack:
-        undo_stack.append(processed_image.copy())
-        processed_image = redo_stack.pop()
+    if redo_edits:
+        flush_pending_transform()
+        transform, pipeline = redo_edits.pop()
+        pending_edits.append((transform, pipeline))
+        apply_edit_to_proxy(transform, pipeline)
+        update_processed_image(processed_image)
+        schedule_render_if_needed()
+    elif not pending_edits and pending_transform.is_identity():
+        step_history(1)
+
+def step_history(offset: int):
+    """
+    Restore the previous or next history state in the background.
+
+    Restoring can replay several full-resolution operations, so it runs as a job and the state only
+    becomes current when it is done. Clicks made meanwhile step on from the state being restored.
+
+    :param offset: -1 to undo, 1 to redo.
+    """
+    global history_target
+    target = (history.index if history_target is None else history_target) + offset
+    if not 0 <= target < len(history):
+        return
+    scheduler.cancel(RENDER_JOB)
+    if target == history.index:
+        # Back to the state already shown
+        cancel_history_restore()
+        return
+
+    # States stored as operations are replayed on the current image
+    restore = history.restorer(target, processed_image)
+    history_target = target
+
+    def restore_state():
+        with profiler.span("restore_history", processed_image):
+            return restore()
+
+    def restored(image):
+        global processed_image, history_target
+        history_target = None
+        history.select(target)
+        processed_image = image
+        discard_proxy()
+        update_history_label()
         update_processed_image(processed_image)
-        
+
+    def failed(error):
+        global history_target
+        history_target = None
+        show_job_error(error)
+
+    scheduler.submit(HISTORY_JOB, restore_state, on_done=restored, on_error=failed)
+    set_loading(True)
+
+def cancel_history_restore():
+    """Drop a background undo/redo, e.g. when an edit is made to the image still shown."""
+    global history_target
+    scheduler.cancel(HISTORY_JOB)
+    history_target = None
+
 def preview_original(event):
     """Preview the original image when the mouse hovers over the image."""
     previwed_image.config(image=original_image_tk)
@@ -71,20 +173,35 @@ def resize_with_aspect_ratio(image, max_height=400):
         return cv2.resize(image, (new_width, new_height))
     return image
 
+def to_display_rgb(image):
+    """Convert a BGR image, or a single-channel grayscale one, to RGB for display."""
+    if image.ndim == 2:
+        # Grayscale edits stay single-channel and are only expanded here
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
 def load_image(image_path):
     """Load and display the selected image."""
     global original_image, processed_image, original_image_tk
 
-    original_image = cv2.imread(image_path)
+    with profiler.span("load_image") as span:
+        original_image = cv2.imread(image_path)
+        span.set_image(original_image)
     if original_image is None:
         messagebox.showerror("Error", "Could not read the image.")
         return
 
+    scheduler.cancel(RENDER_JOB)
+    cancel_history_restore()
     processed_image = original_image.copy()
+    pending_transform.reset()
+    discard_proxy()
+    history.reset(original_image)
+    update_history_label()
     
     # Resize while maintaining the aspect ratio
     resized_original = resize_with_aspect_ratio(original_image)
-    original_image_rgb = cv2.cvtColor(resized_original, cv2.COLOR_BGR2RGB)
+    original_image_rgb = to_display_rgb(resized_original)
     original_image_pil = Image.fromarray(original_image_rgb)
     original_image_tk = ImageTk.PhotoImage(original_image_pil)
     
@@ -111,65 +228,104 @@ def set_loading(loading=True):
 def update_processed_image(image):
     """Update the processed image in the Tkinter label."""
     global processed_image_tk
-    # Resize while maintaining the aspect ratio
-    resized_image = resize_with_aspect_ratio(image)
-    image_rgb = cv2.cvtColor(resized_image, cv2.COLOR_BGR2RGB)
+    if proxy_image is not None:
+        # Edits made in proxy mode only exist on the display-sized copy so far
+        resized_image, scale = proxy_image, proxy_scale
+    else:
+        # Resize while maintaining the aspect ratio
+        resized_image = resize_with_aspect_ratio(image)
+        scale = resized_image.shape[0] / image.shape[0]
+    if not pending_transform.is_identity():
+        # Preview pending rotations on the display-sized copy only
+        resized_image = resize_with_aspect_ratio(pending_transform.render(resized_image, scale=scale))
+    image_rgb = to_display_rgb(resized_image)
     image_pil = Image.fromarray(image_rgb)
     processed_image_tk = ImageTk.PhotoImage(image_pil)
     previwed_image.config(image=processed_image_tk)
 
-def run_in_thread(target_func, *args):
-    """Run a target function in a separate thread and show loading indicator."""
-    def wrapper():
-        set_loading(True)
-        try:
-            target_func(*args)
-        finally:
-            set_loading(False)
-    
-    threading.Thread(target=wrapper, daemon=True).start()
+def poll_jobs():
+    """Hand the results of finished background jobs to the Tk main loop."""
+    scheduler.poll()
+    set_loading(scheduler.busy)
+    update_profile_panel()
+    update_cache_label()
+    root.after(JOB_POLL_INTERVAL_MS, poll_jobs)
+
+def toggle_profiling():
+    """Turn the profiling of each stage on or off from the View menu."""
+    if profile_var.get():
+        profiler.enable(profiler.trace_path)
+        profile_label.grid(row=9, column=0, columnspan=2, sticky=tk.W, pady=10)
+    else:
+        profiler.disable()
+        profile_label.grid_remove()
 
-def apply_filters():
-    """Apply the selected filters and update the processed image."""
-    global processed_image
-    path = image_path.get()
-    if not path:
-        messagebox.showerror("Error", "Please select an image first.")
+def update_profile_panel():
+    """List the latest profiled stages in the profiling panel."""
+    global shown_profile_count
+    if profiler.count == shown_profile_count:
         return
-    
-    # Save the current state for undo before applying any filter
-    save_to_undo()
+    shown_profile_count = profiler.count
+    spans = list(profiler.recent)[-PROFILE_PANEL_ROWS:]
+    profile_label.config(text="\n".join(str(span) for span in reversed(spans)))
 
-    # Clear redo stack when a new filter is applied
-    redo_stack.clear()
+def show_job_error(error):
+    """Report a background job that failed."""
+    messagebox.showerror("Error", str(error))
+
+def build_pipeline():
+    """Build the processing pipeline from the options selected in the GUI."""
+    stages = []
 
     # Apply grayscale if selected
     if grayscale_var.get():
-        processed_image = rgb_to_grayscale(processed_image)
-        processed_image = cv2.cvtColor(processed_image, cv2.COLOR_GRAY2BGR)  # Convert to 3 channels for consistency
+        stages.append(GrayscaleStage())
 
     # Apply blur if selected
     if blur_var.get():
         kernel_size = int(blur_radius.get())
         blur_type = BlurType(blur_option.get())
-        processed_image = apply_blur(processed_image, blur_type, kernel_size)
+        if blur_type == BlurType.RECURSIVE_GAUSSIAN:
+            # The recursive blur has no kernel, so the slider sets its sigma directly
+            stages.append(BlurStage(blur_type, sigma=kernel_size))
+        else:
+            stages.append(BlurStage(blur_type, kernel_size))
 
     # Apply the selected filter
     selected_filter = filter_option.get()
     if selected_filter != "None":
-        filter_type = FilterType(selected_filter)
-        processed_image = apply_filter(processed_image, filter_type)
+        stages.append(FilterStage(FilterType(selected_filter)))
 
     # Apply shape mask if selected
     if mask_option.get() != "None":
-        mask_type = MaskType(mask_option.get())
-        processed_image = apply_mask(processed_image, mask_type)
+        stages.append(MaskStage(MaskType(mask_option.get())))
 
-    update_processed_image(processed_image)
+    # Stage outputs are shared through the cache with earlier edits and the proxy
+    return Pipeline(stages, stage_cache)
 
-def apply_filters_thread():
-    """Wrapper to apply filters in a separate thread."""
-    run_in_thread(apply_filters)
+def apply_filters():
+    """Apply the selected filters and update the processed image."""
+    path = image_path.get()
+    if not path:
+        messagebox.showerror("Error", "Please select an image first.")
+        return
+
+    # Adjacent pointwise steps (grayscale, tone filters, mask) run as one fused pass
+    pipeline = build_pipeline()
+
+    # The edit applies to the image shown, not to a state an undo/redo is still restoring
+    cancel_history_restore()
+
+    # The edit is previewed on the display-sized copy right away
+    with profiler.span("apply_filters", processed_image):
+        flush_pending_transform()
+        pending_edits.append((TransformStack(), pipeline))
+        redo_edits.clear()
+        apply_edit_to_proxy(*pending_edits[-1])
+        update_processed_image(processed_image)
+
+    # Outside proxy mode the full image follows in the background, in proxy mode it waits for save or render
+    schedule_render_if_needed()
 
 def apply_rotate_image(angle: float = 0):
     """Rotate the image."""
@@ -179,22 +335,140 @@ def apply_rotate_image(angle: float = 0):
         messagebox.showerror("Error", "Please select an image first.")
         return
 
-    processed_image = rotate_image(processed_image.copy(), angle)
+    # Only record the rotation, consecutive rotations are combined and resampled once
+    cancel_history_restore()
+    with profiler.span("apply_rotate_image", processed_image):
+        pending_transform.rotate(angle)
+        update_processed_image(processed_image)
+
+def flush_pending_transform():
+    """Record the pending rotations as a proxy edit of their own."""
+    if not pending_transform.is_identity():
+        pending_edits.append((pending_transform.copy(), Pipeline([])))
+        pending_transform.reset()
+        apply_edit_to_proxy(*pending_edits[-1])
+
+def rebuild_proxy():
+    """Create the display-sized proxy of the full image and replay the pending edits on it."""
+    global proxy_image, proxy_scale
+    proxy_image = resize_with_aspect_ratio(processed_image)
+    proxy_scale = proxy_image.shape[0] / processed_image.shape[0]
+    for transform, pipeline in pending_edits:
+        apply_edit_to_proxy(transform, pipeline)
+
+def apply_edit_to_proxy(transform, pipeline):
+    """Apply one edit to the proxy, with translations and blur sizes scaled to the proxy size."""
+    global proxy_image
+    if proxy_image is None:
+        # The pending edits are replayed by rebuild_proxy, the new one included
+        rebuild_proxy()
+        return
+    proxy_image = pipeline.scaled(proxy_scale)(transform.render(proxy_image, scale=proxy_scale))
+
+def discard_proxy():
+    """Forget the proxy and every edit not rendered at full resolution."""
+    global proxy_image
+    proxy_image = None
+    pending_edits.clear()
+    redo_edits.clear()
+
+def replay_edits(edits):
+    """Get an operation that replays proxy edits on the full-resolution image."""
+    def operation(image):
+        for transform, pipeline in edits:
+            image = pipeline(transform.render(image))
+        return image
+    return operation
+
+def schedule_render(key=RENDER_JOB, finish=None, on_finished=None):
+    """
+    Render the pending edits on the full image in the background.
+
+    :param key: Job key; a newer job with the same key cancels this one.
+    :param finish: Optional function run on the worker with the rendered image, e.g. to write it to a file.
+    :param on_finished: Optional function called on the main thread with the result of finish.
+    """
+    global shared_render
+    flush_pending_transform()
+    edits = pending_edits[:]
+    base = processed_image
+
+    # The jobs run one at a time in the order they were submitted, so a save or similarity requested
+    # while the same edits render waits for that render and reuses its image
+    if shared_render is None or shared_render[0] is not base or shared_render[1] != edits:
+        shared_render = (base, edits, {})
+    result = shared_render[2]
+
+    def render():
+        if "image" in result:
+            image = result["image"]
+        else:
+            with profiler.span(f"render ({key})", base):
+                image = replay_edits(edits)(base) if edits else base
+            result["image"] = image
+        return image, finish(image) if finish is not None else None
+
+    def rendered(result):
+        image, value = result
+        commit_render(base, edits, image)
+        if on_finished is not None:
+            on_finished(value)
+
+    scheduler.submit(key, render, on_done=rendered, on_error=show_job_error)
+    set_loading(True)
+
+def schedule_render_if_needed():
+    """Keep the full image up to date with the pending edits, unless proxy mode defers it."""
+    if pending_edits and not proxy_var.get():
+        schedule_render()
+    else:
+        scheduler.cancel(RENDER_JOB)
+
+def commit_render(base, edits, image):
+    """Make a background render the current image, unless the edits it covers have changed since."""
+    global processed_image, proxy_image, shared_render
+    if not edits or base is not processed_image or pending_edits[:len(edits)] != edits:
+        return
+
+    # Jobs already queued keep their reference to the shared result, later ones start from the new image
+    shared_render = None
+    # All the edits rendered together are undone together
+    processed_image = image
+    commit_to_history(replay_edits(edits))
+    redo_edits.clear()
+
+    # Edits added while rendering stay on the proxy
+    del pending_edits[:len(edits)]
+    proxy_image = None
+    if pending_edits:
+        rebuild_proxy()
     update_processed_image(processed_image)
 
-def apply_rotate_image_thread(angle):
-    """Wrapper to rotate image in a separate thread."""
-    run_in_thread(apply_rotate_image, angle)
+def render_full_resolution():
+    """Render the pending proxy edits and rotations on the full image."""
+    if image_path.get() and (pending_edits or not pending_transform.is_identity()):
+        schedule_render()
+
+def toggle_proxy():
+    """Render the edits made in proxy mode when it is turned off."""
+    schedule_render_if_needed()
 
 def calculate_cosine_similarity():
     """Calculate the cosine similarity between the original and processed image."""
-    global original_image, processed_image
     if original_image is None:
         messagebox.showerror("Error", "Please select an image first.")
         return
-    
-    similarity = cosine_similarity(original_image, processed_image)
-    cosine_similarity_label.config(text=f"Cosine Similarity: {similarity:.4f} - {similarity * 100:.2f}%")
+
+    def show_similarity(similarity):
+        cosine_similarity_label.config(text=f"Cosine Similarity: {similarity:.4f} - {similarity * 100:.2f}%")
+
+    original = original_image
+
+    def similarity(image):
+        with profiler.span("calculate_cosine_similarity", image):
+            return cosine_similarity(original, image)
+
+    schedule_render(SIMILARITY_JOB, similarity, show_similarity)
 
     
 def preview_original(event):
@@ -212,8 +486,19 @@ def save_image():
         filetypes=[("PNG Files", "*.png"), ("JPEG Files", "*.jpg"), ("BMP Files", "*.bmp")]
     )
     if path:
-        cv2.imwrite(path, processed_image)
+        def write(image):
+            with profiler.span("save_image", image):
+                return cv2.imwrite(path, image)
+
+        # The full-resolution render of pending edits can take a while, keep the window responsive
+        schedule_render(SAVE_JOB, write, show_saved)
+
+def show_saved(written):
+    """Report the outcome of a background save."""
+    if written:
         messagebox.showinfo("Success", "Image saved successfully.")
+    else:
+        messagebox.showerror("Error", "Could not save the image.")
 
 def close_windows():
     """Close all OpenCV windows and quit the application."""
@@ -242,6 +527,7 @@ mask_option = tk.StringVar()
 # Variables to control checkboxes
 grayscale_var = tk.BooleanVar()
 blur_var = tk.BooleanVar()
+proxy_var = tk.BooleanVar()
 
 # Configure grid for root window with 2 columns
 root.grid_columnconfigure(0, weight=1)  # Left side (tools)
@@ -262,6 +548,14 @@ undo_button.grid(row=0, column=1, pady=10)
 redo_button = ttk.Button(tools_frame, text="↪️ Redo", command=redo)
 redo_button.grid(row=0, column=2, pady=10)
 
+# Memory used by the undo/redo history
+history_label = ttk.Label(tools_frame, text="History: 0.0 MB")
+history_label.grid(row=0, column=3, pady=10, padx=10)
+
+# Stage cache statistics
+cache_label = ttk.Label(tools_frame, text="Cache: 0 hits / 0 misses")
+cache_label.grid(row=1, column=3, pady=10, padx=10)
+
 # Grayscale checkbox
 grayscale_checkbox = ttk.Checkbutton(tools_frame, text="🖤 Grayscale", variable=grayscale_var)
 grayscale_checkbox.grid(row=1, column=0, pady=10)
@@ -310,19 +604,26 @@ mask_menu.grid(row=5, column=1)
 rotate_label = ttk.Label(tools_frame, text="Rotate Image:")
 rotate_label.grid(row=6, column=0, pady=10)
 
-rotate_left_button = ttk.Button(tools_frame, text="⏪ Rotate Left", command=lambda: apply_rotate_image_thread(90))
+rotate_left_button = ttk.Button(tools_frame, text="⏪ Rotate Left", command=lambda: apply_rotate_image(90))
 rotate_left_button.grid(row=6, column=1, padx=5)
 
-rotate_right_button = ttk.Button(tools_frame, text="⏩ Rotate Right", command=lambda: apply_rotate_image_thread(-90))
+rotate_right_button = ttk.Button(tools_frame, text="⏩ Rotate Right", command=lambda: apply_rotate_image(-90))
 rotate_right_button.grid(row=6, column=2, padx=5)
 
 # Apply Button
-apply_button = ttk.Button(tools_frame, text="✨ Apply Filters", command=apply_filters_thread)
+apply_button = ttk.Button(tools_frame, text="✨ Apply Filters", command=apply_filters)
 apply_button.grid(row=7, column=0, pady=20)
 
 save_button = ttk.Button(tools_frame, text="💾 Save Image", command=save_image)
 save_button.grid(row=7, column=1, pady=20)
 
+# Proxy preview checkbox and full-resolution render button
+proxy_checkbox = ttk.Checkbutton(tools_frame, text="⚡ Fast Preview", variable=proxy_var, command=toggle_proxy)
+proxy_checkbox.grid(row=1, column=1, pady=10)
+
+render_button = ttk.Button(tools_frame, text="🖼️ Render", command=render_full_resolution)
+render_button.grid(row=7, column=2, pady=20)
+
 # Button to calculate cosine similarity
 cosine_button = ttk.Button(tools_frame, text="📊 Cosine Similarity", command= calculate_cosine_similarity )
 cosine_button.grid(row=8, column=1, pady=10)
@@ -348,8 +649,24 @@ previwed_image.bind("<Leave>", show_processed_image)
 loading_label = ttk.Label(image_frame, text="Processing...", foreground="red", font=('Helvetica', 12, 'bold'))
 loading_label.grid_remove()
 
+# Profiling panel: time, memory allocated and image size of the latest stages
+profile_label = ttk.Label(image_frame, text="Profiling: no stages yet", font=('Courier', 9), justify=tk.LEFT)
+profile_label.grid_remove()
+
+# View menu with the profiling toggle, also turned on by the LINOSHOP_PROFILE environment variable
+profile_var = tk.BooleanVar(value=profiler.enabled)
+menu_bar = tk.Menu(root)
+view_menu = tk.Menu(menu_bar, tearoff=0)
+view_menu.add_checkbutton(label="⏱️ Profiling", variable=profile_var, command=toggle_profiling)
+menu_bar.add_cascade(label="View", menu=view_menu)
+root.config(menu=menu_bar)
+toggle_profiling()
+
 # Bind closing event to cleanup
 root.protocol("WM_DELETE_WINDOW", close_windows)
 
+# Deliver background results on the main loop
+root.after(JOB_POLL_INTERVAL_MS, poll_jobs)
+
 # Start the GUI event loop
 root.mainloop()
\ No newline at end of file
@@ -1,85 +1,698 @@
 from enum import Enum
 import numpy as np
-from numba import jit
 import cv2
+from tools.jobs import check_cancelled
+from tools.buffers import buffer_pool, get_accumulation_dtype
+from tools.compiled import (convolve_2d, convolve_columns, convolve_rows, get_thread_count,
+                            recursive_filter_columns, recursive_filter_rows)
 
 class BlurType(Enum):
     GAUSSIAN = "Gaussian Blur"
     BOX = "Box Blur"
     VERTICAL = "Vertical Blur"
+    RECURSIVE_GAUSSIAN = "Recursive Gaussian Blur"
+
+class ConvolutionMethod(Enum):
+    DIRECT = "Direct"
+    SEPARABLE = "Separable"
+    SUMMED_AREA = "Summed-Area Table"
+    FFT = "FFT"
+    RECURSIVE = "Recursive (IIR)"
 
 BLUR_FUNCTIONS = {
-    BlurType.GAUSSIAN: lambda img, kernel_size, sigma: BlurFilter.gaussian_blur(img, kernel_size, sigma),
-    BlurType.BOX: lambda img, kernel_size, sigma: BlurFilter.box_blur(img, kernel_size),
-    BlurType.VERTICAL: lambda img, kernel_size, sigma: BlurFilter.vertical_blur(img, kernel_size),
+    BlurType.GAUSSIAN: lambda img, kernel_size, sigma, method: BlurFilter.gaussian_blur(img, kernel_size, sigma, method),
+    BlurType.BOX: lambda img, kernel_size, sigma, method: BlurFilter.box_blur(img, kernel_size, method=method),
+    BlurType.VERTICAL: lambda img, kernel_size, sigma, method: BlurFilter.vertical_blur(img, kernel_size, method),
+    BlurType.RECURSIVE_GAUSSIAN: lambda img, kernel_size, sigma, method: BlurFilter.recursive_gaussian_blur(img, sigma),
+}
+
+# Methods each blur can run with; the cost model picks the cheapest one
+BLUR_METHODS = {
+    BlurType.GAUSSIAN: (ConvolutionMethod.SEPARABLE, ConvolutionMethod.FFT),
+    BlurType.BOX: (ConvolutionMethod.SEPARABLE, ConvolutionMethod.SUMMED_AREA, ConvolutionMethod.FFT),
+    BlurType.VERTICAL: (ConvolutionMethod.SEPARABLE, ConvolutionMethod.FFT),
+    BlurType.RECURSIVE_GAUSSIAN: (ConvolutionMethod.RECURSIVE,),
 }
 
-def apply_blur(image: np.ndarray, blur_type: BlurType, kernel_size: int = 5, sigma: int = 5) -> np.ndarray:
+# Relative costs, in units of one multiply-add of the compiled direct kernels.
+# The compiled kernels are spread over all threads; numpy's FFT and cumsum run on one.
+SUMMED_AREA_COST_PER_PIXEL = 20.0
+RECURSIVE_COST_PER_PIXEL = 28.0  # four passes of a third-order recursion
+FFT_COST_PER_ELEMENT = 2.0  # multiplied by log2 of the transform size, forward and inverse together
+
+# Below this sigma the recursive Gaussian is replaced by its sampled kernel, which the recursion cannot match
+RECURSIVE_MIN_SIGMA = 3.0
+
+# Bisection steps that fit the scale of the recursive Gaussian to sigma, far below float64 resolution
+RECURSIVE_SCALE_ITERATIONS = 60
+
+# Added to floating point results before they are truncated to integers, so sums that are exactly integral
+# (e.g. 9 * (x / 9)) do not land just below x; float32 sums of a hundred taps can be off by about 1e-4 near 255
+TRUNCATION_GUARD = {np.dtype(np.float32): 1e-3, np.dtype(np.float64): 1e-6}
+
+def apply_blur(image: np.ndarray, blur_type: BlurType, kernel_size: int = 5, sigma: int = 5,
+               method: ConvolutionMethod = None, return_method: bool = False):
     """
     Apply the specified blur to the image using the dispatch table.
     
-    :param image: Input image in BGR format (height, width, 3).
+    :param image: Input image in BGR format (height, width, 3), or grayscale (height, width).
     :param blur_type: The type of blur to apply.
     :param kernel_size: The size of the kernel to use for the blur.
     :param sigma: The standard deviation for Gaussian blur (if applicable).
-    :return: Image with the specified blur applied.
+    :param method: Convolution method to use, or None to let the cost model choose.
+    :param return_method: Also return the convolution method that was used.
+    :return: Image with the specified blur applied, or a tuple (image, method) if return_method is set.
     """
     
     blur_function = BLUR_FUNCTIONS.get(blur_type)
-    if blur_function:
-        return blur_function(image, kernel_size, sigma)
-    else:
+    if not blur_function:
         raise ValueError(f"Invalid blur type: {blur_type}")
+
+    if method is None:
+        method = select_blur_method(image.shape, blur_type, kernel_size)
+
+    blurred_image = blur_function(image, kernel_size, sigma, method)
+    return (blurred_image, method) if return_method else blurred_image
+
+def select_blur_method(image_shape: tuple, blur_type: BlurType, kernel_size: int) -> ConvolutionMethod:
+    """
+    Pick the cheapest convolution method for a blur according to the cost model.
+    
+    :param image_shape: Shape of the image to blur.
+    :param blur_type: The type of blur.
+    :param kernel_size: The size of the kernel.
+    :return: The convolution method with the lowest estimated cost.
+    """
+    if blur_type not in BLUR_METHODS:
+        raise ValueError(f"Invalid blur type: {blur_type}")
+
+    # The vertical blur only has taps along one column
+    kernel_shape = (kernel_size, 1) if blur_type == BlurType.VERTICAL else (kernel_size, kernel_size)
+    return min(BLUR_METHODS[blur_type], key=lambda method: convolution_cost(image_shape, kernel_shape, method))
+
+def convolution_cost(image_shape: tuple, kernel_shape: tuple, method: ConvolutionMethod) -> float:
+    """
+    Estimate the relative cost of convolving an image with a kernel.
+    
+    :param image_shape: Shape of the image (height, width) or (height, width, channels).
+    :param kernel_shape: Shape of the kernel (kernel_height, kernel_width).
+    :param method: Convolution method.
+    :return: Estimated cost in units of one multiply-add of the compiled direct kernels.
+    """
+    height, width = image_shape[:2]
+    channels = image_shape[2] if len(image_shape) > 2 else 1
+    kernel_height, kernel_width = kernel_shape
+    samples = height * width * channels
+
+    if method == ConvolutionMethod.DIRECT:
+        return samples * kernel_height * kernel_width / get_thread_count()
+    if method == ConvolutionMethod.SEPARABLE:
+        taps = (kernel_height if kernel_height > 1 else 0) + (kernel_width if kernel_width > 1 else 0)
+        return samples * max(taps, 1) / get_thread_count()
+    if method == ConvolutionMethod.SUMMED_AREA:
+        return samples * SUMMED_AREA_COST_PER_PIXEL
+    if method == ConvolutionMethod.RECURSIVE:
+        return samples * RECURSIVE_COST_PER_PIXEL / get_thread_count()
+    if method == ConvolutionMethod.FFT:
+        fft_height = next_fast_length(height + 2 * (kernel_height // 2))
+        fft_width = next_fast_length(width + 2 * (kernel_width // 2))
+        size = fft_height * fft_width
+        return channels * size * FFT_COST_PER_ELEMENT * np.log2(max(size, 2))
+    raise ValueError(f"Invalid convolution method: {method}")
+
+def select_convolution_method(image_shape: tuple, kernel: np.ndarray) -> ConvolutionMethod:
+    """
+    Pick the cheapest method for convolving an image with an arbitrary kernel.
     
+    :param image_shape: Shape of the image to convolve.
+    :param kernel: 2D convolution kernel.
+    :return: The convolution method with the lowest estimated cost.
+    """
+    methods = [ConvolutionMethod.DIRECT, ConvolutionMethod.FFT]
+    if separate_kernel(kernel) is not None:
+        methods.append(ConvolutionMethod.SEPARABLE)
+    return min(methods, key=lambda method: convolution_cost(image_shape, kernel.shape, method))
+
 class BlurFilter:
     @staticmethod
-    def gaussian_blur(image: np.ndarray, kernel_size: int = 5, sigma: int = 5) -> np.ndarray:
+    def gaussian_blur(image: np.ndarray, kernel_size: int = 5, sigma: int = 5,
+                      method: ConvolutionMethod = ConvolutionMethod.SEPARABLE) -> np.ndarray:
         def create_gaussian_kernel(size: int, sigma: int = 1) -> np.ndarray:
             center = (size - 1) / 2
             
-            def gaussian_function(x, y):
-                exponent = -((x - center)**2 + (y - center)**2) / (2 * sigma**2)
-                return (1 / (2 * np.pi * sigma**2)) * np.exp(exponent)
+            def gaussian_function(x):
+                exponent = -((x - center)**2) / (2 * sigma**2)
+                return np.exp(exponent)
             
-            kernel = np.fromfunction(gaussian_function, (size, size))
+            kernel = np.fromfunction(gaussian_function, (size,))
             return kernel / np.sum(kernel)
         
+        # The 2D Gaussian is the outer product of two 1D Gaussians, so blur rows and columns separately
         kernel = create_gaussian_kernel(kernel_size, sigma)
-        return convolution(image, kernel)
+        return convolve_factors(image, kernel, kernel, method)
 
     @staticmethod
-    def box_blur(image: np.ndarray, kernel_size: int = 5) -> np.ndarray:
+    def box_blur(image: np.ndarray, kernel_size: int = 5, passes: int = 1,
+                 method: ConvolutionMethod = ConvolutionMethod.SUMMED_AREA) -> np.ndarray:
         def create_box_kernel(size: int) -> np.ndarray:
-            return np.ones((size, size)) / (size * size)
-        
+            return np.ones(size) / size
+
+        # Window sums come from an integral image, so the cost per pixel does not depend on kernel_size
+        if method == ConvolutionMethod.SUMMED_AREA:
+            return summed_area_box_blur(image, kernel_size, passes)
+
         kernel = create_box_kernel(kernel_size)
-        return convolution(image, kernel)
+        for _ in range(passes):
+            image = convolve_factors(image, kernel, kernel, method)
+        return image
 
     @staticmethod
-    def vertical_blur(image: np.ndarray, kernel_size: int = 5) -> np.ndarray:
+    def approximate_gaussian_blur(image: np.ndarray, sigma: float = 5, passes: int = 3) -> np.ndarray:
+        # Repeated box blurs converge to a Gaussian; a box of width w has variance (w^2 - 1) / 12
+        kernel_size = max(1, int(round(np.sqrt(12 * sigma**2 / passes + 1))))
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+        return summed_area_box_blur(image, kernel_size, passes)
+
+    @staticmethod
+    def recursive_gaussian_blur(image: np.ndarray, sigma: float = 5) -> np.ndarray:
+        # A causal and an anti-causal recursion per row and per column replace the kernel,
+        # so the cost does not depend on sigma
+        return recursive_gaussian(image, sigma)
+
+    @staticmethod
+    def vertical_blur(image: np.ndarray, kernel_size: int = 5,
+                      method: ConvolutionMethod = ConvolutionMethod.SEPARABLE) -> np.ndarray:
         def create_vertical_kernel(size: int) -> np.ndarray:
-            kernel = np.zeros((size, size))
-            kernel[:, size // 2] = 1 / size
-            return kernel
+            return np.ones(size) / size
     
+        # Only the column pass is needed, the row factor would be the identity
         kernel = create_vertical_kernel(kernel_size)
-        return convolution(image, kernel)
+        return convolve_factors(image, kernel, None, method)
+
+def integral_image(image: np.ndarray, dtype=np.int64, out: np.ndarray = None) -> np.ndarray:
+    """
+    Compute the summed-area table of an image.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param dtype: Accumulation dtype.
+    :param out: Optional output buffer of the table shape and dtype.
+    :return: Table (height + 1, width + 1, channels) where entry [y, x] is the sum of image[:y, :x].
+    """
+    shape = (image.shape[0] + 1, image.shape[1] + 1) + image.shape[2:]
+    table = np.empty(shape, dtype=dtype) if out is None else out
+    table[0] = 0
+    table[:, 0] = 0
+    np.cumsum(image, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+def summed_area_box_blur(image: np.ndarray, kernel_size: int = 5, passes: int = 1) -> np.ndarray:
+    """
+    Box blur using an integral image, with the same reflect padding as convolution.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param kernel_size: Width and height of the box.
+    :param passes: Number of box passes; three or more approximate a Gaussian blur.
+    :return: Blurred image with the same shape and dtype as the input.
+    """
+    if passes == 0:
+        return image.copy()
+
+    height, width = image.shape[:2]
+    pad = kernel_size // 2
+    padded_shape = (height + 2 * pad, width + 2 * pad) + image.shape[2:]
+
+    # Integer images are summed exactly and only divided once at the end, as long as the
+    # undivided sums of all passes fit in an int64. The prefix sums may wrap around, but the
+    # window sums taken from them do not, so int32 is enough when the window sums fit in it.
+    area = kernel_size * kernel_size
+    exact = (np.issubdtype(image.dtype, np.integer) and
+             int(np.iinfo(image.dtype).max) * area**passes < np.iinfo(np.int64).max)
+    if exact:
+        fits_int32 = int(np.iinfo(image.dtype).max) * area**passes <= np.iinfo(np.int32).max
+        dtype = np.dtype(np.int32 if fits_int32 else np.int64)
+    else:
+        # The differences of prefix sums over a whole image cancel out too much precision for float32
+        dtype = np.dtype(np.float64)
+
+    padded_image = buffer_pool.take(padded_shape, image.dtype if passes == 1 else dtype)
+    table = buffer_pool.take((padded_shape[0] + 1, padded_shape[1] + 1) + image.shape[2:], dtype)
+    output = buffer_pool.take(image.shape, dtype)
+
+    source = image
+    for _ in range(passes):
+        check_cancelled()
+        # The output of the previous pass is consumed by the padding, so every pass writes the same buffer
+        integral_image(reflect_pad(source, ((pad, pad), (pad, pad)), padded_image), dtype, table)
+        k = kernel_size
+        np.subtract(table[k:k + height, k:k + width], table[:height, k:k + width], out=output)
+        output -= table[k:k + height, :width]
+        output += table[:height, :width]
+        if not exact:
+            output /= area
+        source = output
+
+    if exact:
+        output //= area**passes
+        result = output.astype(image.dtype)
+    else:
+        result = cast_to_image_dtype(output, image.dtype)
+    buffer_pool.release(padded_image, table, output)
+    return result
+
+def young_van_vliet_coefficients(sigma: float) -> tuple:
+    """
+    Compute the coefficients of the Young-van Vliet recursive Gaussian filter.
+
+    The scale q of the filter is found so that the impulse response of the causal and anti-causal passes
+    together has a variance of exactly sigma², as in the later Young, van Vliet and van Ginkel design. The
+    linear fit q(sigma) of the original paper gives responses 20-50% too wide.
+    
+    :param sigma: Standard deviation of the Gaussian (at least 0.5).
+    :return: Tuple (B, a1, a2, a3) for y[n] = B * x[n] + a1 * y[n-1] + a2 * y[n-2] + a3 * y[n-3].
+    """
+    def coefficients(q):
+        b0 = 1.57825 + 2.44413 * q + 1.4281 * q**2 + 0.422205 * q**3
+        b1 = 2.44413 * q + 2.85619 * q**2 + 1.26661 * q**3
+        b2 = -(1.4281 * q**2 + 1.26661 * q**3)
+        b3 = 0.422205 * q**3
+        a1, a2, a3 = b1 / b0, b2 / b0, b3 / b0
+        return 1 - (a1 + a2 + a3), a1, a2, a3
+
+    # The variance grows with q, from 0 at q = 0 to more than sigma² at q = sigma + 1
+    low, high = 0.0, sigma + 1.0
+    for _ in range(RECURSIVE_SCALE_ITERATIONS):
+        q = (low + high) / 2
+        if recursive_variance(*coefficients(q)) < sigma**2:
+            low = q
+        else:
+            high = q
+    return coefficients((low + high) / 2)
+
+def recursive_boundary(B: float, a1: float, a2: float, a3: float) -> np.ndarray:
+    """
+    Get the matrix that starts the anti-causal pass of a third-order recursion at the end of a signal that
+    repeats its last value, from Triggs and Sdika, "Boundary Conditions for Young-van Vliet Recursive Filtering".
+
+    :param B: Input gain of the recursion, 1 - (a1 + a2 + a3).
+    :param a1: Feedback coefficient of the previous output.
+    :param a2: Feedback coefficient of the output two steps back.
+    :param a3: Feedback coefficient of the output three steps back.
+    :return: 3x3 matrix M such that the anti-causal outputs at the last sample and the two past it are
+             edge + M @ (causal outputs at the last three samples, last first - edge).
+    """
+    scale = B / ((1 + a1 - a2 + a3) * (1 - a1 - a2 - a3) * (1 + a2 + (a1 - a3) * a3))
+    return scale * np.array([
+        [1 - a2 - a1 * a3 - a3**2, (a1 + a3) * (a2 + a1 * a3), a3 * (a1 + a2 * a3)],
+        [a1 + a2 * a3, (1 - a2) * (a2 + a1 * a3), a3 * (1 - a2 - a1 * a3 - a3**2)],
+        [a1**2 + a2 - a2**2 + a1 * a3, a3 + a1 * a2 - a2 * a3 + a2**2 * a3 - a1 * a3**2 - a3**3, a3 * (a1 + a2 * a3)],
+    ])
+
+def recursive_variance(B: float, a1: float, a2: float, a3: float) -> float:
+    """
+    Get the variance of the impulse response of a causal and an anti-causal pass of a third-order recursion.
+
+    With D(w) = 1 - a1 w - a2 w² - a3 w³, the causal response has the generating function B / D(w), from whose
+    derivatives at w = 1 the mean and variance follow; the anti-causal pass doubles the variance.
+
+    :param B: Input gain of the recursion, 1 - (a1 + a2 + a3) for a unit DC gain.
+    :param a1: Feedback coefficient of the previous output.
+    :param a2: Feedback coefficient of the output two steps back.
+    :param a3: Feedback coefficient of the output three steps back.
+    :return: Variance in squared samples.
+    """
+    slope = -(a1 + 2 * a2 + 3 * a3)  # D'(1)
+    curvature = -(2 * a2 + 6 * a3)  # D''(1)
+    mean = -slope / B
+    factorial_moment = 2 * slope**2 / B**2 - curvature / B  # sum of n (n - 1) h[n]
+    return 2 * (factorial_moment + mean - mean**2)
+
+def sampled_gaussian(image: np.ndarray, sigma: float) -> np.ndarray:
+    """
+    Gaussian blur with a sampled kernel reaching 4 sigmas, with edges extended by replication like the
+    recursive Gaussian.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param sigma: Standard deviation of the Gaussian.
+    :return: Blurred image with the same shape and dtype as the input.
+    """
+    radius = int(np.ceil(4 * sigma))
+    dtype = get_accumulation_dtype()
+    kernel = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma**2))
+    kernel = (kernel / kernel.sum()).astype(dtype)
+    height, width = image.shape[:2]
+    channels = image.shape[2:]
+
+    padded_image = edge_pad(image, radius, buffer_pool.take((height + 2 * radius, width + 2 * radius) + channels,
+                                                            image.dtype))
+    columns = buffer_pool.take((height, width + 2 * radius) + channels, dtype)
+    convolve_columns(with_channel_axis(padded_image), kernel, with_channel_axis(columns))
+    rows = buffer_pool.take(image.shape, dtype)
+    convolve_rows(with_channel_axis(columns), kernel, with_channel_axis(rows))
+
+    result = cast_to_image_dtype(rows, image.dtype)
+    buffer_pool.release(padded_image, columns, rows)
+    return result
+
+def recursive_gaussian(image: np.ndarray, sigma: float = 5) -> np.ndarray:
+    """
+    Gaussian blur approximated by a recursive (IIR) filter, with a cost independent of sigma.
+    Below RECURSIVE_MIN_SIGMA the short sampled kernel is applied instead.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param sigma: Standard deviation of the Gaussian; values below 0.5 leave the image unchanged.
+    :return: Blurred image with the same shape and dtype as the input. Edges are extended by replication.
+    """
+    if sigma < 0.5:
+        return image.copy()
+    if sigma < RECURSIVE_MIN_SIGMA:
+        # Three poles cannot follow the shape of a narrow Gaussian, whose sampled kernel is short anyway
+        return sampled_gaussian(image, sigma)
+
+    coefficients = young_van_vliet_coefficients(sigma)
+    boundary = recursive_boundary(*coefficients)
+    height, width = image.shape[:2]
+
+    # The recursion feeds its rounded outputs back, so in float32 the result would depend on where it
+    # started, e.g. on the strip boundaries of a tiled pipeline; its state is kept in float64
+    output = buffer_pool.take(image.shape, np.float64)
+    np.copyto(output, image)
+    recursive_filter_columns(output.reshape(height, -1), *coefficients, boundary)
+    check_cancelled()
+    recursive_filter_rows(output.reshape(height, width, -1), *coefficients, boundary)
+
+    result = cast_to_image_dtype(output, image.dtype)
+    buffer_pool.release(output)
+    return result
 
-def convolution(image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
-    image_height, image_width, channels = image.shape
+def separate_kernel(kernel: np.ndarray, tolerance: float = 1e-10):
+    """
+    Split a rank-1 2D kernel into its column and row factors.
+    
+    :param kernel: 2D convolution kernel (kernel_height, kernel_width).
+    :param tolerance: Largest ratio between the second and first singular value still treated as rank-1.
+    :return: Tuple (column_kernel, row_kernel), or None if the kernel is not separable.
+             A factor is None when it is the identity (a unit impulse at the kernel center).
+    """
+    U, S, Vt = np.linalg.svd(kernel)
+    if S[0] == 0 or (len(S) > 1 and S[1] > tolerance * S[0]):
+        return None
+
+    column_kernel = U[:, 0] * S[0]
+    row_kernel = Vt[0]
+
+    # Move the scale into the column factor so the row factor peaks at exactly 1
+    peak = row_kernel[np.argmax(np.abs(row_kernel))]
+    column_kernel = column_kernel * peak
+    row_kernel = row_kernel / peak
+
+    def is_identity(factor: np.ndarray) -> bool:
+        impulse = np.zeros_like(factor)
+        impulse[len(factor) // 2] = 1
+        return np.allclose(factor, impulse, rtol=0, atol=tolerance)
+
+    return (None if is_identity(column_kernel) else column_kernel,
+            None if is_identity(row_kernel) else row_kernel)
+
+def reflect_pad(image: np.ndarray, pad_width: tuple, out: np.ndarray = None) -> np.ndarray:
+    """
+    Pad the rows and columns of an image like np.pad(mode='reflect'), optionally into an existing buffer.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param pad_width: ((top, bottom), (left, right)) numbers of rows and columns to add.
+    :param out: Optional output buffer of the padded shape; its dtype may differ from the image.
+    :return: Padded image.
+    """
+    (top, bottom), (left, right) = pad_width
+    height, width = image.shape[:2]
+    if out is None:
+        out = np.empty((height + top + bottom, width + left + right) + image.shape[2:], dtype=image.dtype)
+
+    if max(top, bottom) >= height or max(left, right) >= width:
+        # Pads longer than the image reflect more than once, which np.pad handles
+        np.copyto(out, np.pad(image, tuple(pad_width) + ((0, 0),) * (image.ndim - 2), mode='reflect'))
+        return out
+
+    out[top:top + height, left:left + width] = image
+
+    # The rows are reflected first and the columns over the padded rows, so the corners match np.pad
+    center = slice(left, left + width)
+    if top:
+        out[:top, center] = out[2 * top:top:-1, center]
+    if bottom:
+        stop = top + height - 2 - bottom
+        out[top + height:, center] = out[top + height - 2:stop if stop >= 0 else None:-1, center]
+    if left:
+        out[:, :left] = out[:, 2 * left:left:-1]
+    if right:
+        stop = left + width - 2 - right
+        out[:, left + width:] = out[:, left + width - 2:stop if stop >= 0 else None:-1]
+    return out
+
+def edge_pad(image: np.ndarray, pad: int, out: np.ndarray) -> np.ndarray:
+    """
+    Pad the rows and columns of an image like np.pad(mode='edge'), into an existing buffer.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param pad: Number of rows and columns added on every side, at least 1.
+    :param out: Output buffer (height + 2 * pad, width + 2 * pad, ...); its dtype may differ from the image.
+    :return: The output buffer.
+    """
+    height, width = image.shape[:2]
+    out[pad:pad + height, pad:pad + width] = image
+    out[:pad, pad:pad + width] = image[:1]
+    out[pad + height:, pad:pad + width] = image[-1:]
+    out[:, :pad] = out[:, pad:pad + 1]
+    out[:, pad + width:] = out[:, pad + width - 1:pad + width]
+    return out
+
+def convolve_axis(image: np.ndarray, kernel: np.ndarray, axis: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Convolve an image with a 1D kernel along a single axis using reflect padding.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param kernel: 1D kernel.
+    :param axis: Axis to convolve along (0 for columns, 1 for rows).
+    :param out: Optional output buffer with the shape of the image and the accumulation dtype.
+    :return: Result in the accumulation dtype (see buffers.accumulation_dtype) with the same shape as the image.
+    """
+    check_cancelled()
+    pad = len(kernel) // 2
+    dtype = get_accumulation_dtype()
+
+    pad_width = ((pad, pad), (0, 0)) if axis == 0 else ((0, 0), (pad, pad))
+    padded_shape = (image.shape[0] + 2 * pad * (axis == 0), image.shape[1] + 2 * pad * (axis == 1)) + image.shape[2:]
+    padded_image = reflect_pad(image, pad_width, buffer_pool.take(padded_shape, image.dtype))
+
+    output = np.empty(image.shape, dtype=dtype) if out is None else out
+    convolve_1d = convolve_columns if axis == 0 else convolve_rows
+    convolve_1d(with_channel_axis(padded_image), np.asarray(kernel, dtype=dtype), with_channel_axis(output))
+
+    buffer_pool.release(padded_image)
+    return output
+
+def with_channel_axis(image: np.ndarray) -> np.ndarray:
+    """
+    View a grayscale image (height, width) as a single-channel image (height, width, 1) for the compiled kernels.
+
+    :param image: Image with or without a channel axis.
+    :return: The image, or a view of it with a channel axis added; writes through the view reach the image.
+    """
+    return image if image.ndim == 3 else image[:, :, np.newaxis]
+
+def cast_to_image_dtype(output: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    """
+    Convert a floating point convolution result back to the dtype of the input image.
+    
+    :param output: Floating point result; used as scratch space.
+    :param dtype: Target dtype.
+    :return: New array with the result converted to the target dtype.
+    """
+    if np.issubdtype(dtype, np.integer):
+        # Integer results are truncated like the direct loop, after adding the guard
+        info = np.iinfo(dtype)
+        np.add(output, TRUNCATION_GUARD.get(output.dtype, 1e-6), out=output)
+        np.clip(output, info.min, info.max, out=output)
+    return output.astype(dtype, order="C")
+
+def separable_convolution(image: np.ndarray, column_kernel, row_kernel) -> np.ndarray:
+    """
+    Convolve an image with the separable kernel outer(column_kernel, row_kernel) as two 1D passes.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param column_kernel: 1D kernel applied down the columns, or None to skip the pass.
+    :param row_kernel: 1D kernel applied along the rows, or None to skip the pass.
+    :return: Convolved image with the same shape and dtype as the input.
+    """
+    if column_kernel is None and row_kernel is None:
+        return image.copy()
+
+    # Both passes write pooled buffers, so repeated blurs of same-sized images allocate only their result
+    dtype = get_accumulation_dtype()
+    columns = rows = None
+    output = image
+    if column_kernel is not None:
+        output = columns = convolve_axis(output, column_kernel, axis=0, out=buffer_pool.take(image.shape, dtype))
+    if row_kernel is not None:
+        output = rows = convolve_axis(output, row_kernel, axis=1, out=buffer_pool.take(image.shape, dtype))
+
+    result = cast_to_image_dtype(output, image.dtype)
+    buffer_pool.release(columns, rows)
+    return result
+
+def convolve_factors(image: np.ndarray, column_kernel, row_kernel,
+                     method: ConvolutionMethod = ConvolutionMethod.SEPARABLE) -> np.ndarray:
+    """
+    Convolve an image with a kernel given by its column and row factors.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param column_kernel: 1D kernel applied down the columns, or None for the identity.
+    :param row_kernel: 1D kernel applied along the rows, or None for the identity.
+    :param method: Convolution method; SEPARABLE runs the factors as 1D passes, the others use the full 2D kernel.
+    :return: Convolved image with the same shape and dtype as the input.
+    """
+    if method == ConvolutionMethod.SEPARABLE:
+        return separable_convolution(image, column_kernel, row_kernel)
+
+    column_kernel = np.ones(1) if column_kernel is None else column_kernel
+    row_kernel = np.ones(1) if row_kernel is None else row_kernel
+    return convolution(image, np.outer(column_kernel, row_kernel), method)
+
+def next_fast_length(n: int) -> int:
+    """
+    Find the smallest length >= n whose only prime factors are 2, 3 and 5, which numpy's FFT handles fastest.
+    
+    :param n: Minimum length.
+    :return: Fast FFT length.
+    """
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    power_of_5 = 1
+    while power_of_5 < best:
+        power_of_3 = power_of_5
+        while power_of_3 < best:
+            # Smallest power of two that brings the product up to n
+            length = power_of_3
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            power_of_3 *= 3
+        power_of_5 *= 5
+    return best
+
+def fft_columns(spectrum: np.ndarray, transform) -> np.ndarray:
+    """
+    Transform the columns of the planes of a spectrum, counting the arrays it allocates in the pool's allocations.
+
+    :param spectrum: Complex planes (..., height, width).
+    :param transform: np.fft.fft or np.fft.ifft.
+    :return: Transformed spectrum, C-contiguous.
+    """
+    spectrum = transform(spectrum, axis=-2)
+    buffer_pool.count_allocation(spectrum)
+    # numpy < 2 returns a transform along another axis than the last one as a transposed view,
+    # which the following row transform would copy without it being counted
+    if not spectrum.flags.c_contiguous:
+        spectrum = np.ascontiguousarray(spectrum)
+        buffer_pool.count_allocation(spectrum)
+    return spectrum
+
+def fft_convolution(image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Convolve an image with a 2D kernel in the frequency domain, using the same reflect padding as convolution.
+    
+    :param image: Input image (height, width, channels) or (height, width).
+    :param kernel: 2D convolution kernel (kernel_height, kernel_width).
+    :return: Convolved image with the same shape and dtype as the input.
+    """
+    image_height, image_width = image.shape[:2]
     kernel_height, kernel_width = kernel.shape
+    channels = image.shape[2:]
 
+    # The transforms stay in float64 whatever the accumulation dtype: their rounding depends on the
+    # transform size, so in float32 the strips of a tiled pipeline would round differently from the whole image
     pad_height = kernel_height // 2
     pad_width = kernel_width // 2
+    padded_height = image_height + 2 * pad_height
+    padded_width = image_width + 2 * pad_width
+
+    # The padding already holds every sample the kernel reaches, so the circular wrap-around
+    # of a transform as large as the padded image never reaches the pixels we keep
+    fft_height, fft_width = next_fast_length(padded_height), next_fast_length(padded_width)
 
-    output = np.zeros_like(image)
+    # convolution() correlates (region * kernel), which is a true convolution with the flipped kernel
+    with buffer_pool.scratch((fft_height, fft_width), np.float64) as kernel_plane:
+        kernel_plane.fill(0)
+        kernel_plane[:kernel_height, :kernel_width] = kernel[::-1, ::-1]
+        kernel_spectrum = np.fft.rfft(kernel_plane, axis=-1)
+    buffer_pool.count_allocation(kernel_spectrum)
+    kernel_spectrum = fft_columns(kernel_spectrum, np.fft.fft)
+
+    # The channels are transformed as separate planes, so every transform runs along contiguous rows
+    # and numpy allocates nothing but its result, which is counted in the pool's allocations.
+    # The planes are padded to the transform size here rather than by numpy.
+    planes = buffer_pool.take(channels + (fft_height, fft_width), np.float64)
+    padded_image = np.moveaxis(planes, 0, -1) if channels else planes
+    reflect_pad(image, ((pad_height, pad_height), (pad_width, pad_width)),
+                padded_image[:padded_height, :padded_width])
+    padded_image[padded_height:] = 0
+    padded_image[:padded_height, padded_width:] = 0
+    spectrum = np.fft.rfft(planes, axis=-1)
+    buffer_pool.release(planes)
+    buffer_pool.count_allocation(spectrum)
+    spectrum = fft_columns(spectrum, np.fft.fft)
+
+    spectrum *= kernel_spectrum
+    del kernel_spectrum
+    check_cancelled()
+    spectrum = fft_columns(spectrum, np.fft.ifft)
+    output = np.fft.irfft(spectrum, n=fft_width, axis=-1)
+    buffer_pool.count_allocation(output)
+    del spectrum
+
+    output = output[..., kernel_height - 1:kernel_height - 1 + image_height, kernel_width - 1:kernel_width - 1 + image_width]
+    if channels:
+        output = np.moveaxis(output, 0, -1)
+    return cast_to_image_dtype(output, image.dtype)
+
+def convolution(image: np.ndarray, kernel: np.ndarray, method: ConvolutionMethod = None) -> np.ndarray:
+    """
+    Convolve an image with a 2D kernel using reflect padding.
     
-    for c in range(channels):
-        padded_image = np.pad(image[:, :, c], ((pad_height, pad_height), (pad_width, pad_width)), mode='reflect')
-        
-        for i in range(image_height):
-            for j in range(image_width):
-                region = padded_image[i:i+kernel_height, j:j+kernel_width]
-                output[i, j, c] = np.sum(region * kernel)
-        
-    return output
\ No newline at end of file
+    :param image: Input image (height, width, channels) or (height, width).
+    :param kernel: 2D convolution kernel (kernel_height, kernel_width).
+    :param method: Convolution method to use, or None to let the cost model choose.
+    :return: Convolved image with the same shape and dtype as the input.
+    """
+    if method is None:
+        method = select_convolution_method(image.shape, kernel)
+
+    # Rank-1 kernels are much cheaper to apply as a column pass followed by a row pass
+    if method == ConvolutionMethod.SEPARABLE:
+        factors = separate_kernel(kernel)
+        if factors is None:
+            raise ValueError("Kernel is not separable")
+        return separable_convolution(image, *factors)
+
+    if method == ConvolutionMethod.FFT:
+        return fft_convolution(image, kernel)
+
+    if method != ConvolutionMethod.DIRECT:
+        raise ValueError(f"Invalid convolution method: {method}")
+
+    check_cancelled()
+    kernel_height, kernel_width = kernel.shape
+
+    pad_height = kernel_height // 2
+    pad_width = kernel_width // 2
+    dtype = get_accumulation_dtype()
+
+    padded_shape = (image.shape[0] + 2 * pad_height, image.shape[1] + 2 * pad_width) + image.shape[2:]
+    padded_image = reflect_pad(image, ((pad_height, pad_height), (pad_width, pad_width)),
+                               buffer_pool.take(padded_shape, image.dtype))
+    output = buffer_pool.take(image.shape, dtype)
+    convolve_2d(with_channel_axis(padded_image), np.asarray(kernel, dtype=dtype), with_channel_axis(output))
+
+    result = cast_to_image_dtype(output, image.dtype)
+    buffer_pool.release(padded_image, output)
+    return result
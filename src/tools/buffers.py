@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import numpy as np
+
+# Images enter and leave the tools as uint8; arithmetic in between works on this type
+WORK_DTYPE = np.float32
+
+# Released scratch buffers kept for reuse; beyond this the least recently released are freed
+POOL_BUDGET_BYTES = 256 * 1024 * 1024
+
+_accumulation_dtype = ContextVar("accumulation_dtype", default=np.dtype(WORK_DTYPE))
+
+@contextmanager
+def accumulation_dtype(dtype):
+    """
+    Accumulate the convolutions and recursive filters called in this block in another floating point type.
+
+    float32 halves the memory of the intermediate images; float64 gives results that no longer depend
+    on the rounding of intermediate sums, e.g. to compare with a reference implementation.
+
+    :param dtype: np.float32 or np.float64.
+    """
+    token = _accumulation_dtype.set(np.dtype(dtype))
+    try:
+        yield
+    finally:
+        _accumulation_dtype.reset(token)
+
+def get_accumulation_dtype() -> np.dtype:
+    """Get the floating point type the convolutions accumulate in, WORK_DTYPE unless set by accumulation_dtype()."""
+    return _accumulation_dtype.get()
+
+class BufferPool:
+    """
+    Reuses scratch arrays of the same shape and type across calls, so a tool called on image after image
+    (a batch, the strips of a tiled pipeline, repeated GUI renders) stops allocating and freeing its
+    full-size temporaries every time.
+
+    Only arrays that never leave the function using them should be taken from the pool: a released
+    array is handed to the next caller asking for the same shape and type, with stale contents.
+
+    Usage:
+        scratch = buffer_pool.take(image.shape, np.float32)
+        try:
+            np.multiply(image, 0.5, out=scratch)
+            ...
+        finally:
+            buffer_pool.release(scratch)
+    """
+
+    def __init__(self, budget_bytes: int = POOL_BUDGET_BYTES):
+        """
+        :param budget_bytes: Maximum memory of the released arrays kept for reuse.
+        """
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self.reused = 0
+        self.allocated = 0
+        self._free = OrderedDict()  # (shape, dtype) -> released arrays, least recently released first
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+
+    def take(self, shape: tuple, dtype) -> np.ndarray:
+        """
+        Get an uninitialized array, reusing a released one of the same shape and type if there is one.
+
+        :param shape: Shape of the array.
+        :param dtype: Type of the array.
+        :return: Writable C-contiguous array.
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            arrays = self._free.get(key)
+            if arrays:
+                array = arrays.pop()
+                if not arrays:
+                    del self._free[key]
+                self.nbytes -= array.nbytes
+                self.reused += 1
+                return array
+            self.allocated += 1
+        array = np.empty(key[0], dtype=key[1])
+        self.count_allocation(array)
+        return array
+
+    def count_allocation(self, *arrays):
+        """
+        Count arrays allocated outside the pool in allocated_by_thread, e.g. np.fft results, which cannot
+        be written into a given buffer.
+
+        :param arrays: Newly allocated arrays.
+        """
+        self._thread.allocated = self.allocated_by_thread() + len(arrays)
+        self._thread.allocated_bytes = self.allocated_bytes_by_thread() + sum(array.nbytes for array in arrays)
+
+    def release(self, *arrays):
+        """
+        Give arrays from take back to the pool; they must not be used afterwards.
+
+        :param arrays: Arrays to release; None is ignored.
+        """
+        with self._lock:
+            for array in arrays:
+                if array is None or array.nbytes > self.budget_bytes:
+                    continue
+                key = (array.shape, array.dtype)
+                self._free.setdefault(key, []).append(array)
+                self._free.move_to_end(key)
+                self.nbytes += array.nbytes
+
+            while self.nbytes > self.budget_bytes:
+                key, released = next(iter(self._free.items()))
+                self.nbytes -= released.pop(0).nbytes
+                if not released:
+                    del self._free[key]
+
+    @contextmanager
+    def scratch(self, shape: tuple, dtype):
+        """Take an array for the duration of a with block, and release it at the end."""
+        array = self.take(shape, dtype)
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def clear(self):
+        """Free every released array."""
+        with self._lock:
+            self._free.clear()
+            self.nbytes = 0
+
+    def allocated_by_thread(self) -> int:
+        """
+        Get the number of arrays take had to allocate in the calling thread, e.g. for one of several parallel
+        strips, and the ones counted with count_allocation.
+        """
+        return getattr(self._thread, "allocated", 0)
+
+    def allocated_bytes_by_thread(self) -> int:
+        """Get the memory of the arrays counted by allocated_by_thread."""
+        return getattr(self._thread, "allocated_bytes", 0)
+
+    def stats(self) -> dict:
+        """Get the number of arrays reused and allocated by take, and the memory held for reuse."""
+        with self._lock:
+            return {"reused": self.reused, "allocated": self.allocated, "nbytes": self.nbytes}
+
+# Pool shared by the tools; every process of a batch has its own
+buffer_pool = BufferPool()
@@ -0,0 +1,271 @@
+import types
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import numpy as np
+import numba
+from numba import njit, prange
+
+# Every kernel is compiled in nopython mode and cached on disk next to this module,
+# so the compile cost is only paid on the first run after installation.
+
+_single_threaded = ContextVar("single_threaded", default=False)
+
+@contextmanager
+def single_threaded():
+    """
+    Run the kernels called in this block on the calling thread only, without holding the GIL.
+
+    Used by code that already runs kernels on several threads at once (e.g. tiles on a thread pool),
+    where nested parallel loops would oversubscribe the cores.
+    """
+    token = _single_threaded.set(True)
+    try:
+        yield
+    finally:
+        _single_threaded.reset(token)
+
+def kernel(function):
+    """
+    Compile a kernel twice: with its prange loops spread over the cores, and as a serial loop that
+    releases the GIL for single_threaded() callers.
+    """
+    parallel = njit(parallel=True, cache=True)(function)
+
+    # The on-disk cache is keyed by the function name, so the serial copy gets a name of its own
+    serial_function = types.FunctionType(function.__code__, function.__globals__, function.__name__,
+                                         function.__defaults__, function.__closure__)
+    serial_function.__qualname__ = function.__qualname__ + "_serial"
+    serial = njit(nogil=True, cache=True)(serial_function)
+
+    @wraps(function)
+    def dispatch(*args):
+        if _single_threaded.get():
+            return serial(*args)
+        return parallel(*args)
+
+    dispatch.parallel = parallel
+    dispatch.serial = serial
+    return dispatch
+
+def get_thread_count() -> int:
+    """
+    Get the number of threads the compiled kernels run on.
+
+    :return: Number of threads used by prange loops (set with the NUMBA_NUM_THREADS environment variable).
+    """
+    return numba.get_num_threads()
+
+def set_thread_count(count: int):
+    """
+    Set the number of threads the compiled kernels run on in this process.
+
+    :param count: Number of threads, at most the NUMBA_NUM_THREADS the process started with.
+    """
+    numba.set_num_threads(min(count, numba.config.NUMBA_NUM_THREADS))
+
+@kernel
+def convolve_2d(padded_image, kernel, output):
+    """
+    Direct 2D convolution of a reflect-padded image.
+
+    :param padded_image: Padded input (height + kernel_height - 1, width + kernel_width - 1, channels).
+    :param kernel: 2D kernel (kernel_height, kernel_width).
+    :param output: Float output buffer (height, width, channels), written in place.
+    """
+    height, width, channels = output.shape
+    kernel_height, kernel_width = kernel.shape
+
+    # Rows and channels are independent, so they are spread over the threads together
+    for index in prange(height * channels):
+        i = index // channels
+        c = index % channels
+        for j in range(width):
+            total = 0.0
+            for u in range(kernel_height):
+                for v in range(kernel_width):
+                    total += padded_image[i + u, j + v, c] * kernel[u, v]
+            output[i, j, c] = total
+
+@kernel
+def convolve_columns(padded_image, kernel, output):
+    """
+    1D convolution down the columns of an image padded along axis 0.
+
+    :param padded_image: Padded input (height + len(kernel) - 1, width, channels).
+    :param kernel: 1D kernel.
+    :param output: Float output buffer (height, width, channels), written in place.
+    """
+    height, width, channels = output.shape
+
+    # Each output row is accumulated from whole padded rows, which keeps memory access contiguous
+    for i in prange(height):
+        for j in range(width):
+            for c in range(channels):
+                output[i, j, c] = 0.0
+        for k in range(kernel.shape[0]):
+            weight = kernel[k]
+            for j in range(width):
+                for c in range(channels):
+                    output[i, j, c] += padded_image[i + k, j, c] * weight
+
+@kernel
+def convolve_rows(padded_image, kernel, output):
+    """
+    1D convolution along the rows of an image padded along axis 1.
+
+    :param padded_image: Padded input (height, width + len(kernel) - 1, channels).
+    :param kernel: 1D kernel.
+    :param output: Float output buffer (height, width, channels), written in place.
+    """
+    height, width, channels = output.shape
+
+    for i in prange(height):
+        for j in range(width):
+            for c in range(channels):
+                total = 0.0
+                for k in range(kernel.shape[0]):
+                    total += padded_image[i, j + k, c] * kernel[k]
+                output[i, j, c] = total
+
+@njit(nogil=True, cache=True)
+def anticausal_start(u1, u2, u3, edge, boundary):
+    """
+    Get the outputs of the anti-causal pass at the last sample and the two past it, for an input that
+    repeats its last value forever (Triggs and Sdika).
+
+    :param u1: Causal output at the last sample.
+    :param u2: Causal output one sample before.
+    :param u3: Causal output two samples before.
+    :param edge: Last input value.
+    :param boundary: 3x3 matrix from recursive_boundary.
+    :return: Tuple of the three outputs, last sample first.
+    """
+    d1 = u1 - edge
+    d2 = u2 - edge
+    d3 = u3 - edge
+    return (boundary[0, 0] * d1 + boundary[0, 1] * d2 + boundary[0, 2] * d3 + edge,
+            boundary[1, 0] * d1 + boundary[1, 1] * d2 + boundary[1, 2] * d3 + edge,
+            boundary[2, 0] * d1 + boundary[2, 1] * d2 + boundary[2, 2] * d3 + edge)
+
+@kernel
+def recursive_filter_columns(data, B, a1, a2, a3, boundary):
+    """
+    Third-order recursive filter down the columns of a 2D array, causal then anti-causal, in place.
+    The columns are extended by replicating their first and last values.
+
+    :param data: Float array (length, count); every column is filtered independently.
+    :param B: Input gain of the recursion.
+    :param a1: Feedback coefficient of the previous output.
+    :param a2: Feedback coefficient of the output two steps back.
+    :param a3: Feedback coefficient of the output three steps back.
+    :param boundary: 3x3 matrix that starts the anti-causal pass, from recursive_boundary.
+    """
+    length, count = data.shape
+    block_size = 256
+
+    # Columns are processed in blocks so every step of the recursion reads whole rows
+    for block in prange((count + block_size - 1) // block_size):
+        start = block * block_size
+        stop = min(start + block_size, count)
+        first = data[0, start:stop].copy()
+        last = data[length - 1, start:stop].copy()
+
+        # Before the signal the causal outputs are the first value (the steady state)
+        for i in range(length):
+            for m in range(start, stop):
+                y1 = data[i - 1, m] if i >= 1 else first[m - start]
+                y2 = data[i - 2, m] if i >= 2 else first[m - start]
+                y3 = data[i - 3, m] if i >= 3 else first[m - start]
+                data[i, m] = B * data[i, m] + a1 * y1 + a2 * y2 + a3 * y3
+
+        # The anti-causal pass starts from its exact outputs at and past the end
+        tail = np.empty((2, stop - start))
+        for m in range(start, stop):
+            u2 = data[length - 2, m] if length >= 2 else first[m - start]
+            u3 = data[length - 3, m] if length >= 3 else first[m - start]
+            data[length - 1, m], tail[0, m - start], tail[1, m - start] = anticausal_start(
+                data[length - 1, m], u2, u3, last[m - start], boundary)
+
+        for i in range(length - 2, -1, -1):
+            for m in range(start, stop):
+                y2 = data[i + 2, m] if i + 2 < length else tail[i + 2 - length, m - start]
+                y3 = data[i + 3, m] if i + 3 < length else tail[i + 3 - length, m - start]
+                data[i, m] = B * data[i, m] + a1 * data[i + 1, m] + a2 * y2 + a3 * y3
+
+@kernel
+def recursive_filter_rows(data, B, a1, a2, a3, boundary):
+    """
+    Third-order recursive filter along the rows of an image, causal then anti-causal, in place.
+    The rows are extended by replicating their first and last pixels.
+
+    :param data: Float array (height, width, channels).
+    :param B: Input gain of the recursion.
+    :param a1: Feedback coefficient of the previous output.
+    :param a2: Feedback coefficient of the output two steps back.
+    :param a3: Feedback coefficient of the output three steps back.
+    :param boundary: 3x3 matrix that starts the anti-causal pass, from recursive_boundary.
+    """
+    height, width, channels = data.shape
+
+    for i in prange(height):
+        first = data[i, 0].copy()
+        last = data[i, width - 1].copy()
+        for j in range(width):
+            for c in range(channels):
+                y1 = data[i, j - 1, c] if j >= 1 else first[c]
+                y2 = data[i, j - 2, c] if j >= 2 else first[c]
+                y3 = data[i, j - 3, c] if j >= 3 else first[c]
+                data[i, j, c] = B * data[i, j, c] + a1 * y1 + a2 * y2 + a3 * y3
+
+        tail = np.empty((2, channels))
+        for c in range(channels):
+            u2 = data[i, width - 2, c] if width >= 2 else first[c]
+            u3 = data[i, width - 3, c] if width >= 3 else first[c]
+            data[i, width - 1, c], tail[0, c], tail[1, c] = anticausal_start(
+                data[i, width - 1, c], u2, u3, last[c], boundary)
+
+        for j in range(width - 2, -1, -1):
+            for c in range(channels):
+                y2 = data[i, j + 2, c] if j + 2 < width else tail[j + 2 - width, c]
+                y3 = data[i, j + 3, c] if j + 3 < width else tail[j + 3 - width, c]
+                data[i, j, c] = B * data[i, j, c] + a1 * data[i, j + 1, c] + a2 * y2 + a3 * y3
+
+@kernel
+def fused_pointwise(image, grayscale, lut, mask, mask_scale, lut_after_mask, output):
+    """
+    Grayscale conversion, per-channel lookup tables and a shape mask applied in a single pass.
+
+    :param image: uint8 input (height, width, channels) with 1 or 3 channels.
+    :param grayscale: Convert BGR input to grayscale first, with the fixed-point weights of rgb_to_grayscale.
+    :param lut: uint8 lookup tables (3, 256) applied before the mask.
+    :param mask: uint8 mask (height, width); ignored when mask_scale is 0.
+    :param mask_scale: Mask value that keeps a pixel unchanged: 1 for hard masks, 255 for coverage masks,
+                       or 0 for no mask.
+    :param lut_after_mask: uint8 lookup tables (3, 256) applied after the mask.
+    :param output: uint8 output buffer (height, width, 3), or (height, width, 1) when the grayscale values go
+                   through tables that are the same for every channel; written in place.
+    """
+    height, width, channels = image.shape
+    output_channels = output.shape[2]
+    half_scale = mask_scale // 2
+
+    for i in prange(height):
+        for j in range(width):
+            if grayscale and channels == 3:
+                # (29 B + 150 G + 77 R) / 256, rounded
+                gray = (np.int32(image[i, j, 0]) * 29 + np.int32(image[i, j, 1]) * 150
+                        + np.int32(image[i, j, 2]) * 77 + 128) >> 8
+
+            for c in range(output_channels):
+                if grayscale and channels == 3:
+                    v = lut[c, gray]
+                elif channels == 1:
+                    v = lut[c, image[i, j, 0]]
+                else:
+                    v = lut[c, image[i, j, c]]
+
+                if mask_scale > 0:
+                    # Same rounding as reshape.apply_mask
+                    v = lut_after_mask[c, (np.int32(v) * mask[i, j] + half_scale) // mask_scale]
+                output[i, j, c] = v
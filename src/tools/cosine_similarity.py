@@ -1,57 +1,97 @@
 import numpy as np
 
+# Number of elements converted to float64 at a time, so huge images never need a full floating-point copy
+CHUNK_SIZE = 1 << 20
+
+# Memory for the float64 blocks of the image sets compared by cosine_similarity_matrix
+MATRIX_CHUNK_BYTES = 64 * 1024 * 1024
+
 def dot_product(v1: np.ndarray, v2: np.ndarray) -> float:
     """Calculate the dot product of two vectors."""
-    result = 0.0
-    for a, b in zip(v1, v2):
-        result += a * b
-    return result
+    return float(np.dot(np.asarray(v1, dtype=np.float64), np.asarray(v2, dtype=np.float64)))
 
 def magnitude(v: np.ndarray) -> float:
     """Calculate the magnitude of a vector."""
-    sum_squares = 0.0
-    for x in v:
-        sum_squares += x ** 2
-    return sum_squares ** 0.5
+    return dot_product(v, v) ** 0.5
 
 def resize_vector(v: np.ndarray, new_size: int) -> np.ndarray:
     """Resize a vector to a new size by repeating elements if necessary."""
     if len(v) >= new_size:
         return v[:new_size]
-    else:
-        # Repeat elements to fill the new size
-        resized = np.empty(new_size, dtype=v.dtype)
-        for i in range(new_size):
-            resized[i] = v[i % len(v)]
-        return resized
-
-def cosine_similarity(v1: np.ndarray, v2: np.ndarray) -> float:
+    # Repeat elements to fill the new size
+    return np.resize(v, new_size)
+
+def cosine_similarity(v1: np.ndarray, v2: np.ndarray, chunk_size: int = CHUNK_SIZE) -> float:
     """
     Compute the cosine similarity between two images by flattening them into vectors.
 
-    :param v1: First image (RGB).
-    :param v2: Second image (RGB).
+    :param v1: First image (RGB), or grayscale (height, width).
+    :param v2: Second image (RGB), or grayscale. If its size differs, it is truncated or repeated to the size of v1.
+    :param chunk_size: Number of elements accumulated at a time, in float64.
     :return: Cosine similarity between the two flattened images.
     """
-    # Flatten the images into 1D vectors
-    v1_flat = v1.flatten().astype(np.float32)
-    v2_flat = v2.flatten().astype(np.float32)
-
-    # Resize v2_flat to match the size of v1_flat if they are different
-    if v1_flat.shape != v2_flat.shape:
-        v2_flat = resize_vector(v2_flat, v1_flat.shape[0])
-        
-    # Compute the dot product of the two vectors
-    dot_product_result = dot_product(v1_flat, v2_flat)
-    
-    # Compute the magnitudes of the two vectors
-    magnitude_v1 = magnitude(v1_flat)
-    magnitude_v2 = magnitude(v2_flat)
-    
+    # A grayscale image compared with a color one of the same size counts as gray in every channel
+    if v1.ndim == 3 and v2.ndim == 2 and v1.shape[:2] == v2.shape:
+        v2 = np.broadcast_to(v2[:, :, np.newaxis], v1.shape)
+    elif v1.ndim == 2 and v2.ndim == 3 and v1.shape == v2.shape[:2]:
+        v1 = np.broadcast_to(v1[:, :, np.newaxis], v2.shape)
+
+    # Flatten the images into 1D vectors, a view for contiguous images
+    v1_flat = v1.reshape(-1)
+    v2_flat = v2.reshape(-1)
+    size = v1_flat.size
+
+    dot_product_result = 0.0
+    sum_squares_v1 = 0.0
+    sum_squares_v2 = 0.0
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        a = v1_flat[start:stop].astype(np.float64)
+        if stop <= v2_flat.size:
+            b = v2_flat[start:stop].astype(np.float64)
+        else:
+            # v2 is repeated to the size of v1
+            b = np.take(v2_flat, np.arange(start, stop), mode='wrap').astype(np.float64)
+
+        dot_product_result += np.dot(a, b)
+        sum_squares_v1 += np.dot(a, a)
+        sum_squares_v2 += np.dot(b, b)
+
     # Avoid division by zero by checking if magnitudes are zero
-    if magnitude_v1 == 0 or magnitude_v2 == 0:
+    if sum_squares_v1 == 0 or sum_squares_v2 == 0:
         return 0.0
-    
+
     # Compute the cosine similarity
-    similarity = dot_product_result / (magnitude_v1 * magnitude_v2)
+    return float(dot_product_result / (np.sqrt(sum_squares_v1) * np.sqrt(sum_squares_v2)))
+
+def cosine_similarity_matrix(images_a, images_b=None, chunk_bytes: int = MATRIX_CHUNK_BYTES) -> np.ndarray:
+    """
+    Compute the cosine similarity between every pair of images from two sets with one matrix product.
+
+    :param images_a: N images, as a sequence or an array (N, ...); all images must have the same size.
+    :param images_b: M images of the same size, or None to compare images_a with itself.
+    :param chunk_bytes: Memory for the float64 blocks of pixels multiplied at a time.
+    :return: float64 matrix (N, M); pairs involving an all-black image have similarity 0.
+    """
+    a = np.stack([np.asarray(image).reshape(-1) for image in images_a])
+    b = a if images_b is None else np.stack([np.asarray(image).reshape(-1) for image in images_b])
+    if a.shape[1] != b.shape[1]:
+        raise ValueError(f"Images must all have the same size, got {a.shape[1]} and {b.shape[1]} values")
+
+    dot_products = np.zeros((a.shape[0], b.shape[0]))
+    sum_squares_a = np.zeros(a.shape[0])
+    sum_squares_b = np.zeros(b.shape[0])
+
+    # The pixels are converted to float64 one block of columns at a time
+    chunk = max(1, chunk_bytes // (8 * (a.shape[0] + b.shape[0])))
+    for start in range(0, a.shape[1], chunk):
+        block_a = a[:, start:start + chunk].astype(np.float64)
+        block_b = block_a if images_b is None else b[:, start:start + chunk].astype(np.float64)
+        dot_products += block_a @ block_b.T
+        sum_squares_a += np.einsum('ij,ij->i', block_a, block_a)
+        sum_squares_b += np.einsum('ij,ij->i', block_b, block_b)
+
+    norms = np.outer(np.sqrt(sum_squares_a), np.sqrt(sum_squares_b))
+    similarity = np.zeros_like(dot_products)
+    np.divide(dot_products, norms, out=similarity, where=norms > 0)
     return similarity
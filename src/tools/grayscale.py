@@ -1,17 +1,45 @@
 import numpy as np
+from tools.buffers import buffer_pool, WORK_DTYPE
 
-def rgb_to_grayscale(image: np.ndarray) -> np.ndarray:
+# Weights of the B, G and R channels in 1/256ths: 0.114, 0.587 and 0.299 rounded so they add up to 256
+GRAY_WEIGHTS = (29, 150, 77)
+GRAY_SHIFT = 8
+
+def rgb_to_grayscale(image: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """
     Convert an RGB image to grayscale.
-    
-    :param image: Input image in RGB format (height, width, 3).
+
+    uint8 images are converted with integer fixed-point weights and rounded, so the weighted sum never
+    leaves 16-bit integers.
+
+    :param image: Input image in RGB format (height, width, 3). A grayscale image (height, width) is returned as is.
+    :param out: Optional uint8 buffer (height, width) for the grayscale version of a color image.
     :return: Grayscale image (height, width).
     """
+    if image.ndim == 2:
+        return image
+
     B = image[:, :, 0]  # Blue channel
     G = image[:, :, 1]  # Green channel
     R = image[:, :, 2]  # Red channel
-    
-    grayscale_image = 0.299 * R + 0.587 * G + 0.114 * B
-    grayscale_image = np.clip(grayscale_image, 0, 255).astype(np.uint8)
-    
-    return grayscale_image
+
+    if image.dtype == np.uint8:
+        # The weighted sum is accumulated in pooled buffers, so only the result is allocated
+        if out is None:
+            out = np.empty(image.shape[:2], dtype=np.uint8)
+        with buffer_pool.scratch(image.shape[:2], np.uint16) as grayscale_image, \
+                buffer_pool.scratch(image.shape[:2], np.uint16) as weighted:
+            np.multiply(B, GRAY_WEIGHTS[0], out=grayscale_image, dtype=np.uint16)
+            grayscale_image += np.multiply(G, GRAY_WEIGHTS[1], out=weighted, dtype=np.uint16)
+            grayscale_image += np.multiply(R, GRAY_WEIGHTS[2], out=weighted, dtype=np.uint16)
+            grayscale_image += 1 << (GRAY_SHIFT - 1)
+            return np.right_shift(grayscale_image, GRAY_SHIFT, out=out, casting="unsafe")
+
+    grayscale_image = np.multiply(R, 0.299, dtype=WORK_DTYPE)
+    grayscale_image += np.multiply(G, 0.587, dtype=WORK_DTYPE)
+    grayscale_image += np.multiply(B, 0.114, dtype=WORK_DTYPE)
+    grayscale_image = np.clip(grayscale_image, 0, 255, out=grayscale_image)
+    if out is None:
+        return grayscale_image.astype(np.uint8)
+    np.copyto(out, grayscale_image, casting="unsafe")
+    return out
@@ -0,0 +1,200 @@
+import zlib
+from dataclasses import dataclass
+import numpy as np
+from tools.jobs import check_cancelled
+
+# Default memory budget for the compressed history
+HISTORY_BUDGET_BYTES = 256 * 1024 * 1024
+
+# A full snapshot is stored at least every KEYFRAME_INTERVAL states, so undo never replays more operations
+KEYFRAME_INTERVAL = 4
+
+# zlib level 1 is several times faster than the default and compresses edited photos almost as well
+COMPRESSION_LEVEL = 1
+
+@dataclass
+class HistoryEntry:
+    """One state of the history: a compressed snapshot, or the operation that produced it from the previous state."""
+    operation: object = None
+    keyframe: bytes = None
+    shape: tuple = None
+    dtype: np.dtype = None
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.keyframe) if self.keyframe is not None else 0
+
+    @classmethod
+    def snapshot(cls, image: np.ndarray, level: int = COMPRESSION_LEVEL) -> "HistoryEntry":
+        """
+        Create a keyframe entry from an image.
+
+        :param image: Image to store.
+        :param level: zlib compression level.
+        :return: Entry holding the compressed pixels.
+        """
+        data = zlib.compress(np.ascontiguousarray(image).data, level)
+        return cls(keyframe=data, shape=image.shape, dtype=image.dtype)
+
+    def decode(self) -> np.ndarray:
+        """Decompress the stored snapshot into a new writable image."""
+        return np.frombuffer(bytearray(zlib.decompress(self.keyframe)), dtype=self.dtype).reshape(self.shape)
+
+class History:
+    """
+    Undo/redo history of an image, bounded by a memory budget instead of a number of states.
+
+    Each state is stored either as a zlib-compressed snapshot (a keyframe) or, when the operation that
+    produced it is known and deterministic, as that operation alone. Restoring a state decompresses the
+    nearest keyframe before it and replays the operations in between, which takes up to
+    keyframe_interval - 1 full-resolution passes: a GUI gets the work from restorer(), runs it in the
+    background and makes the state current with select() once it is done.
+
+    Usage:
+        history = History()
+        history.reset(image)
+        image = pipeline(image)
+        history.commit(image, pipeline)
+        image = history.undo()
+
+        restore = history.restorer(history.index - 1, image)
+        image = restore()  # e.g. on a worker thread
+        history.select(history.index - 1)
+    """
+
+    def __init__(self, budget_bytes: int = HISTORY_BUDGET_BYTES, keyframe_interval: int = KEYFRAME_INTERVAL,
+                 level: int = COMPRESSION_LEVEL):
+        """
+        :param budget_bytes: Maximum memory for stored snapshots; the oldest states are dropped beyond it.
+        :param keyframe_interval: Maximum number of operations replayed to restore a state.
+        :param level: zlib compression level of the snapshots.
+        """
+        self.budget_bytes = budget_bytes
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self.entries = []
+        self.index = -1
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the stored snapshots, in bytes."""
+        return sum(entry.nbytes for entry in self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def can_undo(self) -> bool:
+        return self.index > 0
+
+    def can_redo(self) -> bool:
+        return self.index < len(self.entries) - 1
+
+    def reset(self, image: np.ndarray):
+        """
+        Clear the history and start it from an image.
+
+        :param image: Initial state.
+        """
+        self.entries = [HistoryEntry.snapshot(image, self.level)]
+        self.index = 0
+
+    def commit(self, image: np.ndarray, operation=None):
+        """
+        Record a new state after the current one, discarding the states that could be redone.
+
+        :param image: The new state.
+        :param operation: Optional deterministic callable that produces the new state from the current one
+                          (e.g. a Pipeline); without it the state is stored as a snapshot.
+        """
+        del self.entries[self.index + 1:]
+
+        if operation is not None and self.index >= 0 and self._operations_since_keyframe(self.index) + 1 < self.keyframe_interval:
+            self.entries.append(HistoryEntry(operation=operation))
+        else:
+            self.entries.append(HistoryEntry.snapshot(image, self.level))
+        self.index = len(self.entries) - 1
+        self._enforce_budget()
+
+    def undo(self):
+        """
+        Step back to the previous state.
+
+        :return: The restored image, or None if there is nothing to undo.
+        """
+        if not self.can_undo():
+            return None
+        self.index -= 1
+        return self.restorer(self.index)()
+
+    def redo(self, current: np.ndarray = None):
+        """
+        Step forward to the next state.
+
+        :param current: Optional image of the current state, which saves restoring it when the next state
+                        is stored as an operation.
+        :return: The restored image, or None if there is nothing to redo.
+        """
+        if not self.can_redo():
+            return None
+        restore = self.restorer(self.index + 1, current)
+        self.index += 1
+        return restore()
+
+    def restorer(self, index: int, current: np.ndarray = None):
+        """
+        Get the work of restoring a state, without changing the current state, so it can run in the background.
+
+        The entries it needs are captured now, so later commits do not change what it restores.
+
+        :param index: Index of the state to restore.
+        :param current: Optional image of the current state, which saves restoring the next state from its
+                        keyframe when that state is stored as an operation.
+        :return: Function without arguments that returns a new image of the state. Between replayed
+                 operations it stops if the job running it has been cancelled.
+        """
+        if not 0 <= index < len(self.entries):
+            raise IndexError(f"No history state {index}")
+        entry = self.entries[index]
+        if entry.keyframe is None and current is not None and index == self.index + 1:
+            operation = entry.operation
+            return lambda: operation(current)
+
+        start = index - self._operations_since_keyframe(index)
+        entries = self.entries[start:index + 1]
+
+        def restore():
+            image = entries[0].decode()
+            for entry in entries[1:]:
+                check_cancelled()
+                image = entry.operation(image)
+            return image
+        return restore
+
+    def select(self, index: int):
+        """
+        Make a state the current one, e.g. once its restorer() has run.
+
+        :param index: Index of the state.
+        """
+        if not 0 <= index < len(self.entries):
+            raise IndexError(f"No history state {index}")
+        self.index = index
+
+    def _operations_since_keyframe(self, index: int) -> int:
+        count = 0
+        while self.entries[index].keyframe is None:
+            index -= 1
+            count += 1
+        return count
+
+    def _enforce_budget(self):
+        # Whole groups (a keyframe and the operations replayed from it) are dropped from the oldest end,
+        # but never the group of the current state
+        while self.nbytes > self.budget_bytes:
+            end = 1
+            while end < len(self.entries) and self.entries[end].keyframe is None:
+                end += 1
+            if end > self.index:
+                break
+            del self.entries[:end]
+            self.index -= end
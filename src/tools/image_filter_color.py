@@ -1,7 +1,10 @@
 from enum import Enum
+from functools import lru_cache
 import numpy as np
 import cv2
 from tools.grayscale import rgb_to_grayscale
+from tools.buffers import buffer_pool, WORK_DTYPE
+from tools.jobs import check_cancelled
 
 class FilterType(Enum):
     COOL_TONE = "Cool Tone"
@@ -38,84 +41,207 @@ FILTER_SETTINGS = {  # B   G   R
     }
 }
 
-def apply_filter(image: np.ndarray, filter_type: FilterType) -> np.ndarray:
+# Filters that map every channel value independently and can be expressed as lookup tables
+LUT_FILTERS = tuple(filter_type for filter_type in FilterType if filter_type != FilterType.OUTLINE)
+
+# Outline levels up to 50 are not significant edges and become white background
+OUTLINE_THRESHOLD_LUT = np.where(np.arange(256) <= 50, 255, np.arange(256)).astype(np.uint8)
+
+def apply_filter(image: np.ndarray, filter_type: FilterType, out: np.ndarray = None) -> np.ndarray:
     """
     Apply the specified filter to the image.
     
-    :param image: Input image in BGR format (height, width, 3).
+    :param image: Input image in BGR format (height, width, 3), or grayscale (height, width).
     :param filter_type: The type of filter to apply.
-    :return: Image with the specified filter applied.
+    :param out: Optional preallocated output for the lookup table filters, shaped like the result.
+    :return: Image with the specified filter applied. Grayscale input stays grayscale unless the filter
+             tints the channels differently; the outline is always grayscale.
     """
-    # If the image is grayscale, convert it to BGR format
-    if len(image.shape) == 2:
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-
-    # Check for the INVERT filter type
-    if filter_type == FilterType.INVERT:
-        return cv2.bitwise_not(image)  
-    
     # Check for the OUTLINE filter type
     if filter_type == FilterType.OUTLINE:
         return apply_outline(image)
 
-    # Retrieve filter settings for the specified filter type
+    # Every other filter, INVERT included, is a precomputed per-channel lookup table
+    return apply_lut(image, get_filter_lut(filter_type), out)
+
+def apply_filter_chain(image: np.ndarray, filter_types: list, out: np.ndarray = None) -> np.ndarray:
+    """
+    Apply several lookup table filters in order with a single pass over the image.
+    
+    :param image: Input image in BGR format (height, width, 3), or grayscale (height, width).
+    :param filter_types: The filters to apply, first to last. OUTLINE is not allowed.
+    :param out: Optional preallocated output, shaped like the result (see apply_lut).
+    :return: Image with all filters applied.
+    """
+    return apply_lut(image, compose_luts(*(get_filter_lut(filter_type) for filter_type in filter_types)), out)
+
+def build_lut(scaling: tuple, offset: tuple) -> np.ndarray:
+    """
+    Build the lookup tables of an RGB scaling and offset adjustment.
+    
+    :param scaling: Tuple of scaling factors for (B, G, R) channels.
+    :param offset: Tuple of offset values for (B, G, R) channels.
+    :return: uint8 array (3, 256) where lut[c, v] is the adjusted value of v in channel c.
+    """
+    levels = np.arange(256, dtype=np.float64)
+    lut = np.empty((3, 256), dtype=np.uint8)
+    for c in range(3):
+        lut[c] = np.clip(levels * scaling[c] + offset[c], 0, 255)
+    return lut
+
+@lru_cache(maxsize=None)
+def get_filter_lut(filter_type: FilterType) -> np.ndarray:
+    """
+    Get the lookup tables of a filter, built once and cached.
+    
+    :param filter_type: The type of filter, any of LUT_FILTERS.
+    :return: Read-only uint8 array (3, 256) of per-channel lookup tables.
+    """
+    if filter_type not in LUT_FILTERS:
+        raise ValueError(f"{filter_type} is not a lookup table filter")
+
     settings = FILTER_SETTINGS[filter_type]
+    lut = build_lut(settings['scaling'], settings['offset'])
+    lut.setflags(write=False)
+    return lut
+
+def compose_luts(*luts: np.ndarray) -> np.ndarray:
+    """
+    Combine lookup tables applied one after another into a single one.
     
-    return apply_rgb_adjustment(image, settings['scaling'], settings['offset'])
+    :param luts: uint8 arrays (3, 256), first to last.
+    :return: uint8 array (3, 256) equivalent to applying all of them in order.
+    """
+    composed = np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+    for lut in luts:
+        composed = np.take_along_axis(lut, composed.astype(np.intp), axis=1)
+    return composed
 
-def apply_outline(image: np.ndarray) -> np.ndarray:
+def preserves_gray(lut: np.ndarray) -> bool:
     """
-    Apply an outline effect to the image using a Sobel filter for edge detection.
+    Check whether lookup tables map a gray pixel to a gray pixel, i.e. all channels share one table.
+
+    :param lut: uint8 array (3, 256) of per-channel lookup tables.
+    :return: True if grayscale images can stay single-channel through the tables.
+    """
+    return bool(np.array_equal(lut[0], lut[1]) and np.array_equal(lut[0], lut[2]))
+
+def apply_lut(image: np.ndarray, lut: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Map every pixel through per-channel lookup tables.
     
-    :param image: Input image in BGR format (height, width, 3).
-    :return: Image with outline effect applied.
+    :param image: uint8 image in BGR format (height, width, 3), or grayscale (height, width).
+    :param lut: uint8 array (3, 256) of per-channel lookup tables.
+    :param out: Optional preallocated uint8 output, shaped like the result.
+    :return: Mapped image (height, width, 3); grayscale input gives a grayscale result (height, width)
+             when the tables preserve gray.
     """
-    # Convert to grayscale for easier edge detection 
-    grayscale_image = rgb_to_grayscale(image)  
+    if image.ndim == 2 and preserves_gray(lut):
+        return cv2.LUT(image, lut[0], dst=out)
 
-    # Define Sobel kernels for edge detection
-    sobel_x = np.array([[1, 0, -1],
-                        [2, 0, -2],
-                        [1, 0, -1]], dtype=np.float32)  # Horizontal edges
+    if out is None:
+        out = np.empty(image.shape[:2] + (3,), dtype=np.uint8)
 
-    sobel_y = np.array([[1, 2, 1],
-                        [0, 0, 0],
-                        [-1, -2, -1]], dtype=np.float32)  # Vertical edges
+    if image.ndim == 2:
+        # A grayscale value is looked up in each channel's table
+        for c in range(3):
+            np.take(lut[c], image, out=out[:, :, c], mode='clip')
+        return out
 
-    # Get image dimensions
-    height, width = grayscale_image.shape
+    # A single gather over all channels at once
+    return cv2.LUT(image, np.ascontiguousarray(lut.T).reshape(256, 1, 3), dst=out)
 
-    # Create an empty array for the output image
-    outline_image = np.zeros_like(grayscale_image)
+def apply_outline(image: np.ndarray, max_magnitude: float = None) -> np.ndarray:
+    """
+    Apply an outline effect to the image using a Sobel filter for edge detection.
+    
+    :param image: Input image in BGR format (height, width, 3), or grayscale (height, width).
+    :param max_magnitude: Gradient magnitude mapped to 255, by default the largest one in the image.
+                          Pass the maximum of the whole image when processing it in strips.
+    :return: Grayscale outline image (height, width).
+    """
+    # Convert to grayscale for easier edge detection; only the result is allocated, the rest is pooled
+    grayscale_image = image
+    if image.ndim == 3:
+        grayscale_image = rgb_to_grayscale(image, buffer_pool.take(image.shape[:2], np.uint8))
 
     # Apply the Sobel filter to detect edges
-    for y in range(1, height - 1):
-        for x in range(1, width - 1):
-            # Convolution for Sobel X
-            gx = (sobel_x[0, 0] * grayscale_image[y - 1, x - 1] + sobel_x[0, 1] * grayscale_image[y - 1, x] + sobel_x[0, 2] * grayscale_image[y - 1, x + 1] +
-                  sobel_x[1, 0] * grayscale_image[y, x - 1] + sobel_x[1, 1] * grayscale_image[y, x] + sobel_x[1, 2] * grayscale_image[y, x + 1] +
-                  sobel_x[2, 0] * grayscale_image[y + 1, x - 1] + sobel_x[2, 1] * grayscale_image[y + 1, x] + sobel_x[2, 2] * grayscale_image[y + 1, x + 1])
-            
-            # Convolution for Sobel Y
-            gy = (sobel_y[0, 0] * grayscale_image[y - 1, x - 1] + sobel_y[0, 1] * grayscale_image[y - 1, x] + sobel_y[0, 2] * grayscale_image[y - 1, x + 1] +
-                  sobel_y[1, 0] * grayscale_image[y, x - 1] + sobel_y[1, 1] * grayscale_image[y, x] + sobel_y[1, 2] * grayscale_image[y, x + 1] +
-                  sobel_y[2, 0] * grayscale_image[y + 1, x - 1] + sobel_y[2, 1] * grayscale_image[y + 1, x] + sobel_y[2, 2] * grayscale_image[y + 1, x + 1])
-            
-            # Calculate gradient magnitude
-            magnitude = np.sqrt(gx ** 2 + gy ** 2)
-            outline_image[y, x] = np.clip(magnitude, 0, 255)
+    magnitude = sobel_magnitude(grayscale_image, out=buffer_pool.take(image.shape[:2], np.float32))
+    if grayscale_image is not image:
+        buffer_pool.release(grayscale_image)
 
     # Normalize the outline image to the range [0, 255] for calculate threshold value 
-    outline_image = (outline_image / outline_image.max() * 255).astype(np.uint8)
+    if max_magnitude is None:
+        max_magnitude = magnitude.max()
+    if max_magnitude > 0:
+        magnitude *= np.float32(255 / max_magnitude)
+    outline_image = magnitude.astype(np.uint8)
+    buffer_pool.release(magnitude)
 
-    # Grayscale outline image is converted back to a 3-channel BGR image
-    color_outline_image = cv2.cvtColor(outline_image, cv2.COLOR_GRAY2BGR)
+    # Set a threshold to keep only significant edges, everything else becomes white background
+    cv2.LUT(outline_image, OUTLINE_THRESHOLD_LUT, dst=outline_image)
 
-    # Set a threshold to keep only significant edges
-    mask = (outline_image > 50).astype(np.uint8)  
-    color_outline_image[mask == 0] = (255, 255, 255)  
+    # The outline stays single-channel, it is only expanded to BGR for display
+    return outline_image
 
-    return color_outline_image
+def sobel_magnitude(grayscale_image: np.ndarray, strip_height: int = 256, out: np.ndarray = None) -> np.ndarray:
+    """
+    Compute the Sobel gradient magnitude of a grayscale image, clipped to [0, 255] and truncated to whole values.
+    
+    :param grayscale_image: Grayscale image (height, width).
+    :param strip_height: Number of rows processed at once.
+    :param out: Optional float32 buffer (height, width) for the result.
+    :return: float32 gradient magnitude (height, width). Border pixels repeat their edge neighbours.
+    """
+    height, width = grayscale_image.shape
+    magnitude = np.empty((height, width), dtype=np.float32) if out is None else out
+
+    # Edge padding, like np.pad(mode='edge'), into a pooled buffer
+    padded_image = buffer_pool.take((height + 2, width + 2), grayscale_image.dtype)
+    padded_image[1:-1, 1:-1] = grayscale_image
+    padded_image[0, 1:-1] = grayscale_image[0]
+    padded_image[-1, 1:-1] = grayscale_image[-1]
+    padded_image[:, 0] = padded_image[:, 1]
+    padded_image[:, -1] = padded_image[:, -2]
+
+    # Both Sobel kernels are separable: gx smooths [1, 2, 1] down the columns a [1, 0, -1] row difference,
+    # gy is the transpose. Each strip is computed with whole-row array operations into reused buffers.
+    rows = min(strip_height, height)
+    strip = buffer_pool.take((rows + 2, width + 2), np.float32)
+    difference = buffer_pool.take((rows + 2, width), np.float32)
+    smooth = buffer_pool.take((rows + 2, width), np.float32)
+    gy = buffer_pool.take((rows, width), np.float32)
+
+    for top in range(0, height, rows):
+        check_cancelled()
+        n = min(rows, height - top)
+        s = strip[:n + 2]
+        s[...] = padded_image[top:top + n + 2]
+
+        d = difference[:n + 2]
+        np.subtract(s[:, :-2], s[:, 2:], out=d)
+        sm = smooth[:n + 2]
+        np.add(s[:, :-2], s[:, 2:], out=sm)
+        sm += s[:, 1:-1]
+        sm += s[:, 1:-1]
+
+        gx = magnitude[top:top + n]
+        np.add(d[:-2], d[2:], out=gx)
+        gx += d[1:-1]
+        gx += d[1:-1]
+        g = gy[:n]
+        np.subtract(sm[:-2], sm[2:], out=g)
+
+        # magnitude = sqrt(gx^2 + gy^2), written over gx
+        np.multiply(gx, gx, out=gx)
+        np.multiply(g, g, out=g)
+        gx += g
+        np.sqrt(gx, out=gx)
+
+    buffer_pool.release(padded_image, strip, difference, smooth, gy)
+    np.minimum(magnitude, 255, out=magnitude)
+    np.floor(magnitude, out=magnitude)
+    return magnitude
 
 
 def apply_rgb_adjustment(image: np.ndarray, scaling: tuple, offset: tuple) -> np.ndarray:
@@ -127,16 +253,15 @@ def apply_rgb_adjustment(image: np.ndarray, scaling: tuple, offset: tuple) -> np
     :param offset: Tuple of offset values for (B, G, R) channels.
     :return: Adjusted image with the given RGB scaling and offset.
     """
-    B = image[:, :, 0] * scaling[0] + offset[0]
-    G = image[:, :, 1] * scaling[1] + offset[1]
-    R = image[:, :, 2] * scaling[2] + offset[2]
+    # uint8 images only have 256 possible values per channel, so adjust the table instead of the pixels
+    if image.dtype == np.uint8:
+        return apply_lut(image, build_lut(scaling, offset))
 
-    # Clip values to ensure they are in the valid range [0, 255]
-    B = np.clip(B, 0, 255)
-    G = np.clip(G, 0, 255)
-    R = np.clip(R, 0, 255)
+    # Other types are adjusted in one float32 buffer, all channels at once
+    adjusted_image = np.multiply(image, np.asarray(scaling, dtype=WORK_DTYPE), dtype=WORK_DTYPE)
+    adjusted_image += np.asarray(offset, dtype=WORK_DTYPE)
 
-    # Merge the adjusted channels back into a BGR image
-    adjusted_image = np.dstack((B, G, R)).astype(np.uint8)
+    # Clip values to ensure they are in the valid range [0, 255]
+    np.clip(adjusted_image, 0, 255, out=adjusted_image)
 
-    return adjusted_image
\ No newline at end of file
+    return adjusted_image.astype(np.uint8)
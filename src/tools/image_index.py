@@ -0,0 +1,227 @@
+import json
+import os
+import numpy as np
+import cv2
+from tools.grayscale import rgb_to_grayscale
+
+# Images are reduced to EMBEDDING_SIZE x EMBEDDING_SIZE grayscale thumbnails, the size used by perceptual
+# hashes; 64 values per image keep a query over a million images to a few tens of milliseconds
+EMBEDDING_SIZE = 8
+
+# Number of stored embeddings multiplied at once by a query, bounds the memory of the scores
+BLOCK_ROWS = 65536
+
+# Similarity above which two images are considered near-duplicates
+DUPLICATE_THRESHOLD = 0.95
+
+EMBEDDINGS_FILE = "embeddings.bin"
+IDS_FILE = "ids.txt"
+HEADER_FILE = "index.json"
+
+def embed(image: np.ndarray, size: int = EMBEDDING_SIZE) -> np.ndarray:
+    """
+    Compute the embedding of an image: its grayscale thumbnail with the mean removed, L2-normalized.
+
+    The dot product of two embeddings is the cosine similarity of the thumbnails, which ignores
+    changes of brightness and contrast. A flat image has a zero embedding, similar to nothing.
+
+    :param image: Input image (height, width, 3) or grayscale (height, width).
+    :param size: Width and height of the thumbnail.
+    :return: float32 vector of size * size values.
+    """
+    grayscale = rgb_to_grayscale(image) if image.ndim == 3 else image
+    thumbnail = cv2.resize(grayscale, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32).reshape(-1)
+    thumbnail -= thumbnail.mean()
+    norm = np.linalg.norm(thumbnail)
+    if norm > 0:
+        thumbnail /= norm
+    return thumbnail
+
+def _top_k(scores: np.ndarray, indices: np.ndarray, k: int) -> tuple:
+    """Keep the k highest scores of every row, in no particular order, and their indices."""
+    if scores.shape[1] <= k:
+        return scores, indices
+    top = np.argpartition(scores, -k, axis=1)[:, -k:]
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(indices, top, axis=1)
+
+class ImageIndex:
+    """
+    Persistent index of image embeddings for finding similar and near-duplicate images.
+
+    The index is a directory holding the embeddings as a raw matrix, memory-mapped so that opening it
+    reads nothing, the image ids (one per line) and a small header. Images are added incrementally by
+    appending to the files; the header records how much of them is valid, so an interrupted add is
+    discarded when the index is next opened.
+
+    Queries compare embeddings with blocked matrix products over the memory map, so the images
+    themselves are never loaded and the memory used does not grow with the index.
+
+    Usage:
+        index = ImageIndex("assets.index")
+        index.add_files(find_images("assets"))
+        for image_id, similarity in index.query(cv2.imread("photo.jpg"), k=5):
+            ...
+    """
+
+    def __init__(self, path: str, embedding_size: int = EMBEDDING_SIZE, dtype=np.float32):
+        """
+        :param path: Directory of the index, created if it does not exist.
+        :param embedding_size: Thumbnail size of a new index; an existing index keeps its own.
+        :param dtype: Storage type of the embeddings of a new index: float32, or float16 to halve the file
+                      at the cost of slower queries, which convert the embeddings back to float32.
+        """
+        self.path = path
+        header_path = os.path.join(path, HEADER_FILE)
+        if os.path.exists(header_path):
+            with open(header_path) as file:
+                self._header = json.load(file)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._header = {"embedding_size": embedding_size, "dtype": np.dtype(dtype).name, "count": 0, "ids_bytes": 0}
+            open(os.path.join(path, IDS_FILE), "ab").close()
+            self._write_header()
+
+        self.embedding_size = self._header["embedding_size"]
+        self.dtype = np.dtype(self._header["dtype"])
+        self.dimension = self.embedding_size ** 2
+        self._ids = None
+        self._map_embeddings()
+
+    def __len__(self) -> int:
+        return self._header["count"]
+
+    @property
+    def ids(self) -> list:
+        """Ids of the indexed images, in the order they were added; read on first use."""
+        if self._ids is None:
+            # Also covers indexes created before the ids file was written on creation
+            if self._header["count"] == 0:
+                self._ids = []
+                return self._ids
+            with open(os.path.join(self.path, IDS_FILE), "rb") as file:
+                data = file.read(self._header["ids_bytes"])
+            self._ids = data.decode("utf-8").split("\n")[:-1]
+        return self._ids
+
+    def _write_header(self):
+        # Written under a temporary name, so the header is never seen half-written
+        header_path = os.path.join(self.path, HEADER_FILE)
+        with open(header_path + ".partial", "w") as file:
+            json.dump(self._header, file)
+        os.replace(header_path + ".partial", header_path)
+
+    def _map_embeddings(self):
+        count = self._header["count"]
+        if count == 0:
+            self.embeddings = np.empty((0, self.dimension), dtype=self.dtype)
+        else:
+            self.embeddings = np.memmap(os.path.join(self.path, EMBEDDINGS_FILE), dtype=self.dtype, mode="r",
+                                        shape=(count, self.dimension))
+
+    def add(self, ids, images):
+        """
+        Add images to the index.
+
+        :param ids: Ids of the images, e.g. their paths; ids cannot contain line breaks.
+        :param images: Images, in the same order as the ids.
+        """
+        ids = list(ids)
+        embeddings = np.array([embed(image, self.embedding_size) for image in images], dtype=self.dtype)
+        if len(embeddings) != len(ids):
+            raise ValueError(f"Got {len(ids)} ids for {len(embeddings)} images")
+        self.add_embeddings(ids, embeddings.reshape(len(ids), self.dimension))
+
+    def add_files(self, paths, batch_size: int = 1024) -> list:
+        """
+        Add image files to the index, using their paths as ids.
+
+        :param paths: Paths of the images.
+        :param batch_size: Number of images embedded before they are written to the index.
+        :return: Paths of the files that could not be read, which are not added.
+        """
+        failed = []
+        ids, embeddings = [], []
+        for path in paths:
+            image = cv2.imread(path)
+            if image is None:
+                failed.append(path)
+                continue
+            ids.append(path)
+            embeddings.append(embed(image, self.embedding_size))
+            if len(ids) == batch_size:
+                self.add_embeddings(ids, np.array(embeddings, dtype=self.dtype))
+                ids, embeddings = [], []
+        if ids:
+            self.add_embeddings(ids, np.array(embeddings, dtype=self.dtype))
+        return failed
+
+    def add_embeddings(self, ids: list, embeddings: np.ndarray):
+        """
+        Append precomputed embeddings (see embed) to the index.
+
+        :param ids: Ids of the images.
+        :param embeddings: Embeddings (len(ids), dimension).
+        """
+        if len(ids) == 0:
+            return
+        if any("\n" in image_id for image_id in ids):
+            raise ValueError("Image ids cannot contain line breaks")
+        count = self._header["count"]
+        encoded_ids = "".join(image_id + "\n" for image_id in ids).encode("utf-8")
+
+        # Anything past the valid part was left by an interrupted add and is overwritten
+        with open(os.path.join(self.path, EMBEDDINGS_FILE), "ab") as file:
+            file.truncate(count * self.dimension * self.dtype.itemsize)
+            file.write(np.ascontiguousarray(embeddings, dtype=self.dtype).tobytes())
+        with open(os.path.join(self.path, IDS_FILE), "ab") as file:
+            file.truncate(self._header["ids_bytes"])
+            file.write(encoded_ids)
+
+        self._header["count"] = count + len(ids)
+        self._header["ids_bytes"] += len(encoded_ids)
+        self._write_header()
+        if self._ids is not None:
+            self._ids.extend(ids)
+        self._map_embeddings()
+
+    def query(self, image: np.ndarray, k: int = 10, threshold: float = None) -> list:
+        """
+        Find the indexed images most similar to an image.
+
+        :param image: Query image.
+        :param k: Maximum number of results.
+        :param threshold: Optional minimum similarity, e.g. DUPLICATE_THRESHOLD to find near-duplicates.
+        :return: List of (id, similarity), most similar first.
+        """
+        return self.query_embeddings(embed(image, self.embedding_size)[np.newaxis], k, threshold)[0]
+
+    def query_embeddings(self, queries: np.ndarray, k: int = 10, threshold: float = None) -> list:
+        """
+        Find the indexed images most similar to each of several embeddings.
+
+        :param queries: Query embeddings (n, dimension).
+        :param k: Maximum number of results per query.
+        :param threshold: Optional minimum similarity.
+        :return: For each query, a list of (id, similarity), most similar first.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_indices = np.empty((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(self), BLOCK_ROWS):
+            block = np.asarray(self.embeddings[start:start + BLOCK_ROWS], dtype=np.float32)
+            scores = queries @ block.T
+            indices = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+
+            # Keep the k best of this block, then the k best of those and the previous ones
+            scores, indices = _top_k(scores, indices, k)
+            best_scores, best_indices = _top_k(np.concatenate([best_scores, scores], axis=1),
+                                               np.concatenate([best_indices, indices], axis=1), k)
+
+        results = []
+        for scores, indices in zip(best_scores, best_indices):
+            order = np.argsort(-scores, kind="stable")
+            results.append([(self.ids[index], float(score)) for score, index in zip(scores[order], indices[order])
+                            if threshold is None or score >= threshold])
+        return results
@@ -0,0 +1,162 @@
+import queue
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+
+# Maximum number of jobs waiting to run; the oldest is dropped beyond it
+MAX_PENDING_JOBS = 4
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled or superseded."""
+
+class CancelToken:
+    """Cancellation flag shared between a job and the code that submitted it."""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        """Raise JobCancelled if the job has been cancelled."""
+        if self._event.is_set():
+            raise JobCancelled()
+
+_current_token = ContextVar("current_token", default=None)
+
+def check_cancelled():
+    """
+    Stop the current job if it has been cancelled.
+
+    Long-running operations call this between their passes; outside a job it does nothing.
+    """
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+class Job:
+    """A function to run in the background and the callbacks that receive its outcome."""
+
+    def __init__(self, key, function, args, on_done, on_error):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.token = CancelToken()
+
+class JobScheduler:
+    """
+    Runs jobs one at a time on a single worker thread, keeping only the latest request for each key.
+
+    Submitting a job cancels the pending or running job with the same key, so repeated clicks never queue
+    redundant passes. Results are not delivered from the worker thread: poll() runs the callbacks on the
+    thread that calls it, e.g. the Tk main loop through root.after().
+
+    Usage:
+        scheduler = JobScheduler()
+        scheduler.submit("render", render, image, on_done=show)
+        root.after(50, poll)  # where poll calls scheduler.poll() and schedules itself again
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING_JOBS):
+        """
+        :param max_pending: Maximum number of jobs waiting to run.
+        """
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._running = None
+        self._results = queue.Queue()
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def busy(self) -> bool:
+        """Check whether a job is running or waiting to run."""
+        with self._condition:
+            return self._running is not None or bool(self._pending)
+
+    def submit(self, key, function, *args, on_done=None, on_error=None) -> Job:
+        """
+        Queue a job, superseding the pending and running jobs with the same key.
+
+        :param key: Jobs with equal keys do the same kind of work; only the latest one is kept.
+        :param function: Function to run on the worker thread.
+        :param args: Arguments of the function.
+        :param on_done: Called by poll() with the return value of the function.
+        :param on_error: Called by poll() with the exception if the function fails.
+        :return: The queued job.
+        """
+        job = Job(key, function, args, on_done, on_error)
+        with self._condition:
+            self._cancel_locked(key)
+            self._pending[key] = job
+            while len(self._pending) > self.max_pending:
+                _, dropped = self._pending.popitem(last=False)
+                dropped.token.cancel()
+            self._condition.notify()
+        return job
+
+    def cancel(self, key):
+        """
+        Cancel the pending and running jobs with a key; their callbacks are never called.
+
+        :param key: Key of the jobs to cancel.
+        """
+        with self._condition:
+            self._cancel_locked(key)
+
+    def _cancel_locked(self, key):
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.token.cancel()
+        if self._running is not None and self._running.key == key:
+            self._running.token.cancel()
+
+    def poll(self):
+        """Run the callbacks of the finished jobs on the calling thread."""
+        while True:
+            try:
+                job, result, error = self._results.get_nowait()
+            except queue.Empty:
+                return
+            # A job cancelled after it finished is dropped as well
+            if job.token.cancelled:
+                continue
+            if error is None:
+                if job.on_done is not None:
+                    job.on_done(result)
+            elif job.on_error is not None:
+                job.on_error(error)
+            else:
+                raise error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                _, job = self._pending.popitem(last=False)
+                self._running = job
+
+            token = _current_token.set(job.token)
+            try:
+                result, error = job.function(*job.args), None
+            except JobCancelled:
+                result, error = None, None
+                job.token.cancel()
+            except Exception as exception:
+                result, error = None, exception
+            finally:
+                _current_token.reset(token)
+
+            with self._condition:
+                self._running = None
+            if not job.token.cancelled:
+                self._results.put((job, result, error))
@@ -0,0 +1,298 @@
+from dataclasses import dataclass, replace
+import numpy as np
+from tools.blur import apply_blur, BlurType
+from tools.grayscale import rgb_to_grayscale
+from tools.image_filter_color import apply_filter, compose_luts, get_filter_lut, preserves_gray, FilterType, LUT_FILTERS
+from tools.reshape import apply_mask, get_mask, MaskType
+from tools.rotate import rotate_image, Interpolation
+from tools.buffers import buffer_pool
+from tools.compiled import fused_pointwise
+from tools.jobs import check_cancelled
+from tools.profiling import profiler
+from tools.stage_cache import chain_key
+
+IDENTITY_LUT = np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+IDENTITY_LUT.setflags(write=False)
+
+@dataclass(frozen=True)
+class GrayscaleStage:
+    """Convert to a single-channel grayscale image."""
+    pointwise = True
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return rgb_to_grayscale(image)
+
+    def output_channels(self, channels: int) -> int:
+        return 1
+
+    def scaled(self, factor: float):
+        return self
+
+@dataclass(frozen=True)
+class BlurStage:
+    """Blur with one of the BlurType methods."""
+    blur_type: BlurType
+    kernel_size: int = 5
+    sigma: float = 5
+    pointwise = False
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return apply_blur(image, self.blur_type, self.kernel_size, self.sigma)
+
+    def output_channels(self, channels: int) -> int:
+        return channels
+
+    def scaled(self, factor: float):
+        """
+        Get the same blur for an image resized by a factor, so a downscaled proxy looks like the full render.
+
+        :param factor: Size of the target image relative to the one the stage was set up for.
+        :return: BlurStage with the kernel size and sigma scaled; the kernel keeps its parity.
+        """
+        kernel_size = max(1, int(round(self.kernel_size * factor)))
+        if kernel_size % 2 != self.kernel_size % 2:
+            kernel_size += 1
+        return replace(self, kernel_size=kernel_size, sigma=self.sigma * factor)
+
+@dataclass(frozen=True)
+class FilterStage:
+    """Apply a color filter; every filter except OUTLINE is pointwise."""
+    filter_type: FilterType
+
+    @property
+    def pointwise(self) -> bool:
+        return self.filter_type in LUT_FILTERS
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return apply_filter(image, self.filter_type)
+
+    def output_channels(self, channels: int) -> int:
+        if self.filter_type not in LUT_FILTERS:
+            return 1
+        # Tone filters tint the channels differently, which turns a grayscale image into a color one
+        return channels if preserves_gray(get_filter_lut(self.filter_type)) else 3
+
+    def scaled(self, factor: float):
+        return self
+
+@dataclass(frozen=True)
+class MaskStage:
+    """Black out everything outside a shape mask, optionally with an anti-aliased edge."""
+    mask_type: MaskType
+    antialias: bool = False
+    pointwise = True
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return apply_mask(image, self.mask_type, self.antialias)
+
+    def output_channels(self, channels: int) -> int:
+        return channels
+
+    def scaled(self, factor: float):
+        # Mask shapes are sized relative to the image already
+        return self
+
+@dataclass(frozen=True)
+class RotateStage:
+    """Rotate around the image center by an angle in degrees, counterclockwise."""
+    angle: float
+    interpolation: Interpolation = Interpolation.NEAREST
+    pointwise = False
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        return rotate_image(image, self.angle, self.interpolation)
+
+    def output_channels(self, channels: int) -> int:
+        return channels
+
+    def scaled(self, factor: float):
+        return self
+
+class PointwiseSegment:
+    """
+    A run of consecutive pointwise stages fused into one pass over the pixels.
+
+    The fused form is: optional grayscale conversion, the composed lookup table of the filters before
+    the mask, the mask multiply, then the composed lookup table of the filters after it.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.grayscale = False
+        self.mask = None
+        self.lut = IDENTITY_LUT
+        self.lut_after_mask = IDENTITY_LUT
+
+    def can_fuse(self, stage) -> bool:
+        """Check whether a stage can be folded into this segment."""
+        if not stage.pointwise:
+            return False
+        if isinstance(stage, GrayscaleStage):
+            # Grayscale weights mix channels, so they can only come before any lookup table
+            return not self.stages
+        if isinstance(stage, MaskStage):
+            return self.mask is None
+        return True
+
+    def add(self, stage):
+        """Fold a stage into this segment; can_fuse must be true."""
+        self.stages.append(stage)
+        if isinstance(stage, GrayscaleStage):
+            self.grayscale = True
+        elif isinstance(stage, MaskStage):
+            self.mask = stage
+        elif self.mask is None:
+            self.lut = compose_luts(self.lut, get_filter_lut(stage.filter_type))
+        else:
+            self.lut_after_mask = compose_luts(self.lut_after_mask, get_filter_lut(stage.filter_type))
+
+    def apply(self, image: np.ndarray) -> np.ndarray:
+        height, width = image.shape[:2]
+        pixels = image if image.ndim == 3 else image[:, :, np.newaxis]
+        channels = self.output_channels(pixels.shape[2])
+
+        if self.mask is not None:
+            mask = get_mask(height, width, self.mask.mask_type, self.mask.antialias)
+            mask_scale = 255 if self.mask.antialias else 1
+        else:
+            mask = np.ones((1, 1), dtype=np.uint8)
+            mask_scale = 0
+
+        output = np.empty((height, width, channels), dtype=np.uint8)
+        fused_pointwise(pixels, self.grayscale, self.lut, mask, mask_scale, self.lut_after_mask, output)
+        return output.reshape(height, width) if channels == 1 else output
+
+    def output_channels(self, channels: int) -> int:
+        """Grayscale values stay single-channel unless a lookup table tints the channels differently."""
+        if (channels == 1 or self.grayscale) and preserves_gray(self.lut) and preserves_gray(self.lut_after_mask):
+            return 1
+        return 3
+
+def compile_stages(stages) -> list:
+    """
+    Group stages into segments: consecutive pointwise stages are fused, the others run on their own.
+
+    :param stages: Pipeline stages, first to last.
+    :return: List of segments, each with an apply(image) method.
+    """
+    segments = []
+    for stage in stages:
+        if stage.pointwise:
+            if not (segments and isinstance(segments[-1], PointwiseSegment) and segments[-1].can_fuse(stage)):
+                segments.append(PointwiseSegment())
+            segments[-1].add(stage)
+        else:
+            # Neighborhood operations need the full output of the previous segment
+            segments.append(stage)
+    return segments
+
+def segment_name(segment) -> str:
+    """Name a segment for profiling, e.g. BlurStage or PointwiseSegment(GrayscaleStage+MaskStage)."""
+    if isinstance(segment, PointwiseSegment):
+        return f"PointwiseSegment({'+'.join(type(stage).__name__ for stage in segment.stages)})"
+    return type(segment).__name__
+
+def segment_key(segment) -> str:
+    """Describe a segment by the names and parameters of its stages, for the stage cache keys."""
+    if isinstance(segment, PointwiseSegment):
+        return repr(tuple(segment.stages))
+    return repr(segment)
+
+class Pipeline:
+    """
+    A sequence of image operations compiled into as few full-image passes as possible.
+
+    With a StageCache, the output of every segment is cached, and a run resumes from the deepest
+    segment whose output is already cached for the same input, e.g. only the mask is recomputed
+    when it is the one stage that changed after a blur.
+
+    Usage:
+        pipeline = Pipeline([GrayscaleStage(), BlurStage(BlurType.GAUSSIAN, 25), MaskStage(MaskType.HEART)])
+        result = pipeline(image)
+        pipeline.passes  # full-image passes of the last run
+        pipeline.allocations  # image buffers it allocated
+        pipeline.allocated_bytes  # and their memory
+    """
+
+    def __init__(self, stages, cache=None):
+        """
+        :param stages: Stages, first to last.
+        :param cache: Optional StageCache shared with other pipelines.
+        """
+        self.stages = tuple(stages)
+        self.segments = compile_stages(self.stages)
+        self.cache = cache
+        self.passes = 0
+        self.allocations = 0
+        self.allocated_bytes = 0
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        """
+        Run the pipeline.
+
+        :param image: Input image in BGR format (height, width, 3). It is never modified.
+        :return: Processed image; the input itself if the pipeline is empty. With a cache, the result
+                 is read-only and shared with it.
+        """
+        self.passes = 0
+        self.allocations = 0
+        self.allocated_bytes = 0
+        pool_allocations = buffer_pool.allocated_by_thread()
+        pool_bytes = buffer_pool.allocated_bytes_by_thread()
+        source = image
+        keys = []
+        start = 0
+        if self.cache is not None and self.segments:
+            key = self.cache.fingerprint(image)
+            for segment in self.segments:
+                key = chain_key(key, segment_key(segment))
+                keys.append(key)
+
+            # Resume after the deepest segment whose output is cached; the run counts as one hit or miss
+            index, cached = self.cache.get_deepest(keys)
+            if cached is not None:
+                image, start = cached, index + 1
+
+        for index in range(start, len(self.segments)):
+            segment = self.segments[index]
+            # Stop between passes if the job running the pipeline has been superseded
+            check_cancelled()
+            with profiler.span(segment_name(segment), image):
+                output = segment.apply(image)
+            self.passes += 1
+            # A segment may return its input or a view of it, e.g. a quarter turn, without allocating
+            if not np.may_share_memory(output, image):
+                self.allocations += 1
+                self.allocated_bytes += output.nbytes
+            image = output
+            # Caching makes the output read-only, so a stage that returned the input itself is not cached
+            if keys and not np.may_share_memory(image, source):
+                image = self.cache.put(keys[index], image)
+
+        # Scratch arrays the stages could not reuse from the pool, and the temporaries they counted, were allocated as well
+        self.allocations += buffer_pool.allocated_by_thread() - pool_allocations
+        self.allocated_bytes += buffer_pool.allocated_bytes_by_thread() - pool_bytes
+        return image
+
+    def scaled(self, factor: float) -> "Pipeline":
+        """
+        Get the pipeline for an image resized by a factor, e.g. a display-sized proxy of the full image.
+
+        :param factor: Size of the target image relative to the one the pipeline was set up for.
+        :return: New pipeline with the blur sizes scaled to match, sharing the cache.
+        """
+        return Pipeline((stage.scaled(factor) for stage in self.stages), self.cache)
+
+    def output_channels(self, channels: int) -> int:
+        """
+        Get the number of channels of the result, without running the pipeline.
+
+        :param channels: Number of channels of the input, 1 for a grayscale image (height, width).
+        :return: 1 if the result is a grayscale image (height, width), else 3.
+        """
+        for stage in self.stages:
+            channels = stage.output_channels(channels)
+        return channels
+
+    def __repr__(self) -> str:
+        return f"Pipeline({list(self.stages)!r})"
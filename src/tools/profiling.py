@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# Setting this environment variable (e.g. LINOSHOP_PROFILE=1) turns profiling on at startup
+PROFILE_ENV = "LINOSHOP_PROFILE"
+
+# Optional Chrome trace file written while profiling, e.g. LINOSHOP_PROFILE_TRACE=trace.json
+TRACE_ENV = "LINOSHOP_PROFILE_TRACE"
+
+# The trace file is moved to <name>.1 and started again when it grows past this size
+TRACE_MAX_BYTES = 64 * 1024 * 1024
+
+# Number of finished spans kept for display
+RECENT_SPANS = 32
+
+logger = logging.getLogger(__name__)
+
+class Span:
+    """Timing and memory of one profiled stage."""
+
+    def __init__(self, profiler, name: str, image=None):
+        self.profiler = profiler
+        self.name = name
+        self.shape = None if image is None else tuple(image.shape)
+        self.thread = threading.current_thread().name
+        self.thread_id = threading.get_ident()
+        self.start = 0.0
+        self.seconds = 0.0
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self.allocated_bytes = 0
+
+    def set_image(self, image):
+        """Record the dimensions of the image the stage works on."""
+        if image is not None:
+            self.shape = tuple(image.shape)
+
+    def __enter__(self):
+        self.profiler._begin(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.profiler._end(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "seconds": round(self.seconds, 6), "allocated_bytes": self.allocated_bytes,
+                "shape": list(self.shape) if self.shape else None, "thread": self.thread}
+
+    def __str__(self) -> str:
+        shape = "x".join(str(size) for size in self.shape) if self.shape else "-"
+        return f"{self.name:<34} {self.seconds * 1000:9.1f} ms {self.allocated_bytes / 2 ** 20:8.1f} MB  {shape}"
+
+class NullSpan:
+    """Stands in for a span while profiling is off, so instrumented code costs a function call."""
+
+    def set_image(self, image):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Profiler:
+    """
+    Records the wall time, memory allocated and image size of named stages.
+
+    Memory is measured with tracemalloc, which sees the NumPy arrays and Python objects but not the
+    internal buffers of OpenCV. The allocated bytes of a span are the peak traced memory while it ran
+    minus the traced memory when it started, so they include allocations made by other threads at the
+    same time.
+
+    Finished spans are kept for display, written as JSON log lines, and appended to an optional trace
+    file in the Chrome trace event format (open it in chrome://tracing or https://ui.perfetto.dev).
+
+    Usage:
+        with profiler.span("load_image") as span:
+            image = cv2.imread(path)
+            span.set_image(image)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_path = None
+        self.recent = deque(maxlen=RECENT_SPANS)
+        self.count = 0  # Number of finished spans, to notice new ones
+        self._lock = threading.Lock()
+        self._open = []
+        self._epoch = time.perf_counter()
+        self._started_tracemalloc = False
+        self._named_threads = set()
+
+    def enable(self, trace_path: str = None):
+        """
+        Start profiling.
+
+        :param trace_path: Optional Chrome trace file the spans are appended to.
+        """
+        self.trace_path = trace_path
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        """Stop profiling; the spans still open are not recorded."""
+        self.enabled = False
+        with self._lock:
+            self._open.clear()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def span(self, name: str, image=None):
+        """
+        Profile a stage, as a context manager.
+
+        :param name: Name of the stage.
+        :param image: Optional image the stage works on, for its dimensions.
+        :return: The span, or a span that records nothing if profiling is off.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, image)
+
+    def _sample_peak(self):
+        # The traced peak is shared by the whole process, so it is folded into every open span and reset
+        _, peak = tracemalloc.get_traced_memory()
+        for span in self._open:
+            span.peak_bytes = max(span.peak_bytes, peak)
+        tracemalloc.reset_peak()
+
+    def _begin(self, span: Span):
+        if not tracemalloc.is_tracing():
+            return
+        with self._lock:
+            self._sample_peak()
+            span.start_bytes = span.peak_bytes = tracemalloc.get_traced_memory()[0]
+            self._open.append(span)
+
+    def _end(self, span: Span):
+        with self._lock:
+            if span not in self._open:
+                return
+            self._sample_peak()
+            self._open.remove(span)
+            span.allocated_bytes = max(span.peak_bytes - span.start_bytes, 0)
+            self.recent.append(span)
+            self.count += 1
+        logger.info(json.dumps(span.to_dict()))
+        if self.trace_path:
+            self._write_trace_event(span)
+
+    def _write_trace_event(self, span: Span):
+        event = {"name": span.name, "ph": "X", "pid": os.getpid(), "tid": span.thread_id,
+                 "ts": round((span.start - self._epoch) * 1e6, 1), "dur": round(span.seconds * 1e6, 1),
+                 "args": {"allocated_bytes": span.allocated_bytes, "shape": span.to_dict()["shape"]}}
+        with self._lock:
+            if os.path.exists(self.trace_path) and os.path.getsize(self.trace_path) > TRACE_MAX_BYTES:
+                os.replace(self.trace_path, self.trace_path + ".1")
+                self._named_threads.clear()
+            events = [event]
+            if span.thread_id not in self._named_threads:
+                # Metadata event that labels the thread in the viewer
+                self._named_threads.add(span.thread_id)
+                events.insert(0, {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": span.thread_id,
+                                  "args": {"name": span.thread}})
+            # The array is never closed, which trace viewers accept, so events can be appended as they come
+            with open(self.trace_path, "a") as file:
+                if file.tell() == 0:
+                    file.write("[\n")
+                file.writelines(json.dumps(entry) + ",\n" for entry in events)
+
+def enable_from_environment(profiler: Profiler):
+    """Turn profiling on if the LINOSHOP_PROFILE environment variable is set, logging spans to stderr."""
+    if os.environ.get(PROFILE_ENV):
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+            logger.setLevel(logging.INFO)
+        profiler.enable(os.environ.get(TRACE_ENV))
+
+# Profiler shared by the tools and the GUI
+profiler = Profiler()
+enable_from_environment(profiler)
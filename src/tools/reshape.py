@@ -1,68 +1,183 @@
 import numpy as np
 from enum import Enum
+from functools import lru_cache
+from tools.buffers import buffer_pool
 
 class MaskType(Enum):
     CIRCULAR = "Circular Mask"
     HEART = "Heart Mask"
 
-def apply_mask(image: np.ndarray, mask_type: MaskType) -> np.ndarray:
+# Number of generated masks kept for batches of same-size images
+MASK_CACHE_SIZE = 8
+
+# Subpixel samples per axis used to estimate the coverage of anti-aliased masks
+ANTIALIAS_SAMPLES = 4
+
+def apply_mask(image: np.ndarray, mask_type: MaskType, antialias: bool = False, out: np.ndarray = None) -> np.ndarray:
     """
     Apply the specified mask to the image.
 
     :param image: Input image in RGB format (height, width, 3).
     :param mask_type: The type of mask to apply.
+    :param antialias: Blend the edge of the shape by its fractional coverage instead of cutting it hard.
+    :param out: Optional output array of the same shape and dtype; pass the image itself to mask it in place.
     :return: Image with the specified mask applied.
     """
+    height, width = image.shape[:2]
+    return multiply_by_mask(image, get_mask(height, width, mask_type, antialias), antialias, out)
+
+def multiply_by_mask(image: np.ndarray, mask: np.ndarray, antialias: bool = False, out: np.ndarray = None) -> np.ndarray:
+    """
+    Multiply an image by a uint8 mask from get_mask.
+
+    :param image: Input image (height, width, channels) or (height, width).
+    :param mask: Mask (height, width) holding 0 and 1, or the coverage from 0 to 255 if antialias is set.
+    :param antialias: Whether the mask holds coverage values.
+    :param out: Optional output array of the same shape and dtype as the image.
+    :return: Masked image.
+    """
+    if image.ndim == 3:
+        mask = mask[:, :, np.newaxis]
+
+    if not antialias:
+        # The mask holds 0 and 1, so masking is one multiply per pixel
+        return np.multiply(image, mask, out=out)
+
+    # Coverage is stored as 0-255, blend with rounding in a pooled 16-bit buffer
+    blended = buffer_pool.take(image.shape, np.uint16)
+    np.multiply(image, mask, out=blended, dtype=np.uint16)
+    blended += 127
+    blended //= 255
+    if out is None:
+        out = blended.astype(image.dtype)
+    else:
+        np.copyto(out, blended, casting='unsafe')
+    buffer_pool.release(blended)
+    return out
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def get_mask(height: int, width: int, mask_type: MaskType, antialias: bool = False) -> np.ndarray:
+    """
+    Get the mask of the specified shape, generated once per image size and cached.
+
+    :param height: Image height.
+    :param width: Image width.
+    :param mask_type: The type of mask.
+    :param antialias: Return the fractional coverage of every pixel instead of a hard mask.
+    :return: Read-only uint8 mask (height, width): 0 or 1, or the coverage from 0 to 255 if antialias is set.
+    """
+    if antialias:
+        mask = create_coverage_mask(height, width, mask_type)
+    else:
+        mask = create_mask(height, width, mask_type).view(np.uint8)
+    mask.setflags(write=False)
+    return mask
+
+def create_mask(height: int, width: int, mask_type: MaskType, offset_x: float = 0.0, offset_y: float = 0.0,
+                top: int = 0, bottom: int = None) -> np.ndarray:
+    """
+    Create the boolean mask of the specified shape.
+
+    :param height: Image height.
+    :param width: Image width.
+    :param mask_type: The type of mask to create.
+    :param offset_x: Horizontal subpixel offset of the sample point in each pixel.
+    :param offset_y: Vertical subpixel offset of the sample point in each pixel.
+    :param top: First row to create, for images processed in strips.
+    :param bottom: Row after the last one to create, the image height by default.
+    :return: Boolean mask (bottom - top, width), True where the image is kept.
+    """
     if mask_type == MaskType.CIRCULAR:
-        return apply_circular_mask(image)
+        return create_circular_mask(height, width, offset_x, offset_y, top, bottom)
     elif mask_type == MaskType.HEART:
-        return apply_heart_mask(image)
-    # elif mask_type == MaskType.STAR:
-    #     return apply_star_mask(image)
+        return create_heart_mask(height, width, offset_x, offset_y, top, bottom)
     else:
         raise ValueError(f"Invalid mask type: {mask_type}")
 
-def apply_circular_mask(image: np.ndarray) -> np.ndarray:
+def create_coverage_mask(height: int, width: int, mask_type: MaskType, top: int = 0, bottom: int = None) -> np.ndarray:
     """
-    Apply a circular mask to a color image.
+    Create an anti-aliased mask by sampling the shape at several points inside every pixel.
 
-    :param image: Color image (height, width, 3).
-    :return: Image with a circular mask.
+    :param height: Image height.
+    :param width: Image width.
+    :param mask_type: The type of mask to create.
+    :param top: First row to create, for images processed in strips.
+    :param bottom: Row after the last one to create, the image height by default.
+    :return: uint8 mask (bottom - top, width) with the fraction of every pixel inside the shape, from 0 to 255.
     """
-    height, width = image.shape[:2]
-    center_y, center_x = height // 2, width // 2
-    radius = min(center_y, center_x)  # Radius of the circle
+    samples = ANTIALIAS_SAMPLES * ANTIALIAS_SAMPLES
+    bottom = height if bottom is None else bottom
+    hits = np.zeros((bottom - top, width), dtype=np.uint16)
+    for sy in range(ANTIALIAS_SAMPLES):
+        for sx in range(ANTIALIAS_SAMPLES):
+            offset_x = (sx + 0.5) / ANTIALIAS_SAMPLES - 0.5
+            offset_y = (sy + 0.5) / ANTIALIAS_SAMPLES - 0.5
+            hits += create_mask(height, width, mask_type, offset_x, offset_y, top, bottom)
 
-    # Create a circular mask
-    Y, X = np.ogrid[:height, :width]
-    distance_from_center = np.sqrt((X - center_x) ** 2 + (Y - center_y) ** 2)
-    mask = distance_from_center <= radius
+    hits *= 255
+    hits += samples // 2
+    hits //= samples
+    return hits.astype(np.uint8)
 
-    # Apply the mask to the original image
-    masked_image = np.zeros_like(image)
-    masked_image[mask] = image[mask]
+def create_circular_mask(height: int, width: int, offset_x: float = 0.0, offset_y: float = 0.0,
+                         top: int = 0, bottom: int = None) -> np.ndarray:
+    """
+    Create a circular mask centered in the image.
 
-    return masked_image
+    :param height: Image height.
+    :param width: Image width.
+    :param offset_x: Horizontal subpixel offset of the sample point in each pixel.
+    :param offset_y: Vertical subpixel offset of the sample point in each pixel.
+    :param top: First row to create.
+    :param bottom: Row after the last one to create, the image height by default.
+    :return: Boolean mask (bottom - top, width).
+    """
+    center_y, center_x = height // 2, width // 2
+    radius = min(center_y, center_x)  # Radius of the circle
 
-def apply_heart_mask(image: np.ndarray) -> np.ndarray:
+    # Create a circular mask, comparing squared distances avoids a square root per pixel
+    Y, X = np.ogrid[top:height if bottom is None else bottom, :width]
+    distance_x = (X + (offset_x - center_x)) ** 2
+    distance_y = (Y + (offset_y - center_y)) ** 2
+    return distance_x + distance_y <= radius ** 2
+
+def create_heart_mask(height: int, width: int, offset_x: float = 0.0, offset_y: float = 0.0,
+                      top: int = 0, bottom: int = None) -> np.ndarray:
     """
-    Apply a heart-shaped mask to a color image.
+    Create a heart-shaped mask centered in the image.
 
-    :param image: Color image (height, width, 3).
-    :return: Image with a heart-shaped mask.
+    :param height: Image height.
+    :param width: Image width.
+    :param offset_x: Horizontal subpixel offset of the sample point in each pixel.
+    :param offset_y: Vertical subpixel offset of the sample point in each pixel.
+    :param top: First row to create.
+    :param bottom: Row after the last one to create, the image height by default.
+    :return: Boolean mask (bottom - top, width).
     """
-    height, width = image.shape[:2]
     center_y, center_x = height // 2, width // 2
     scale_factor = min(center_y, center_x) / 1.5  # Scale factor for heart size
 
-    Y, X = np.ogrid[:height, :width]
-    X = (X - center_x) / scale_factor
-    Y = (Y - center_y) / scale_factor
+    Y, X = np.ogrid[top:height if bottom is None else bottom, :width]
+    X = (X + (offset_x - center_x)) / scale_factor
+    Y = (Y + (offset_y - center_y)) / scale_factor
 
     # Parametric equation of a heart (simplified form)
-    heart_mask = ((X ** 2 + Y ** 2 - 1) ** 3 - X ** 2 * -1*(Y ** 3)) <= 0 # add -1 because of the inversion of the y-axis
-    # Apply the mask to the original image
-    masked_image = np.zeros_like(image)
-    masked_image[heart_mask] = image[heart_mask]
+    return ((X ** 2 + Y ** 2 - 1) ** 3 - X ** 2 * -1*(Y ** 3)) <= 0 # add -1 because of the inversion of the y-axis
 
-    return masked_image
+def apply_circular_mask(image: np.ndarray) -> np.ndarray:
+    """
+    Apply a circular mask to a color image.
+
+    :param image: Color image (height, width, 3).
+    :return: Image with a circular mask.
+    """
+    return apply_mask(image, MaskType.CIRCULAR)
+
+def apply_heart_mask(image: np.ndarray) -> np.ndarray:
+    """
+    Apply a heart-shaped mask to a color image.
+
+    :param image: Color image (height, width, 3).
+    :return: Image with a heart-shaped mask.
+    """
+    return apply_mask(image, MaskType.HEART)
@@ -1,12 +1,27 @@
+import threading
+from collections import OrderedDict
+from enum import Enum
 import numpy as np
+from tools.buffers import buffer_pool
+from tools.jobs import check_cancelled
 
-def rotate_function(rotation_matrix: np.ndarray, pos_x: int, pos_y: int):
+class Interpolation(Enum):
+    NEAREST = "Nearest"
+    BILINEAR = "Bilinear"
+
+# Memory of the coordinate maps kept for repeated rotations of same-size images
+COORDINATE_MAP_CACHE_BYTES = 256 * 1024 * 1024
+
+# Output pixels mapped and resampled per chunk of rows, which bounds the temporaries of both steps
+MAP_CHUNK_PIXELS = 1 << 16
+
+def rotate_function(rotation_matrix: np.ndarray, pos_x, pos_y):
     """
     Rotate a point around the origin (0, 0) by a given angle.
 
-    :param angle: Angle in degrees.
-    :param pos_x: X-coordinate of the point.
-    :param pos_y: Y-coordinate of the point.
+    :param rotation_matrix: 2x2 rotation matrix.
+    :param pos_x: X-coordinate of the point, or a 1D array of X-coordinates.
+    :param pos_y: Y-coordinate of the point, or a 1D array of Y-coordinates.
     :return: Rotated point coordinates.
     """
     point = np.array([pos_x, pos_y])
@@ -28,47 +43,308 @@ def get_new_dimensions(width, height, angle):
     new_width = abs(width * np.cos(angle_rad)) + abs(height * np.sin(angle_rad))
     new_height = abs(width * np.sin(angle_rad)) + abs(height * np.cos(angle_rad))
     
-    return int(np.ceil(new_width)), int(np.ceil(new_height))
+    # Round away floating point noise first, e.g. cos(90) is 6e-17 rather than 0
+    return int(np.ceil(np.round(new_width, 6))), int(np.ceil(np.round(new_height, 6)))
+
+def right_angle_turns(angle: float):
+    """
+    Find how many quarter turns an angle is, if it is a multiple of 90 degrees.
+    
+    :param angle: Angle in degrees.
+    :return: Number of counterclockwise quarter turns in [0, 3], or None if the angle is not a multiple of 90.
+    """
+    turns = angle / 90
+    if abs(turns - round(turns)) > 1e-9:
+        return None
+    return int(round(turns)) % 4
+
+def rotate_right_angle(image: np.ndarray, turns: int) -> np.ndarray:
+    """
+    Rotate an image counterclockwise by a whole number of quarter turns, without resampling.
+    
+    :param image: Input image as a NumPy array (height, width, 3).
+    :param turns: Number of counterclockwise quarter turns.
+    :return: Rotated image; this is a view of the input, not a copy.
+    """
+    # A quarter turn is a transpose plus a flip, so every pixel is moved exactly
+    return np.rot90(image, turns % 4)
+
+def sampling_map(orig_x: np.ndarray, orig_y: np.ndarray, first: int, height: int, width: int,
+                 index_dtype, interpolation: Interpolation) -> tuple:
+    """
+    Turn the source coordinates of a chunk of output pixels into the indices and weights used to resample.
+
+    :param orig_x: Source X-coordinate of every output pixel of the chunk.
+    :param orig_y: Source Y-coordinate of every output pixel of the chunk.
+    :param first: Flat index of the first output pixel of the chunk.
+    :param height: Source image height.
+    :param width: Source image width.
+    :param index_dtype: Integer type of the indices, int32 unless the images are too large for it.
+    :param interpolation: Sampling method.
+    :return: For NEAREST, (target, source): flat indices of the covered output pixels and of the source
+             pixels they copy. For BILINEAR, (target, base, fx, fy): flat indices of the covered output pixels,
+             flat indices of the top-left neighbour in the source padded by one zero pixel on every side,
+             and the float32 horizontal and vertical interpolation weights. The arrays are read-only.
+    """
 
-def rotate_image(image: np.ndarray, angle: float):
+    if interpolation == Interpolation.NEAREST:
+        source_x = np.floor(orig_x + 0.5).astype(index_dtype)
+        source_y = np.floor(orig_y + 0.5).astype(index_dtype)
+        inside = (source_x >= 0) & (source_x < width) & (source_y >= 0) & (source_y < height)
+        target = (np.flatnonzero(inside) + first).astype(index_dtype)
+        source = source_y[inside] * width + source_x[inside]
+        maps = (target, source)
+    elif interpolation == Interpolation.BILINEAR:
+        # Pixels partly overlapping the source blend with the zero border of the padded source
+        x0 = np.floor(orig_x)
+        y0 = np.floor(orig_y)
+        inside = (x0 >= -1) & (x0 < width) & (y0 >= -1) & (y0 < height)
+        x0 = x0[inside]
+        y0 = y0[inside]
+        target = (np.flatnonzero(inside) + first).astype(index_dtype)
+        base = (y0 + 1).astype(index_dtype) * (width + 2) + (x0 + 1).astype(index_dtype)
+        fx = (orig_x[inside] - x0).astype(np.float32)
+        fy = (orig_y[inside] - y0).astype(np.float32)
+        maps = (target, base, fx, fy)
+    else:
+        raise ValueError(f"Invalid interpolation: {interpolation}")
+
+    # Cached maps are shared between calls
+    for array in maps:
+        array.setflags(write=False)
+    return maps
+
+def inverse_map(height: int, width: int, new_height: int, new_width: int, inverse: np.ndarray,
+                interpolation: Interpolation) -> tuple:
+    """
+    Compute where every pixel of the output canvas samples the source image, one chunk of rows at a time.
+
+    :param height: Source image height.
+    :param width: Source image width.
+    :param new_height: Output image height.
+    :param new_width: Output image width.
+    :param inverse: 2x3 transform from output coordinates relative to the output center to source coordinates.
+    :param interpolation: Sampling method.
+    :return: Tuple of chunk maps, see sampling_map.
+    """
+    index_dtype = np.int32 if (height + 2) * (width + 2) < 2**31 and new_height * new_width < 2**31 else np.int64
+    rows_per_chunk = max(1, MAP_CHUNK_PIXELS // max(new_width, 1))
+
+    # The grid is broadcast from a row and a column of coordinates instead of being materialized.
+    # Coordinates stay float64 within a chunk, so nearest-neighbour rounding is not affected
+    rel_x = np.arange(new_width, dtype=np.int32) - np.int32(new_width // 2)
+    x_terms = (inverse[0, 0] * rel_x, inverse[1, 0] * rel_x)
+
+    chunks = []
+    for start in range(0, new_height, rows_per_chunk):
+        rel_y = np.arange(start, min(start + rows_per_chunk, new_height), dtype=np.int32)[:, np.newaxis]
+        rel_y -= np.int32(new_height // 2)
+        orig_x = x_terms[0] + inverse[0, 1] * rel_y
+        orig_x += inverse[0, 2]
+        orig_y = x_terms[1] + inverse[1, 1] * rel_y
+        orig_y += inverse[1, 2]
+        chunks.append(sampling_map(orig_x.ravel(), orig_y.ravel(), start * new_width, height, width,
+                                   index_dtype, interpolation))
+    return tuple(chunks)
+
+class CoordinateMapCache:
+    """
+    Least-recently-used cache of coordinate maps, bounded by their memory rather than their number, so a
+    few rotations of very large images cannot hold gigabytes of maps.
+    """
+
+    def __init__(self, budget_bytes: int = COORDINATE_MAP_CACHE_BYTES):
+        """
+        :param budget_bytes: Maximum memory of the cached maps; maps larger than this are not cached.
+        """
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._maps)
+
+    def get(self, key: tuple, build) -> tuple:
+        """
+        Look a map up, building and caching it if needed.
+
+        :param key: Hashable description of the map.
+        :param build: Function without arguments that builds the map.
+        :return: The map.
+        """
+        with self._lock:
+            maps = self._maps.get(key)
+            if maps is not None:
+                self._maps.move_to_end(key)
+                return maps
+
+        maps = build()
+        nbytes = map_nbytes(maps)
+        if nbytes > self.budget_bytes:
+            return maps
+        with self._lock:
+            if key not in self._maps:
+                self._maps[key] = maps
+                self.nbytes += nbytes
+            while self.nbytes > self.budget_bytes:
+                _, evicted = self._maps.popitem(last=False)
+                self.nbytes -= map_nbytes(evicted)
+        return maps
+
+    def clear(self):
+        """Drop every cached map."""
+        with self._lock:
+            self._maps.clear()
+            self.nbytes = 0
+
+def map_nbytes(maps: tuple) -> int:
+    """Get the memory of the arrays of a map from inverse_map."""
+    return sum(array.nbytes for chunk in maps for array in chunk)
+
+# Maps shared by rotate_image and warp_affine
+coordinate_map_cache = CoordinateMapCache()
+
+def resample(image: np.ndarray, maps: tuple, new_height: int, new_width: int, interpolation: Interpolation) -> np.ndarray:
+    """
+    Build an output image by sampling the source image through a map from sampling_map.
+
+    :param image: Input image as a NumPy array (height, width, 3).
+    :param maps: Chunk maps returned by inverse_map.
+    :param new_height: Output image height.
+    :param new_width: Output image width.
+    :param interpolation: Sampling method the map was built for.
+    :return: Resampled image; output pixels that fall outside the source are black.
+    """
+    height, width = image.shape[:2]
+    channels = image.shape[2:]
+
+    # Create an empty output image with new dimensions, viewed as one row of channels per pixel
+    resampled_image = np.zeros((new_height, new_width) + channels, dtype=image.dtype)
+    output = resampled_image.reshape(new_height * new_width, -1)
+
+    if interpolation == Interpolation.NEAREST:
+        pixels = image.reshape(height * width, -1)
+        for target, source in maps:
+            check_cancelled()
+            output[target] = pixels[source]
+        return resampled_image
+
+    # The source padded by one zero pixel on every side, in a pooled buffer
+    padded_image = buffer_pool.take((height + 2, width + 2) + channels, image.dtype)
+    padded_image[1:-1, 1:-1] = image
+    padded_image[[0, -1]] = 0
+    padded_image[:, [0, -1]] = 0
+    source = padded_image.reshape((height + 2) * (width + 2), -1)
+    for target, base, fx, fy in maps:
+        check_cancelled()
+        fx = fx[:, None]
+        fy = fy[:, None]
+
+        # Blend the four neighbours: first along x on the two rows, then along y
+        top = source[base].astype(np.float32)
+        top += (source[base + 1] - top) * fx
+        bottom = source[base + (width + 2)].astype(np.float32)
+        bottom += (source[base + (width + 3)] - bottom) * fx
+        top += (bottom - top) * fy
+
+        if np.issubdtype(image.dtype, np.integer):
+            info = np.iinfo(image.dtype)
+            np.rint(top, out=top)
+            np.clip(top, info.min, info.max, out=top)
+        output[target] = top
+    buffer_pool.release(padded_image)
+    return resampled_image
+
+def rotation_map(height: int, width: int, angle: float, interpolation: Interpolation) -> tuple:
+    """
+    Compute where every pixel of the rotated canvas samples the source image (inverse mapping).
+    Results are cached, so rotating more images of the same size by the same angle skips this work.
+
+    :param height: Source image height.
+    :param width: Source image width.
+    :param angle: Angle in degrees for rotation.
+    :param interpolation: Sampling method.
+    :return: Sampling map, see inverse_map.
+    """
+    def build():
+        new_width, new_height = get_new_dimensions(width, height, angle)
+        angle_rad = np.radians(angle)
+
+        # Rotate the output coordinates, relative to the center of the new image, around the center of the original
+        inverse = np.array([[np.cos(angle_rad), -np.sin(angle_rad), width // 2],
+                            [np.sin(angle_rad), np.cos(angle_rad), height // 2]])
+        return inverse_map(height, width, new_height, new_width, inverse, interpolation)
+
+    return coordinate_map_cache.get(("rotation", height, width, angle, interpolation), build)
+
+def rotate_image(image: np.ndarray, angle: float, interpolation: Interpolation = Interpolation.NEAREST):
     """
     Rotate an image by a given angle around its center, adjusting dimensions to fit.
 
     :param image: Input image as a NumPy array (height, width, 3).
     :param angle: Angle in degrees for rotation.
-    :return: Rotated image.
+    :param interpolation: Sampling method for angles that are not multiples of 90 degrees.
+    :return: Rotated image. Multiples of 90 degrees return a view of the input.
     """
-    height, width, _ = image.shape
+    turns = right_angle_turns(angle)
+    if turns is not None:
+        return rotate_right_angle(image, turns)
+
+    height, width = image.shape[:2]
     
     # Get the new dimensions after rotation
     new_width, new_height = get_new_dimensions(width, height, angle)
-    
-    # Find the center of the original and new image
-    center_x, center_y = width // 2, height // 2
-    new_center_x, new_center_y = new_width // 2, new_height // 2
 
-    # Create an empty output image with new dimensions
-    rotated_image = np.zeros((new_height, new_width, image.shape[2]), dtype=image.dtype)
-    angle_rad = np.radians(angle)
-    rotation_matrix = np.array([[np.cos(angle_rad), -np.sin(angle_rad)],
-                                 [np.sin(angle_rad), np.cos(angle_rad)]])
+    maps = rotation_map(height, width, float(angle), interpolation)
+    return resample(image, maps, new_height, new_width, interpolation)
 
-    # Iterate over each pixel in the output image
-    for y in range(new_height):
-        for x in range(new_width):
-            # Compute the coordinates relative to the center of the new image
-            rel_x = x - new_center_x
-            rel_y = y - new_center_y
+def get_affine_dimensions(width: int, height: int, matrix: np.ndarray):
+    """
+    Calculate the canvas size that fits an image after an affine transform, like get_new_dimensions does for rotations.
 
-            # Rotate the point using the rotate_function
-            orig_x, orig_y = rotate_function(rotation_matrix, rel_x, rel_y)
+    :param width: Original image width.
+    :param height: Original image height.
+    :param matrix: 3x3 forward transform about the image center.
+    :return: New width and height after the transform.
+    """
+    new_width = abs(width * matrix[0, 0]) + abs(height * matrix[0, 1])
+    new_height = abs(width * matrix[1, 0]) + abs(height * matrix[1, 1])
 
-            # Shift the rotated coordinates back to the original image space
-            orig_x = int(orig_x + center_x)
-            orig_y = int(orig_y + center_y)
+    return int(np.ceil(np.round(new_width, 6))), int(np.ceil(np.round(new_height, 6)))
+
+def affine_map(height: int, width: int, matrix: tuple, interpolation: Interpolation) -> tuple:
+    """
+    Compute where every pixel of the transformed canvas samples the source image (inverse mapping).
 
-            # If the new coordinates are within the bounds of the original image, assign the pixel
-            if 0 <= orig_x < width and 0 <= orig_y < height:
-                rotated_image[y, x] = image[orig_y, orig_x]
+    :param height: Source image height.
+    :param width: Source image width.
+    :param matrix: 3x3 forward transform about the image center, flattened to a tuple so it can be cached.
+    :param interpolation: Sampling method.
+    :return: Sampling map, see inverse_map.
+    """
+    def build():
+        forward = np.array(matrix).reshape(3, 3)
+        new_width, new_height = get_affine_dimensions(width, height, forward)
+
+        # Output pixels are mapped back through the inverse transform
+        inverse = np.linalg.inv(forward)[:2]
+        inverse[:, 2] += (width // 2, height // 2)
+        return inverse_map(height, width, new_height, new_width, inverse, interpolation)
+
+    return coordinate_map_cache.get(("affine", height, width, matrix, interpolation), build)
+
+def warp_affine(image: np.ndarray, matrix: np.ndarray, interpolation: Interpolation = Interpolation.NEAREST) -> np.ndarray:
+    """
+    Apply an affine transform to an image in a single resampling pass, adjusting dimensions to fit.
+
+    :param image: Input image as a NumPy array (height, width, 3).
+    :param matrix: 3x3 forward transform of coordinates relative to the image center (y pointing down).
+    :param interpolation: Sampling method.
+    :return: Transformed image.
+    """
+    height, width = image.shape[:2]
+    new_width, new_height = get_affine_dimensions(width, height, matrix)
 
-    return rotated_image
\ No newline at end of file
+    maps = affine_map(height, width, tuple(np.asarray(matrix, dtype=np.float64).ravel()), interpolation)
+    return resample(image, maps, new_height, new_width, interpolation)
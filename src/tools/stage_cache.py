@@ -0,0 +1,201 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+# Default memory budget of the cached stage outputs
+STAGE_CACHE_BYTES = 512 * 1024 * 1024
+
+# Size of the cache keys in bytes (blake2b digest)
+KEY_BYTES = 16
+
+def chain_key(parent: str, step: str) -> str:
+    """
+    Derive the key of a stage output from the key of its input and a description of the stage.
+
+    :param parent: Key of the input image.
+    :param step: Stage name and parameters, e.g. the repr of the stage.
+    :return: Hex key.
+    """
+    return hashlib.blake2b(f"{parent}|{step}".encode(), digest_size=KEY_BYTES).hexdigest()
+
+def base_buffer(image: np.ndarray) -> np.ndarray:
+    """
+    Find the array that owns the memory of an image, following the chain of arrays it is a view of.
+
+    :param image: Any array.
+    :return: The last array of the chain; the image itself if it owns its memory.
+    """
+    while isinstance(image.base, np.ndarray):
+        image = image.base
+    return image
+
+def is_immutable(image: np.ndarray) -> bool:
+    """
+    Check that the pixels of an image cannot be changed through it or through any array it is a view of.
+
+    :param image: Any array.
+    :return: True if every array of the chain is read-only and the last one owns its memory.
+    """
+    while True:
+        if image.flags.writeable:
+            return False
+        if image.base is None:
+            return True
+        if not isinstance(image.base, np.ndarray):
+            # Memory of another object, e.g. a memory map, may change without numpy knowing
+            return False
+        image = image.base
+
+class StageCache:
+    """
+    Content-addressed cache of pipeline stage outputs, bounded in bytes with a least-recently-used policy.
+
+    An image is identified by a hash of its shape, type and pixels. The output of a stage is keyed by the
+    key of its input chained with the stage name and parameters, so equal inputs through equal stages
+    share an entry however the input was produced, and a pipeline can resume from the deepest stage
+    whose output is already cached.
+
+    Cached images are made read-only, since they are shared by every later hit. Their keys are
+    remembered, so a cached image fed back into a pipeline is not hashed again. Views sharing a buffer,
+    e.g. a quarter turn of a cached image, are charged to the budget once.
+
+    Usage:
+        cache = StageCache()
+        pipeline = Pipeline(stages, cache=cache)
+        pipeline(image)
+        pipeline(image)  # returns the cached result
+        cache.stats()
+    """
+
+    def __init__(self, budget_bytes: int = STAGE_CACHE_BYTES):
+        """
+        :param budget_bytes: Maximum memory of the cached images; the least recently used are evicted beyond it.
+        """
+        self.budget_bytes = budget_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._buffers = {}  # id of a buffer behind cached images -> [buffer, number of entries using it]
+        self._keys = {}  # id of a cached immutable image -> (weak reference, key)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def fingerprint(self, image: np.ndarray) -> str:
+        """
+        Get the content key of an image.
+
+        :param image: Any image.
+        :return: Hex key of the shape, type and pixels; remembered for the images the cache stored.
+        """
+        with self._lock:
+            known = self._keys.get(id(image))
+        if known is not None and known[0]() is image and is_immutable(image):
+            return known[1]
+
+        hasher = hashlib.blake2b(f"{image.shape}{image.dtype}".encode(), digest_size=KEY_BYTES)
+        hasher.update(np.ascontiguousarray(image).data)
+        return hasher.hexdigest()
+
+    def _remember(self, image: np.ndarray, key: str):
+        # Only images whose pixels cannot change behind the key are remembered. A read-only view of a
+        # writable array, e.g. np.rot90 of an image being edited, is not one of them
+        if not is_immutable(image):
+            return
+        identity = id(image)
+        with self._lock:
+            self._keys[identity] = (weakref.ref(image, lambda _: self._forget(identity)), key)
+
+    def _forget(self, identity: int):
+        with self._lock:
+            entry = self._keys.get(identity)
+            if entry is not None and entry[0]() is None:
+                del self._keys[identity]
+
+    def get(self, key: str):
+        """
+        Look an output up, counting a hit or a miss.
+
+        :param key: Key from chain_key.
+        :return: The cached read-only image, or None.
+        """
+        return self.get_deepest([key])[1]
+
+    def get_deepest(self, keys) -> tuple:
+        """
+        Look up the outputs of successive stages and find the last one cached, counting a single hit or miss.
+
+        :param keys: Keys from chain_key, first stage to last.
+        :return: (index, image) of the deepest cached output, or (-1, None) if none is cached.
+        """
+        with self._lock:
+            for index in range(len(keys) - 1, -1, -1):
+                image = self._entries.get(keys[index])
+                if image is not None:
+                    self._entries.move_to_end(keys[index])
+                    self.hits += 1
+                    return index, image
+            self.misses += 1
+            return -1, None
+
+    def put(self, key: str, image: np.ndarray) -> np.ndarray:
+        """
+        Store an output, evicting the least recently used ones to stay within the budget.
+
+        :param key: Key from chain_key.
+        :param image: Output of the stage; made read-only. Images whose buffer is larger than the budget
+                      are not stored.
+        :return: The image.
+        """
+        buffer = base_buffer(image)
+        if buffer.nbytes > self.budget_bytes:
+            return image
+        image.setflags(write=False)
+        self._remember(image, key)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return image
+            self._entries[key] = image
+            self._acquire(buffer)
+            while self.nbytes > self.budget_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._release(base_buffer(evicted))
+                self.evictions += 1
+        return image
+
+    def _acquire(self, buffer: np.ndarray):
+        # Views of a buffer that is already cached add nothing to the memory held
+        user = self._buffers.get(id(buffer))
+        if user is None:
+            self._buffers[id(buffer)] = [buffer, 1]
+            self.nbytes += buffer.nbytes
+        else:
+            user[1] += 1
+
+    def _release(self, buffer: np.ndarray):
+        user = self._buffers[id(buffer)]
+        user[1] -= 1
+        if user[1] == 0:
+            del self._buffers[id(buffer)]
+            self.nbytes -= buffer.nbytes
+
+    def clear(self):
+        """Drop every cached image; the statistics are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._buffers.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        """Get the hit, miss and eviction counts, the hit rate, and the number and memory of the cached images."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self._entries),
+                    "nbytes": self.nbytes}
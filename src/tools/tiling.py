@@ -0,0 +1,277 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+import numpy as np
+from tools.compiled import single_threaded
+from tools.blur import apply_blur, select_blur_method, BlurType
+from tools.grayscale import rgb_to_grayscale
+from tools.image_filter_color import apply_outline, sobel_magnitude, FilterType
+from tools.reshape import create_coverage_mask, create_mask, multiply_by_mask
+from tools.pipeline import Pipeline, BlurStage, FilterStage, MaskStage, RotateStage
+from tools.jobs import check_cancelled
+
+# Default memory budget for the strips processed at once, temporaries included
+TILE_BUDGET_BYTES = 256 * 1024 * 1024
+
+# Working memory per input sample while a strip is processed: the blurs pad the strip and keep
+# float32 intermediates (two buffers and a padded copy), which dominates the uint8 input and output
+WORKING_BYTES_PER_SAMPLE = 24
+
+# With several workers, strips are made small enough that each worker gets at least this many
+STRIPS_PER_WORKER = 2
+
+# The recursive Gaussian has an infinite impulse response, and the start-up transient of the recursion at a
+# strip edge only stops changing the rounded result after about this many sigmas
+RECURSIVE_HALO_SIGMAS = 16
+
+def open_image(path: str, shape: tuple = None, dtype=np.uint8) -> np.ndarray:
+    """
+    Open an image stored on disk as a read-only memory map, without loading it.
+
+    :param path: A .npy file, or a raw file of pixels in row-major (height, width, channels) order.
+    :param shape: Shape of a raw file; .npy files store their own.
+    :param dtype: Pixel type of a raw file.
+    :return: Read-only memory-mapped image.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    if shape is None:
+        raise ValueError("The shape of a raw image file must be given")
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+def create_image(path: str, shape: tuple, dtype=np.uint8) -> np.ndarray:
+    """
+    Create an image on disk as a writable memory map.
+
+    :param path: A .npy file, or any other name for a raw file.
+    :param shape: Shape of the image.
+    :param dtype: Pixel type.
+    :return: Writable memory-mapped image.
+    """
+    if path.endswith(".npy"):
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+def stage_halo(stage) -> int:
+    """
+    Get the number of rows a stage reads above and below each output row.
+
+    :param stage: Pipeline stage.
+    :return: Halo in rows; 0 for pointwise stages.
+    """
+    if isinstance(stage, BlurStage):
+        if stage.blur_type == BlurType.RECURSIVE_GAUSSIAN:
+            return int(np.ceil(RECURSIVE_HALO_SIGMAS * stage.sigma))
+        return stage.kernel_size // 2
+    if isinstance(stage, FilterStage) and stage.filter_type == FilterType.OUTLINE:
+        return 1  # 3x3 Sobel kernel
+    if isinstance(stage, RotateStage):
+        raise ValueError("Rotations move pixels across strips and cannot be processed in tiles")
+    return 0
+
+class TiledPipeline:
+    """
+    Runs pipeline stages over an image in horizontal strips, so images larger than memory can be processed
+    from a memory-mapped source straight into a memory-mapped output.
+
+    Each strip is read with enough extra rows (the halo) above and below for every neighborhood stage, so
+    the result matches processing the whole image. The outline filter normalizes by the largest gradient of
+    the whole image, which is found in a first pass.
+
+    Strips are independent, so they are processed on a thread pool and written into the shared output.
+    The NumPy, OpenCV and compiled kernels release the GIL, and the compiled kernels run serially in each
+    worker so the cores are not oversubscribed. The result is the same for any number of workers.
+
+    Usage:
+        tiled = TiledPipeline([BlurStage(BlurType.GAUSSIAN, 25), MaskStage(MaskType.HEART)])
+        source = open_image("scan.npy")
+        output = create_image("result.npy", tiled.output_shape(source.shape))
+        tiled(source, output)
+    """
+
+    def __init__(self, stages, tile_bytes: int = TILE_BUDGET_BYTES, workers: int = None, strip_rows: int = None):
+        """
+        :param stages: Pipeline stages, first to last. Rotations are not supported.
+        :param tile_bytes: Memory budget for the strips processed at once and their temporaries.
+        :param workers: Number of strips processed in parallel, the number of CPUs if not given.
+        :param strip_rows: Rows per strip, instead of the largest number that fits the budget.
+        """
+        self.stages = tuple(stages)
+        self.halos = [stage_halo(stage) for stage in self.stages]
+        self.tile_bytes = tile_bytes
+        self.workers = workers or os.cpu_count() or 1
+        self.strip_rows = strip_rows
+
+    def output_shape(self, shape: tuple) -> tuple:
+        """
+        Get the shape of the result for an input shape.
+
+        :param shape: Input shape (height, width, 3) or (height, width).
+        :return: (height, width) for a grayscale result, else (height, width, 3).
+        """
+        channels = Pipeline(self.stages).output_channels(shape[2] if len(shape) == 3 else 1)
+        return tuple(shape[:2]) if channels == 1 else tuple(shape[:2]) + (3,)
+
+    def rows_per_strip(self, height: int, width: int, channels: int, halo: int) -> int:
+        """
+        Get the number of output rows per strip: what fits the memory budget of one worker, and with
+        several workers small enough to keep all of them busy.
+
+        :param height: Image height.
+        :param width: Image width.
+        :param channels: Largest number of channels the strip has between stages.
+        :param halo: Extra rows read above and below the strip.
+        :return: Rows per strip, at least 1.
+        :raises ValueError: If the halo alone fills the budget of a worker, e.g. a recursive Gaussian with a large
+                            sigma, so even a strip of one row would exceed it.
+        """
+        if self.strip_rows:
+            return self.strip_rows
+        row_bytes = width * channels * WORKING_BYTES_PER_SAMPLE
+        rows = self.tile_bytes // self.workers // row_bytes - 2 * halo
+        if rows < 1:
+            needed = (1 + 2 * halo) * row_bytes * self.workers
+            raise ValueError(f"A tile budget of {self.tile_bytes} bytes is too small for strips with a halo of "
+                             f"{halo} rows: {self.workers} worker(s) need at least {needed} bytes")
+        if self.workers > 1:
+            rows = min(rows, -(-height // (STRIPS_PER_WORKER * self.workers)))
+        return max(1, rows)
+
+    def __call__(self, source: np.ndarray, output: np.ndarray) -> np.ndarray:
+        """
+        Run the stages over the whole image.
+
+        :param source: Input image (height, width, 3) or (height, width), e.g. from open_image.
+        :param output: Output image of the shape given by output_shape, e.g. from create_image.
+        :return: The output.
+        """
+        # Settings that depend on the whole image are found before the strips are processed:
+        # the blur method for the full image size, so every strip rounds the same way (and the cost model
+        # queries the kernel threads here, not from a worker), and the normalization of outline thresholds
+        settings = {}
+        for index, stage in enumerate(self.stages):
+            if isinstance(stage, BlurStage):
+                settings[index] = select_blur_method(source.shape, stage.blur_type, stage.kernel_size)
+            elif isinstance(stage, FilterStage) and stage.filter_type == FilterType.OUTLINE:
+                settings[index] = self._max_magnitude(source, index, settings)
+
+        def write(top, bottom, strip):
+            output[top:bottom] = strip
+
+        self._map_strips(source, len(self.stages), settings, write)
+
+        if isinstance(output, np.memmap):
+            output.flush()
+        return output
+
+    def _max_magnitude(self, source: np.ndarray, index: int, settings: dict) -> float:
+        def strip_maximum(top, bottom, strip):
+            magnitude = sobel_magnitude(rgb_to_grayscale(strip))
+            first = min(top, 1)
+            return float(magnitude[first:first + bottom - top].max())
+
+        return max(self._map_strips(source, index, settings, strip_maximum, extra_halo=1))
+
+    def _map_strips(self, source: np.ndarray, count: int, settings: dict, function, extra_halo: int = 0) -> list:
+        """Call function(top, bottom, strip) on every strip with the first count stages applied, and
+        return the results in order; the strips keep extra_halo rows of their halo."""
+        height, width = source.shape[:2]
+        halo = sum(self.halos[:count]) + extra_halo
+
+        # Grayscale strips stay single-channel until a tone filter tints them
+        channels = widest = source.shape[2] if source.ndim == 3 else 1
+        for stage in self.stages[:count]:
+            channels = stage.output_channels(channels)
+            widest = max(widest, channels)
+        rows = self.rows_per_strip(height, width, widest, halo)
+        bounds = [(top, min(top + rows, height)) for top in range(0, height, rows)]
+
+        def task(top, bottom):
+            check_cancelled()
+            start = max(top - halo, 0)
+            stop = min(bottom + halo, height)
+
+            strip = np.array(source[start:stop])
+            for index in range(count):
+                strip = self._apply(index, strip, start, source.shape, settings)
+
+            # Rows near the ends of the strip saw the strip edge instead of their real neighbours
+            crop_top = max(top - extra_halo, 0) - start
+            crop_bottom = min(bottom + extra_halo, height) - start
+            return function(top, bottom, strip[crop_top:crop_bottom])
+
+        if self.workers == 1 or len(bounds) == 1:
+            return [task(top, bottom) for top, bottom in bounds]
+
+        def serial_task(top, bottom):
+            with single_threaded():
+                return task(top, bottom)
+
+        # Every task gets a copy of the caller's context, so cancellation reaches the workers
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(copy_context().run, serial_task, top, bottom) for top, bottom in bounds]
+            try:
+                return [future.result() for future in futures]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _apply(self, index: int, strip: np.ndarray, start: int, shape: tuple, settings: dict) -> np.ndarray:
+        stage = self.stages[index]
+        height, width = shape[:2]
+
+        if isinstance(stage, BlurStage):
+            return apply_blur(strip, stage.blur_type, stage.kernel_size, stage.sigma, settings[index])
+
+        if isinstance(stage, MaskStage):
+            # Masks are placed relative to the whole image, so only the rows of this strip are created
+            stop = start + strip.shape[0]
+            if stage.antialias:
+                mask = create_coverage_mask(height, width, stage.mask_type, start, stop)
+            else:
+                mask = create_mask(height, width, stage.mask_type, top=start, bottom=stop).view(np.uint8)
+            return multiply_by_mask(strip, mask, stage.antialias)
+
+        if isinstance(stage, FilterStage) and stage.filter_type == FilterType.OUTLINE:
+            return apply_outline(strip, settings[index])
+
+        return stage.apply(strip)
+
+def parallel_apply(image: np.ndarray, stages, workers: int = None, strip_rows: int = None) -> np.ndarray:
+    """
+    Run pipeline stages over an image in memory, with its strips processed on several cores.
+
+    :param image: Input image (height, width, 3) or (height, width).
+    :param stages: Pipeline stages, first to last. Rotations are not supported.
+    :param workers: Number of worker threads, the number of CPUs if not given.
+    :param strip_rows: Rows per strip, chosen from the image size and worker count if not given.
+    :return: Processed image, identical to Pipeline(stages)(image).
+    """
+    tiled = TiledPipeline(stages, workers=workers, strip_rows=strip_rows)
+    output = np.empty(tiled.output_shape(image.shape), dtype=image.dtype)
+    return tiled(image, output)
+
+def process_file(input_path: str, output_path: str, stages, tile_bytes: int = TILE_BUDGET_BYTES,
+                 shape: tuple = None, dtype=np.uint8, workers: int = None) -> np.ndarray:
+    """
+    Run pipeline stages over an image file in strips, writing the result to another file.
+
+    :param input_path: A .npy file, or a raw file of pixels (see open_image).
+    :param output_path: Output .npy file, or a raw file for any other name.
+    :param stages: Pipeline stages, first to last.
+    :param tile_bytes: Memory budget for a strip and its temporaries.
+    :param shape: Shape of a raw input file.
+    :param dtype: Pixel type of a raw input file.
+    :param workers: Number of strips processed in parallel, the number of CPUs if not given.
+    :return: The memory-mapped output.
+    """
+    source = open_image(input_path, shape, dtype)
+    tiled = TiledPipeline(stages, tile_bytes, workers)
+    output = create_image(output_path, tiled.output_shape(source.shape), source.dtype)
+    try:
+        return tiled(source, output)
+    except BaseException:
+        del output
+        os.remove(output_path)
+        raise
@@ -0,0 +1,130 @@
+import numpy as np
+from tools.rotate import Interpolation, rotate_image, warp_affine
+
+class TransformStack:
+    """
+    Accumulates rotations, scales, flips and translations as a single 3x3 matrix, so the image is only
+    resampled once, when its pixels are actually needed.
+
+    Coordinates are relative to the image center with y pointing down, and positive angles rotate
+    counterclockwise on screen like rotate_image.
+    """
+
+    def __init__(self):
+        self.matrix = np.eye(3)
+
+    def reset(self):
+        """Drop all recorded transforms."""
+        self.matrix = np.eye(3)
+
+    def copy(self) -> "TransformStack":
+        """Get an independent stack with the same recorded transforms."""
+        stack = TransformStack()
+        stack.matrix = self.matrix.copy()
+        return stack
+
+    def is_identity(self) -> bool:
+        """Check whether the recorded transforms cancel out."""
+        return np.allclose(self.matrix, np.eye(3), rtol=0, atol=1e-9)
+
+    def _append(self, matrix: np.ndarray):
+        # Later transforms act on the result of earlier ones
+        self.matrix = matrix @ self.matrix
+
+    def rotate(self, angle: float):
+        """
+        Record a rotation around the image center.
+
+        :param angle: Angle in degrees, counterclockwise.
+        """
+        angle_rad = np.radians(angle)
+        cos, sin = np.cos(angle_rad), np.sin(angle_rad)
+        self._append(np.array([[cos, sin, 0],
+                               [-sin, cos, 0],
+                               [0, 0, 1]]))
+
+    def scale(self, scale_x: float, scale_y: float = None):
+        """
+        Record a scale around the image center.
+
+        :param scale_x: Horizontal scale factor.
+        :param scale_y: Vertical scale factor, the same as scale_x if not given.
+        """
+        scale_y = scale_x if scale_y is None else scale_y
+        self._append(np.diag([scale_x, scale_y, 1.0]))
+
+    def flip_horizontal(self):
+        """Record a mirror image (left and right swapped)."""
+        self._append(np.diag([-1.0, 1.0, 1.0]))
+
+    def flip_vertical(self):
+        """Record an upside-down flip (top and bottom swapped)."""
+        self._append(np.diag([1.0, -1.0, 1.0]))
+
+    def translate(self, dx: float, dy: float):
+        """
+        Record a shift of the content within the canvas.
+
+        :param dx: Horizontal shift in pixels, to the right.
+        :param dy: Vertical shift in pixels, downwards.
+        """
+        self._append(np.array([[1, 0, dx],
+                               [0, 1, dy],
+                               [0, 0, 1]], dtype=np.float64))
+
+    def right_angle_decomposition(self):
+        """
+        Express the transform as an optional mirror followed by quarter turns, if that is exactly what it is.
+
+        :return: Tuple (flip, turns) with flip True if the image is mirrored first and turns the number of
+                 counterclockwise quarter turns, or None if the transform needs resampling.
+        """
+        if not np.allclose(self.matrix[:, 2], (0, 0, 1), rtol=0, atol=1e-9):
+            return None
+
+        quarter_turn = np.array([[0, 1], [-1, 0]])
+        for flip in (False, True):
+            candidate = np.diag([-1, 1]) if flip else np.eye(2)
+            for turns in range(4):
+                if np.allclose(self.matrix[:2, :2], candidate, rtol=0, atol=1e-9):
+                    return flip, turns
+                candidate = quarter_turn @ candidate
+        return None
+
+    def rotation_angle(self):
+        """
+        Get the angle of the transform, if it is a pure rotation.
+
+        :return: Angle in degrees, or None if the transform scales, flips or translates.
+        """
+        linear = self.matrix[:2, :2]
+        if (not np.allclose(self.matrix[:, 2], (0, 0, 1), rtol=0, atol=1e-9)
+                or not np.allclose(linear.T @ linear, np.eye(2), rtol=0, atol=1e-9)
+                or np.linalg.det(linear) < 0):
+            return None
+        return float(np.degrees(np.arctan2(linear[0, 1], linear[0, 0])))
+
+    def render(self, image: np.ndarray, interpolation: Interpolation = Interpolation.NEAREST,
+               scale: float = 1.0) -> np.ndarray:
+        """
+        Apply the recorded transforms to an image in a single pass.
+
+        :param image: Input image as a NumPy array (height, width, 3).
+        :param interpolation: Sampling method when resampling is needed.
+        :param scale: Size of the image relative to the one the transforms were recorded for,
+                      e.g. for a downscaled preview; translations are scaled to match.
+        :return: Transformed image. Mirrors and quarter turns return a view of the input.
+        """
+        # Exact cases move pixels without resampling, so e.g. four quarter turns cost nothing
+        decomposition = self.right_angle_decomposition()
+        if decomposition is not None:
+            flip, turns = decomposition
+            return np.rot90(image[:, ::-1] if flip else image, turns)
+
+        angle = self.rotation_angle()
+        if angle is not None:
+            return rotate_image(image, angle, interpolation)
+
+        matrix = self.matrix.copy()
+        matrix[:2, 2] *= scale
+        return warp_affine(image, matrix, interpolation)
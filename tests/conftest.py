@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The packages live in src/ and are run from there, so the tests import them the same way
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,74 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from linoshop.__main__ import main
+from linoshop.batch import output_path_for, run_batch, source_root
+from tools.blur import BlurType
+from tools.pipeline import BlurStage, Pipeline
+
+STAGES = [BlurStage(BlurType.BOX, 3)]
+
+def write_image(path, seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(str(path), np.random.default_rng(seed).integers(0, 256, (24, 32, 3), dtype=np.uint8))
+
+def test_batch_processes_and_resumes(tmp_path):
+    for index in range(3):
+        write_image(tmp_path / "in" / f"img{index}.png", index)
+    output_dir = tmp_path / "out"
+
+    summary = run_batch(str(tmp_path / "in"), str(output_dir), STAGES, workers=2, log=lambda line: None)
+    assert (summary["processed"], summary["skipped"], summary["failed"]) == (3, 0, 0)
+
+    # A second run skips the finished images unless asked to overwrite them
+    summary = run_batch(str(tmp_path / "in"), str(output_dir), STAGES, workers=2, log=lambda line: None)
+    assert (summary["processed"], summary["skipped"]) == (0, 3)
+    summary = run_batch(str(tmp_path / "in"), str(output_dir), STAGES, workers=2, overwrite=True, log=lambda line: None)
+    assert summary["processed"] == 3
+    assert not [name for name in os.listdir(output_dir) if ".partial" in name]
+
+def test_unreadable_images_are_reported(tmp_path):
+    write_image(tmp_path / "in" / "good.png", 0)
+    (tmp_path / "in" / "bad.png").write_bytes(b"not an image")
+    lines = []
+    summary = run_batch(str(tmp_path / "in"), str(tmp_path / "out"), STAGES, workers=1, log=lines.append)
+    assert (summary["processed"], summary["failed"]) == (1, 1)
+    assert any(line.startswith("FAILED") and "bad.png" in line for line in lines)
+
+def test_batch_command_converts_the_format(tmp_path):
+    write_image(tmp_path / "in" / "img0.bmp", 0)
+    assert main(["batch", str(tmp_path / "in" / "*.bmp"), str(tmp_path / "out"), "--grayscale",
+                 "--format", "png", "--workers", "1"]) == 0
+    assert os.listdir(tmp_path / "out") == ["img0.png"]
+
+def test_source_root():
+    assert source_root(os.path.join("photos", "**", "*.jpg")) == "photos"
+    assert source_root("*.png") == "."
+
+def test_output_mirrors_source_layout():
+    assert output_path_for(os.path.join("in", "a", "img0.png"), "out", ".jpg", "in") == os.path.join("out", "a", "img0.jpg")
+
+def test_same_names_in_different_folders(tmp_path):
+    write_image(tmp_path / "in" / "a" / "img0.png", 0)
+    write_image(tmp_path / "in" / "b" / "img0.png", 1)
+    output_dir = tmp_path / "out"
+
+    summary = run_batch(str(tmp_path / "in" / "**" / "*.png"), str(output_dir), STAGES, workers=2, log=lambda line: None)
+    assert summary["processed"] == 2
+    first = cv2.imread(str(output_dir / "a" / "img0.png"))
+    second = cv2.imread(str(output_dir / "b" / "img0.png"))
+    assert first is not None and second is not None and not np.array_equal(first, second)
+
+def test_colliding_outputs_are_refused(tmp_path):
+    write_image(tmp_path / "in" / "img0.png", 0)
+    write_image(tmp_path / "in" / "img0.bmp", 1)
+    with pytest.raises(ValueError):
+        run_batch(str(tmp_path / "in"), str(tmp_path / "out"), [], extension=".png", log=lambda line: None)
+
+# Kept last: running the kernels in this process starts their threads, and forking a pool after that can hang
+def test_batch_output_matches_the_pipeline(tmp_path):
+    write_image(tmp_path / "in" / "img0.png", 0)
+    run_batch(str(tmp_path / "in"), str(tmp_path / "out"), STAGES, workers=1, log=lambda line: None)
+    expected = Pipeline(STAGES)(cv2.imread(str(tmp_path / "in" / "img0.png")))
+    assert np.array_equal(cv2.imread(str(tmp_path / "out" / "img0.png")), expected)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from linoshop.benchmark import benchmark_cases, compare_results, load_results, reference_difference, run_benchmarks, \
+    save_results, synthetic_image, ONE_LEVEL
+
+CASES = benchmark_cases()
+
+@pytest.mark.parametrize("channels", [1, 3])
+@pytest.mark.parametrize("name, function, reference, tolerance", CASES, ids=[case[0] for case in CASES])
+def test_case_matches_reference(name, function, reference, tolerance, channels):
+    image = synthetic_image(61, 90, channels)
+    matches, difference = reference_difference(function(image), reference(image), tolerance)
+    assert matches, f"{name} differs from its reference by up to {difference}"
+
+def test_reference_difference_beyond_tolerance():
+    image = np.zeros((4, 4), dtype=np.uint8)
+    assert reference_difference(image, image + 1.0, ONE_LEVEL) == (True, 1.0)
+    assert not reference_difference(image, image + 2.0, ONE_LEVEL)[0]
+    assert not reference_difference(image, image[:2], ONE_LEVEL)[0]
+
+def test_synthetic_image_is_reproducible():
+    assert synthetic_image(20, 30, 1).shape == (20, 30)
+    assert (synthetic_image(20, 30, 3) == synthetic_image(20, 30, 3)).all()
+
+def test_run_records_every_case(tmp_path):
+    results = run_benchmarks(sizes=((16, 24),), channels=(3,), only="filter/", min_seconds=0, log=lambda line: None)
+    keys = [key for key in results["results"]]
+    assert keys and all(key.startswith("filter/") and key.endswith("/16x24x3") for key in keys)
+    assert all("digest" in entry and entry["min_seconds"] <= entry["seconds"] for entry in results["results"].values())
+
+    save_results(results, str(tmp_path / "baseline.json"))
+    assert load_results(str(tmp_path / "baseline.json")) == results
+
+def test_compare_results_flags_regressions():
+    entry = {"digest": "a", "seconds": 1.0, "min_seconds": 1.0}
+    baseline = {"results": {"same": entry, "slower": entry, "changed": entry, "broken": entry, "new-in-baseline": entry}}
+    current = {"results": {
+        "same": dict(entry, min_seconds=1.1),
+        "slower": dict(entry, min_seconds=1.5),
+        "changed": dict(entry, digest="b"),
+        "broken": {"error": "ValueError: bad shape"},
+        "only-now": entry,
+    }}
+    problems = dict(compare_results(current, baseline))
+    assert sorted(problems) == ["broken", "changed", "slower"]
+    assert problems["slower"].startswith("1.50x slower")
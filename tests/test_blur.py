@@ -0,0 +1,111 @@
+import cv2
+import numpy as np
+import pytest
+import tools.blur
+from tools.blur import (apply_blur, convolution, integral_image, next_fast_length, select_blur_method, separate_kernel,
+                        summed_area_box_blur, BlurType, ConvolutionMethod, BLUR_METHODS)
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (23, 31, 3), dtype=np.uint8)
+
+def direct_convolution(image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Reference: every output pixel as the sum of its reflect-padded window, in float64."""
+    pad_height, pad_width = kernel.shape[0] // 2, kernel.shape[1] // 2
+    padded = np.pad(image.astype(np.float64), ((pad_height, pad_height), (pad_width, pad_width), (0, 0)), mode="reflect")
+    output = np.zeros(image.shape)
+    for i in range(kernel.shape[0]):
+        for j in range(kernel.shape[1]):
+            output += kernel[i, j] * padded[i:i + image.shape[0], j:j + image.shape[1]]
+    return output
+
+def gaussian_kernel(size: int, sigma: float) -> np.ndarray:
+    kernel = np.exp(-(np.arange(size) - (size - 1) / 2) ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+def test_separate_kernel():
+    column, row = np.array([1.0, 2.0, 1.0]), np.array([1.0, 0.0, -1.0])
+    column_factor, row_factor = separate_kernel(np.outer(column, row))
+    assert np.allclose(np.outer(column_factor, row_factor), np.outer(column, row))
+    assert separate_kernel(np.array([[1.0, 0.0], [0.0, 1.0]])) is None
+
+def test_identity_factor_is_skipped():
+    kernel = np.zeros((3, 5))
+    kernel[:, 2] = [0.25, 0.5, 0.25]
+    column_factor, row_factor = separate_kernel(kernel)
+    assert row_factor is None and np.allclose(column_factor, [0.25, 0.5, 0.25])
+
+@pytest.mark.parametrize("blur_type, kernel", [
+    (BlurType.GAUSSIAN, np.outer(gaussian_kernel(7, 5), gaussian_kernel(7, 5))),
+    (BlurType.BOX, np.full((7, 7), 1 / 49)),
+    (BlurType.VERTICAL, np.full((7, 1), 1 / 7)),
+])
+def test_separable_blur_matches_direct_convolution(blur_type, kernel):
+    result = apply_blur(IMAGE, blur_type, 7)
+    assert result.shape == IMAGE.shape and result.dtype == np.uint8
+    # Results are truncated to whole levels, the reference keeps the fraction
+    assert np.abs(result - direct_convolution(IMAGE, kernel)).max() <= 1
+
+def test_non_separable_kernel_matches_direct_convolution():
+    kernel = np.array([[0.0, 0.2, 0.0], [0.2, 0.2, 0.2], [0.0, 0.2, 0.0]])
+    assert np.abs(convolution(IMAGE, kernel) - direct_convolution(IMAGE, kernel)).max() <= 1
+
+def test_integral_image():
+    table = integral_image(IMAGE)
+    assert table.shape == (24, 32, 3) and not table[0].any() and not table[:, 0].any()
+    assert np.array_equal(table[7, 9], IMAGE[:7, :9].sum(axis=(0, 1)))
+
+@pytest.mark.parametrize("passes", [1, 3])
+def test_summed_area_box_blur_matches_repeated_convolution(passes):
+    kernel = np.full((5, 5), 1 / 25)
+    expected = IMAGE.astype(np.float64)
+    for _ in range(passes):
+        expected = direct_convolution(expected, kernel)
+    assert np.abs(summed_area_box_blur(IMAGE, 5, passes) - expected).max() <= 1
+
+def test_next_fast_length():
+    assert [next_fast_length(n) for n in (1, 7, 11, 97, 1025)] == [1, 8, 12, 100, 1080]
+
+@pytest.mark.parametrize("blur_type, method", [(blur_type, method) for blur_type, methods in BLUR_METHODS.items()
+                                               for method in methods])
+def test_every_method_gives_the_same_blur(blur_type, method):
+    expected = apply_blur(IMAGE, blur_type, 7, method=ConvolutionMethod.SEPARABLE)
+    assert np.abs(apply_blur(IMAGE, blur_type, 7, method=method).astype(int) - expected).max() <= 1
+
+@pytest.mark.parametrize("blur_type, method", [(blur_type, method) for blur_type, methods in BLUR_METHODS.items()
+                                               for method in methods])
+def test_grayscale_blur_matches_each_channel(blur_type, method):
+    result = apply_blur(IMAGE[:, :, 1], blur_type, 7, method=method)
+    assert result.shape == IMAGE.shape[:2]
+    assert np.array_equal(result, apply_blur(IMAGE, blur_type, 7, method=method)[:, :, 1])
+
+def test_fft_convolution_of_non_separable_kernel():
+    kernel = np.random.default_rng(1).random((5, 7))
+    kernel /= kernel.sum()
+    result = convolution(IMAGE, kernel, ConvolutionMethod.FFT)
+    assert np.abs(result - direct_convolution(IMAGE, kernel)).max() <= 1
+
+def test_cost_model_picks_fft_for_large_kernels(monkeypatch):
+    monkeypatch.setattr(tools.blur, "get_thread_count", lambda: 1)
+    assert select_blur_method((240, 320, 3), BlurType.GAUSSIAN, 51) == ConvolutionMethod.FFT
+    assert select_blur_method((240, 320, 3), BlurType.GAUSSIAN, 3) == ConvolutionMethod.SEPARABLE
+
+def test_recursive_gaussian_keeps_flat_images():
+    flat = np.full((20, 30, 3), 77, dtype=np.uint8)
+    assert np.array_equal(apply_blur(flat, BlurType.RECURSIVE_GAUSSIAN, sigma=4), flat)
+
+@pytest.mark.parametrize("sigma, tolerance", [(1, 1), (2.5, 1), (5, 4), (12, 4)])
+def test_recursive_gaussian_approximates_gaussian(sigma, tolerance):
+    # Noise is the hardest case for the recursion; both extend the edges by replication
+    image = np.random.default_rng(2).integers(0, 256, (96, 96, 3), dtype=np.uint8)
+    result = apply_blur(image, BlurType.RECURSIVE_GAUSSIAN, sigma=sigma)
+    expected = cv2.GaussianBlur(image.astype(np.float64), (0, 0), sigma, borderType=cv2.BORDER_REPLICATE)
+    assert np.abs(result - expected).max() <= tolerance
+
+@pytest.mark.parametrize("sigma", [1, 2.5, 3, 5, 10, 20])
+def test_recursive_gaussian_impulse_response_has_the_requested_variance(sigma):
+    size = 2 * int(12 * sigma) + 1
+    impulse = np.zeros((1, size))
+    impulse[0, size // 2] = 1
+    response = apply_blur(impulse, BlurType.RECURSIVE_GAUSSIAN, sigma=sigma)[0]
+    offsets = np.arange(size) - size // 2
+    assert response.sum() == pytest.approx(1)
+    assert (response * offsets**2).sum() == pytest.approx(sigma**2, rel=0.02)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from tools.blur import apply_blur, reflect_pad, BlurType, ConvolutionMethod
+from tools.buffers import BufferPool, accumulation_dtype, get_accumulation_dtype, WORK_DTYPE
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (23, 31, 3), dtype=np.uint8)
+
+def test_released_arrays_are_reused():
+    pool = BufferPool()
+    first = pool.take((4, 5), np.float32)
+    pool.release(first)
+    assert pool.take((4, 5), np.float32) is first
+    assert pool.take((4, 5), np.float64) is not first
+    assert pool.stats() == {"reused": 1, "allocated": 2, "nbytes": 0}
+
+    with pool.scratch((4, 5), np.float32) as scratch:
+        assert scratch.shape == (4, 5) and scratch.flags.c_contiguous
+    assert pool.stats()["nbytes"] == scratch.nbytes
+
+def test_pool_frees_the_least_recently_released():
+    pool = BufferPool(budget_bytes=2 * 80)
+    arrays = [pool.take((10,), np.float64) for _ in range(3)]
+    pool.release(*arrays)
+    assert pool.nbytes == 160
+    assert pool.take((10,), np.float64) is arrays[2]
+    assert pool.take((10,), np.float64) is arrays[1]
+    pool.release(None, np.empty(100))
+    assert pool.nbytes == 0
+
+def test_accumulation_dtype_is_scoped():
+    assert get_accumulation_dtype() == WORK_DTYPE
+    with accumulation_dtype(np.float64):
+        assert get_accumulation_dtype() == np.float64
+    assert get_accumulation_dtype() == WORK_DTYPE
+
+@pytest.mark.parametrize("pad_width", [((2, 3), (4, 1)), ((0, 0), (5, 5)), ((25, 1), (1, 40))])
+def test_reflect_pad_matches_numpy(pad_width):
+    expected = np.pad(IMAGE, pad_width + ((0, 0),), mode="reflect")
+    out = np.empty(expected.shape, np.float32)
+    assert reflect_pad(IMAGE, pad_width, out) is out
+    assert np.array_equal(out, expected)
+    assert np.array_equal(reflect_pad(IMAGE[:, :, 0], pad_width), expected[:, :, 0])
+
+@pytest.mark.parametrize("method", [ConvolutionMethod.SEPARABLE, ConvolutionMethod.FFT])
+def test_float32_blur_is_within_one_level_of_float64(method):
+    result = apply_blur(IMAGE, BlurType.GAUSSIAN, 9, method=method)
+    with accumulation_dtype(np.float64):
+        expected = apply_blur(IMAGE, BlurType.GAUSSIAN, 9, method=method)
+    assert np.abs(result.astype(int) - expected).max() <= 1
@@ -0,0 +1,36 @@
+import numpy as np
+from tools.compiled import convolve_2d, convolve_columns, convolve_rows, single_threaded
+
+rng = np.random.default_rng(0)
+IMAGE = rng.random((12, 17, 2))
+
+def test_convolve_2d():
+    kernel = rng.random((3, 5))
+    padded = np.pad(IMAGE, ((1, 1), (2, 2), (0, 0)), mode="reflect")
+    output = np.empty(IMAGE.shape)
+    convolve_2d(padded, kernel, output)
+
+    expected = sum(kernel[u, v] * padded[u:u + 12, v:v + 17] for u in range(3) for v in range(5))
+    assert np.allclose(output, expected)
+
+def test_convolve_columns_and_rows():
+    kernel = rng.random(5)
+    output = np.empty(IMAGE.shape)
+    convolve_columns(np.pad(IMAGE, ((2, 2), (0, 0), (0, 0)), mode="reflect"), kernel, output)
+    expected = np.apply_along_axis(lambda column: np.convolve(np.pad(column, 2, mode="reflect"), kernel[::-1], "valid"),
+                                   0, IMAGE)
+    assert np.allclose(output, expected)
+
+    convolve_rows(np.pad(IMAGE, ((0, 0), (2, 2), (0, 0)), mode="reflect"), kernel, output)
+    expected = np.apply_along_axis(lambda row: np.convolve(np.pad(row, 2, mode="reflect"), kernel[::-1], "valid"),
+                                   1, IMAGE)
+    assert np.allclose(output, expected)
+
+def test_single_threaded_kernels_give_the_same_result():
+    kernel = rng.random((3, 5))
+    padded = np.pad(IMAGE, ((1, 1), (2, 2), (0, 0)), mode="reflect")
+    parallel, serial = np.empty(IMAGE.shape), np.empty(IMAGE.shape)
+    convolve_2d(padded, kernel, parallel)
+    with single_threaded():
+        convolve_2d(padded, kernel, serial)
+    assert np.array_equal(parallel, serial)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from tools.cosine_similarity import cosine_similarity, cosine_similarity_matrix
+
+rng = np.random.default_rng(0)
+IMAGES = rng.integers(0, 256, (4, 30, 40, 3), dtype=np.uint8)
+
+def reference_similarity(v1, v2):
+    a = v1.reshape(-1).astype(np.float64)
+    b = np.resize(v2.reshape(-1), a.size).astype(np.float64)
+    norms = np.linalg.norm(a) * np.linalg.norm(b)
+    return a @ b / norms if norms else 0.0
+
+@pytest.mark.parametrize("chunk_size", [7, 1000, 1 << 20])
+def test_cosine_similarity_matches_reference(chunk_size):
+    assert cosine_similarity(IMAGES[0], IMAGES[1], chunk_size) == pytest.approx(reference_similarity(IMAGES[0], IMAGES[1]),
+                                                                                abs=1e-12)
+
+def test_smaller_second_image_is_repeated():
+    smaller = IMAGES[1][:10]
+    assert cosine_similarity(IMAGES[0], smaller, 1000) == pytest.approx(reference_similarity(IMAGES[0], smaller), abs=1e-12)
+
+def test_black_image_has_similarity_zero():
+    assert cosine_similarity(IMAGES[0], np.zeros_like(IMAGES[0])) == 0.0
+    assert cosine_similarity(IMAGES[0], IMAGES[0]) == pytest.approx(1.0)
+
+@pytest.mark.parametrize("chunk_bytes", [64, 1 << 26])
+def test_similarity_matrix_matches_pairwise_similarity(chunk_bytes):
+    images_b = list(IMAGES[:3]) + [np.zeros_like(IMAGES[0])]
+    matrix = cosine_similarity_matrix(IMAGES, images_b, chunk_bytes)
+    expected = [[reference_similarity(a, b) for b in images_b] for a in IMAGES]
+    assert matrix.shape == (4, 4)
+    assert np.allclose(matrix, expected, atol=1e-12)
+    assert np.allclose(cosine_similarity_matrix(IMAGES, chunk_bytes=chunk_bytes),
+                       cosine_similarity_matrix(IMAGES, IMAGES, chunk_bytes), atol=1e-12)
+
+def test_similarity_matrix_needs_images_of_one_size():
+    with pytest.raises(ValueError):
+        cosine_similarity_matrix(IMAGES, [IMAGES[0][:10]])
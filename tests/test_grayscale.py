@@ -0,0 +1,38 @@
+import cv2
+import numpy as np
+import pytest
+from tools.blur import BlurType
+from tools.grayscale import rgb_to_grayscale
+from tools.image_filter_color import FilterType
+from tools.pipeline import BlurStage, FilterStage, GrayscaleStage, MaskStage, Pipeline
+from tools.reshape import MaskType
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (40, 50, 3), dtype=np.uint8)
+
+def test_fixed_point_weights_round_the_float_formula():
+    gray = rgb_to_grayscale(IMAGE)
+    assert gray.shape == (40, 50) and gray.dtype == np.uint8
+    b, g, r = (IMAGE[:, :, channel].astype(np.float64) for channel in range(3))
+    assert np.abs(gray - (0.114 * b + 0.587 * g + 0.299 * r)).max() <= 1
+    assert np.array_equal(rgb_to_grayscale(np.full((2, 2, 3), 255, np.uint8)), np.full((2, 2), 255))
+
+def test_grayscale_input_is_returned_as_is():
+    gray = IMAGE[:, :, 0]
+    assert rgb_to_grayscale(gray) is gray
+
+def test_grayscale_stays_single_channel():
+    stages = [GrayscaleStage(), BlurStage(BlurType.GAUSSIAN, 5), FilterStage(FilterType.INVERT), MaskStage(MaskType.HEART)]
+    pipeline = Pipeline(stages)
+    result = pipeline(IMAGE)
+    assert result.shape == (40, 50) and pipeline.output_channels(3) == 1
+
+    # The same edits on the gray image expanded to three channels give three copies of the result
+    expanded = Pipeline(stages[1:])(cv2.cvtColor(rgb_to_grayscale(IMAGE), cv2.COLOR_GRAY2BGR))
+    assert all(np.array_equal(expanded[:, :, channel], result) for channel in range(3))
+
+@pytest.mark.parametrize("filter_type, channels", [(FilterType.WARM_TONE, 3), (FilterType.HIGH_CONTRAST, 1),
+                                                   (FilterType.OUTLINE, 1)])
+def test_filters_report_their_channels(filter_type, channels):
+    pipeline = Pipeline([GrayscaleStage(), FilterStage(filter_type)])
+    assert pipeline(IMAGE).ndim == (3 if channels == 3 else 2)
+    assert pipeline.output_channels(3) == channels
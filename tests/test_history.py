@@ -0,0 +1,109 @@
+import threading
+import time
+import numpy as np
+from tools.history import History
+from tools.jobs import JobScheduler
+
+def brighten(image: np.ndarray) -> np.ndarray:
+    return np.minimum(image.astype(np.int16) + 10, 255).astype(np.uint8)
+
+def edit_states(history: History, count: int, operation=brighten) -> list:
+    image = np.random.default_rng(0).integers(0, 200, (30, 40, 3), dtype=np.uint8)
+    states = [image]
+    history.reset(image)
+    for _ in range(count):
+        image = brighten(image)
+        states.append(image)
+        history.commit(image, operation)
+    return states
+
+def test_undo_and_redo_restore_every_state():
+    history = History(keyframe_interval=3)
+    states = edit_states(history, 7)
+    for expected in reversed(states[:-1]):
+        assert np.array_equal(history.undo(), expected)
+    assert history.undo() is None
+
+    for expected in states[1:]:
+        assert np.array_equal(history.redo(), expected)
+    assert history.redo() is None
+
+def test_operations_are_replayed_from_keyframes():
+    history = History(keyframe_interval=3)
+    edit_states(history, 7)
+    assert [entry.keyframe is not None for entry in history.entries] == [True, False, False, True, False, False, True, False]
+
+    # Without a known operation every state is a snapshot
+    history = History()
+    edit_states(history, 3, operation=None)
+    assert all(entry.keyframe is not None for entry in history.entries)
+
+def test_commit_after_undo_drops_the_redo_states():
+    history = History()
+    states = edit_states(history, 3)
+    history.undo()
+    history.undo()
+    history.commit(states[0])
+    assert len(history) == 3 and not history.can_redo()
+
+def test_oldest_states_are_dropped_beyond_the_budget():
+    history = History(keyframe_interval=1)
+    states = edit_states(history, 1)
+    history.budget_bytes = 3 * history.entries[0].nbytes
+    image = states[-1]
+    for _ in range(10):
+        # Noise compresses poorly, so every snapshot takes about the same memory
+        image = np.random.default_rng(len(history)).integers(0, 256, image.shape, dtype=np.uint8)
+        history.commit(image)
+    assert history.nbytes <= history.budget_bytes and len(history) < 12
+    assert np.array_equal(history.undo(), history.entries[history.index].decode())
+
+def test_restorer_leaves_the_current_state_alone():
+    history = History(keyframe_interval=3)
+    states = edit_states(history, 5)
+    restore = history.restorer(1)
+    assert history.index == 5
+
+    # Entries are captured when the restorer is made, so a later commit does not change its result
+    history.select(2)
+    history.commit(states[0])
+    assert np.array_equal(restore(), states[1])
+    assert len(history) == 4 and history.index == 3
+
+def test_next_state_is_replayed_on_the_current_image():
+    history = History(keyframe_interval=3)
+    states = edit_states(history, 2)
+    history.undo()
+    inputs = []
+    def recorded_brighten(image):
+        inputs.append(image)
+        return brighten(image)
+    history.entries[2].operation = recorded_brighten
+
+    assert np.array_equal(history.restorer(2, states[1])(), states[2])
+    assert len(inputs) == 1 and inputs[0] is states[1]
+
+def test_restorer_stops_when_its_job_is_cancelled():
+    history = History(keyframe_interval=4)
+    edit_states(history, 3)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+    def slow_brighten(image):
+        calls.append(image)
+        started.set()
+        release.wait(5)
+        return brighten(image)
+    for entry in history.entries[1:]:
+        entry.operation = slow_brighten
+
+    scheduler = JobScheduler()
+    results = []
+    scheduler.submit("history", history.restorer(3), on_done=results.append)
+    assert started.wait(5)
+    scheduler.cancel("history")
+    release.set()
+    while scheduler.busy:
+        time.sleep(0.01)
+    scheduler.poll()
+    # The operations after the one running when the job was cancelled are not replayed
+    assert len(calls) == 1 and results == []
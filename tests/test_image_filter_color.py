@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from tools.grayscale import rgb_to_grayscale
+from tools.image_filter_color import (apply_filter, apply_filter_chain, compose_luts, get_filter_lut, sobel_magnitude,
+                                      FilterType, FILTER_SETTINGS, LUT_FILTERS)
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (20, 30, 3), dtype=np.uint8)
+
+def reference_sobel(image: np.ndarray) -> np.ndarray:
+    """Sobel magnitude of an edge-padded image, in float64."""
+    p = np.pad(image.astype(np.float64), 1, mode="edge")
+    gx = (p[:-2, :-2] + 2 * p[1:-1, :-2] + p[2:, :-2]) - (p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:])
+    gy = (p[:-2, :-2] + 2 * p[:-2, 1:-1] + p[:-2, 2:]) - (p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:])
+    return np.floor(np.minimum(np.hypot(gx, gy), 255))
+
+def test_sobel_magnitude_matches_reference():
+    image = np.random.default_rng(0).integers(0, 256, (40, 33), dtype=np.uint8)
+    # Strips of 7 rows, the last one shorter
+    assert np.array_equal(sobel_magnitude(image, strip_height=7), reference_sobel(image))
+
+def test_outline_thresholds_normalized_edges():
+    image = np.random.default_rng(1).integers(0, 256, (20, 30, 3), dtype=np.uint8)
+    magnitude = reference_sobel(rgb_to_grayscale(image)).astype(np.float32)
+    expected = (magnitude * np.float32(255 / magnitude.max())).astype(np.uint8)
+    expected[expected <= 50] = 255
+
+    outline = apply_filter(image, FilterType.OUTLINE)
+    assert np.array_equal(outline.reshape(20, 30, -1)[:, :, 0], expected)
+
+@pytest.mark.parametrize("filter_type", LUT_FILTERS)
+def test_lookup_tables_match_the_filter_formula(filter_type):
+    settings = FILTER_SETTINGS[filter_type]
+    expected = np.clip(IMAGE * np.array(settings['scaling']) + settings['offset'], 0, 255).astype(np.uint8)
+    assert np.array_equal(apply_filter(IMAGE, filter_type), expected)
+
+def test_chain_matches_filters_one_after_another():
+    chain = [FilterType.WARM_TONE, FilterType.INVERT, FilterType.HIGH_CONTRAST]
+    expected = IMAGE
+    for filter_type in chain:
+        expected = apply_filter(expected, filter_type)
+    out = np.empty_like(IMAGE)
+    assert apply_filter_chain(IMAGE, chain, out) is out
+    assert np.array_equal(out, expected)
+    assert np.array_equal(compose_luts(get_filter_lut(FilterType.INVERT), get_filter_lut(FilterType.INVERT))[0],
+                          np.arange(256))
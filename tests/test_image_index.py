@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+import pytest
+from linoshop.__main__ import main
+from tools.image_index import ImageIndex, embed
+
+rng = np.random.default_rng(0)
+IMAGES = [cv2.GaussianBlur(rng.integers(0, 256, (32, 48, 3), dtype=np.uint8), (5, 5), 0) for _ in range(20)]
+IDS = [f"img{number}.png" for number in range(len(IMAGES))]
+
+def brighter(image):
+    return cv2.convertScaleAbs(image, alpha=0.8, beta=40)
+
+def test_embedding_ignores_brightness_and_contrast():
+    embedding = embed(IMAGES[0])
+    assert embedding.shape == (64,) and embedding.dtype == np.float32
+    assert np.linalg.norm(embedding) == pytest.approx(1)
+    assert embedding @ embed(brighter(IMAGES[0])) > 0.99
+    assert not embed(np.full((32, 48, 3), 7, np.uint8)).any()
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_query_finds_near_duplicates(tmp_path, dtype):
+    index = ImageIndex(str(tmp_path / "library.index"), dtype=dtype)
+    index.add(IDS, IMAGES)
+
+    results = index.query(brighter(IMAGES[5]), k=3)
+    assert len(results) == 3
+    assert results[0][0] == "img5.png" and results[0][1] > 0.99
+    assert results[1][1] <= results[0][1]
+    assert index.query(brighter(IMAGES[5]), k=3, threshold=0.95) == results[:1]
+
+def test_index_is_reopened_from_disk(tmp_path):
+    index = ImageIndex(str(tmp_path / "library.index"))
+    index.add(IDS[:12], IMAGES[:12])
+    index.add(IDS[12:], IMAGES[12:])
+
+    reopened = ImageIndex(str(tmp_path / "library.index"))
+    assert len(reopened) == len(IMAGES)
+    assert reopened.ids == IDS
+    assert reopened.query(IMAGES[17], k=1)[0][0] == "img17.png"
+
+def test_blocked_query_matches_whole_search(tmp_path, monkeypatch):
+    index = ImageIndex(str(tmp_path / "library.index"))
+    index.add(IDS, IMAGES)
+    queries = np.array([embed(image) for image in IMAGES[:4]])
+    expected = index.query_embeddings(queries, k=5)
+    monkeypatch.setattr("tools.image_index.BLOCK_ROWS", 3)
+    assert index.query_embeddings(queries, k=5) == expected
+
+def test_ids_cannot_contain_line_breaks(tmp_path):
+    index = ImageIndex(str(tmp_path / "library.index"))
+    index.add(IDS[:1], IMAGES[:1])
+    with pytest.raises(ValueError):
+        index.add(["bad\nid"], IMAGES[:1])
+    assert len(ImageIndex(str(tmp_path / "library.index"))) == 1
+
+def write_images(directory, count):
+    paths = []
+    for number in range(count):
+        path = str(directory / f"img{number}.png")
+        cv2.imwrite(path, IMAGES[number])
+        paths.append(path)
+    return paths
+
+def test_new_index_has_no_ids(tmp_path):
+    index = ImageIndex(str(tmp_path / "new.index"))
+    assert len(index) == 0
+    assert index.ids == []
+
+def test_index_add_on_fresh_directory(tmp_path):
+    paths = write_images(tmp_path, 3)
+    index_path = str(tmp_path / "library.index")
+
+    assert main(["index", "add", index_path, str(tmp_path / "*.png")]) == 0
+    assert sorted(ImageIndex(index_path).ids) == sorted(paths)
+
+    # Running again skips the images already indexed
+    assert main(["index", "add", index_path, str(tmp_path / "*.png")]) == 0
+    assert len(ImageIndex(index_path)) == 3
@@ -0,0 +1,89 @@
+import threading
+import time
+import pytest
+from tools.jobs import CancelToken, JobCancelled, JobScheduler, check_cancelled
+
+def poll_until(scheduler, condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "the jobs did not finish in time"
+        scheduler.poll()
+        time.sleep(0.01)
+
+def blocking_job(started, release):
+    def run(value):
+        started.set()
+        while not release.wait(0.01):
+            check_cancelled()
+        check_cancelled()
+        return value
+    return run
+
+def test_results_are_delivered_by_poll():
+    scheduler = JobScheduler()
+    results = []
+    scheduler.submit("render", lambda value: value * 2, 21, on_done=results.append)
+    poll_until(scheduler, lambda: results)
+    assert results == [42]
+    assert not scheduler.busy
+
+def test_errors_go_to_on_error():
+    scheduler = JobScheduler()
+    errors = []
+    scheduler.submit("render", lambda: 1 / 0, on_error=errors.append)
+    poll_until(scheduler, lambda: errors)
+    assert isinstance(errors[0], ZeroDivisionError)
+
+def test_newer_job_supersedes_the_running_one():
+    scheduler = JobScheduler()
+    started, release = threading.Event(), threading.Event()
+    results = []
+    scheduler.submit("render", blocking_job(started, release), "old", on_done=results.append)
+    assert started.wait(5)
+    scheduler.submit("render", lambda value: value, "new", on_done=results.append)
+    release.set()
+    poll_until(scheduler, lambda: results and not scheduler.busy)
+    assert results == ["new"]
+
+def test_jobs_with_other_keys_are_kept():
+    scheduler = JobScheduler()
+    started, release = threading.Event(), threading.Event()
+    results = []
+    scheduler.submit("render", blocking_job(started, release), "render", on_done=results.append)
+    assert started.wait(5)
+    scheduler.submit("save", lambda value: value, "save", on_done=results.append)
+    release.set()
+    poll_until(scheduler, lambda: len(results) == 2)
+    assert results == ["render", "save"]
+
+def test_cancelled_job_never_calls_back():
+    scheduler = JobScheduler()
+    started, release = threading.Event(), threading.Event()
+    results = []
+    scheduler.submit("render", blocking_job(started, release), "old", on_done=results.append)
+    assert started.wait(5)
+    scheduler.cancel("render")
+    release.set()
+    poll_until(scheduler, lambda: not scheduler.busy)
+    scheduler.poll()
+    assert results == []
+
+def test_oldest_pending_job_is_dropped():
+    scheduler = JobScheduler(max_pending=2)
+    started, release = threading.Event(), threading.Event()
+    results = []
+    scheduler.submit("blocker", blocking_job(started, release), None)
+    assert started.wait(5)
+    for key in ("a", "b", "c"):
+        scheduler.submit(key, lambda value: value, key, on_done=results.append)
+    release.set()
+    poll_until(scheduler, lambda: len(results) == 2 and not scheduler.busy)
+    assert results == ["b", "c"]
+
+def test_check_cancelled_outside_a_job_does_nothing():
+    check_cancelled()
+    token = CancelToken()
+    token.check()
+    token.cancel()
+    with pytest.raises(JobCancelled):
+        token.check()
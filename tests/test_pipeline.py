@@ -0,0 +1,92 @@
+import threading
+import tracemalloc
+import numpy as np
+import pytest
+from tools.blur import select_blur_method, BlurType, ConvolutionMethod
+from tools.buffers import BufferPool, buffer_pool
+from tools.image_filter_color import FilterType
+from tools.pipeline import compile_stages, Pipeline, PointwiseSegment, GrayscaleStage, BlurStage, FilterStage, \
+    MaskStage, RotateStage
+from tools.reshape import MaskType
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (64, 80, 3), dtype=np.uint8)
+
+STAGE_LISTS = [
+    [GrayscaleStage(), FilterStage(FilterType.COOL_TONE), MaskStage(MaskType.HEART), FilterStage(FilterType.INVERT)],
+    [FilterStage(FilterType.VINTAGE_TONE), BlurStage(BlurType.GAUSSIAN, 5), FilterStage(FilterType.HIGH_CONTRAST),
+     MaskStage(MaskType.CIRCULAR)],
+    [FilterStage(FilterType.INVERT), MaskStage(MaskType.HEART, antialias=True), FilterStage(FilterType.COOL_TONE)],
+    [GrayscaleStage(), BlurStage(BlurType.BOX, 3), FilterStage(FilterType.OUTLINE), FilterStage(FilterType.WARM_TONE)],
+]
+
+@pytest.mark.parametrize("stages", STAGE_LISTS)
+def test_fused_pipeline_matches_stages_one_at_a_time(stages):
+    expected = IMAGE
+    for stage in stages:
+        expected = stage.apply(expected)
+    assert np.array_equal(Pipeline(stages)(IMAGE), expected)
+
+def test_pointwise_stages_are_fused_between_neighborhood_stages():
+    segments = compile_stages([GrayscaleStage(), FilterStage(FilterType.COOL_TONE), MaskStage(MaskType.HEART),
+                               BlurStage(BlurType.GAUSSIAN), FilterStage(FilterType.INVERT),
+                               FilterStage(FilterType.WARM_TONE), FilterStage(FilterType.OUTLINE)])
+    assert [len(segment.stages) if isinstance(segment, PointwiseSegment) else type(segment).__name__
+            for segment in segments] == [3, "BlurStage", 2, "FilterStage"]
+
+def test_empty_pipeline_returns_the_input():
+    assert Pipeline([])(IMAGE) is IMAGE
+
+def test_scaled_pipeline_for_a_proxy():
+    pipeline = Pipeline([GrayscaleStage(), BlurStage(BlurType.GAUSSIAN, 25, 8), MaskStage(MaskType.HEART)])
+    proxy = pipeline.scaled(0.25)
+    assert proxy.stages[0] == GrayscaleStage() and proxy.stages[2] == MaskStage(MaskType.HEART)
+    # The kernel keeps its parity, so the blur stays centered
+    assert proxy.stages[1] == BlurStage(BlurType.GAUSSIAN, 7, 2.0)
+    assert pipeline.scaled(0.1).stages[1].kernel_size == 3
+
+def test_allocations_count_outputs_and_pool_misses():
+    pipeline = Pipeline([GrayscaleStage(), BlurStage(BlurType.GAUSSIAN, 5), FilterStage(FilterType.COOL_TONE),
+                         MaskStage(MaskType.HEART)])
+    buffer_pool.clear()
+    before = buffer_pool.stats()["allocated"]
+    pipeline(IMAGE)
+    assert pipeline.passes == 3
+    assert pipeline.allocations == 3 + buffer_pool.stats()["allocated"] - before
+
+    # Once the pool holds the blur's scratch arrays, only the output of each pass is allocated
+    pipeline(IMAGE)
+    assert pipeline.allocations == 3
+
+def test_allocations_account_for_the_memory_a_run_uses(monkeypatch):
+    # One thread makes the cost model pick the FFT for the large blur
+    monkeypatch.setattr("tools.blur.get_thread_count", lambda: 1)
+    image = np.random.default_rng(0).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+    assert select_blur_method(image.shape, BlurType.GAUSSIAN, 51) == ConvolutionMethod.FFT
+    for stages in ([BlurStage(BlurType.GAUSSIAN, 51)], [FilterStage(FilterType.OUTLINE)],
+                   [BlurStage(BlurType.GAUSSIAN, 51), FilterStage(FilterType.OUTLINE)]):
+        pipeline = Pipeline(stages)
+        pipeline(image)
+        tracemalloc.start()
+        try:
+            pipeline(image)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # Everything alive at the peak was counted, apart from a few Python objects
+        assert pipeline.allocations >= len(stages)
+        assert peak <= pipeline.allocated_bytes + 16 * 1024
+
+def test_views_are_not_allocations():
+    pipeline = Pipeline([RotateStage(90)])
+    assert np.shares_memory(pipeline(IMAGE), IMAGE)
+    assert pipeline.passes == 1 and pipeline.allocations == 0
+
+def test_pool_counts_allocations_per_thread():
+    pool = BufferPool()
+    thread = threading.Thread(target=pool.take, args=((4, 4), np.float32))
+    thread.start()
+    thread.join()
+    pool.take((4, 4), np.float32)
+    assert pool.allocated_by_thread() == 1 and pool.stats()["allocated"] == 2
+    pool.count_allocation(np.empty(10, np.uint8))
+    assert pool.allocated_by_thread() == 2 and pool.allocated_bytes_by_thread() == 64 + 10
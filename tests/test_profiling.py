@@ -0,0 +1,72 @@
+import json
+import numpy as np
+import pytest
+from tools.blur import BlurType
+from tools.pipeline import BlurStage, GrayscaleStage, Pipeline
+from tools.profiling import Profiler, NULL_SPAN, profiler
+
+def read_trace(path):
+    # The event array is left open so events can be appended; close it to parse it
+    with open(path) as file:
+        return json.loads(file.read().rstrip().rstrip(",") + "]")
+
+@pytest.fixture
+def enabled_profiler():
+    profiler = Profiler()
+    profiler.enable()
+    yield profiler
+    profiler.disable()
+
+def test_span_records_time_memory_and_shape(enabled_profiler):
+    image = np.zeros((30, 40, 3), np.uint8)
+    with enabled_profiler.span("allocate", image) as span:
+        buffer = np.ones(1 << 20)
+    assert span.seconds > 0
+    assert span.allocated_bytes >= buffer.nbytes
+    assert span.shape == (30, 40, 3)
+    assert list(enabled_profiler.recent) == [span] and enabled_profiler.count == 1
+
+def test_nested_spans_share_the_peak(enabled_profiler):
+    with enabled_profiler.span("outer") as outer:
+        with enabled_profiler.span("inner") as inner:
+            buffer = np.ones(1 << 20)
+        del buffer
+    assert inner.allocated_bytes >= 8 << 20
+    assert outer.allocated_bytes >= inner.allocated_bytes
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler()
+    with profiler.span("idle") as span:
+        pass
+    assert span is NULL_SPAN
+    assert profiler.count == 0
+
+def test_trace_file_rolls_over(tmp_path, monkeypatch):
+    path = str(tmp_path / "trace.json")
+    profiler = Profiler()
+    profiler.enable(path)
+    try:
+        for number in range(3):
+            with profiler.span(f"stage{number}"):
+                pass
+        events = read_trace(path)
+        assert [event["ph"] for event in events] == ["M", "X", "X", "X"]
+        assert [event["name"] for event in events[1:]] == ["stage0", "stage1", "stage2"]
+
+        monkeypatch.setattr("tools.profiling.TRACE_MAX_BYTES", 0)
+        with profiler.span("stage3"):
+            pass
+    finally:
+        profiler.disable()
+    assert len(read_trace(path + ".1")) == 4
+    assert [event["name"] for event in read_trace(path)] == ["thread_name", "stage3"]
+
+def test_pipeline_profiles_each_segment():
+    profiler.enable()
+    try:
+        count = profiler.count
+        Pipeline([GrayscaleStage(), BlurStage(BlurType.BOX, 3)])(np.zeros((20, 30, 3), np.uint8))
+        names = [span.name for span in list(profiler.recent)[count - profiler.count:]]
+    finally:
+        profiler.disable()
+    assert names == ["PointwiseSegment(GrayscaleStage)", "BlurStage"]
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from tools.reshape import apply_mask, create_mask, get_mask, MaskType
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (41, 60, 3), dtype=np.uint8)
+
+@pytest.mark.parametrize("mask_type", list(MaskType))
+def test_mask_matches_boolean_indexing(mask_type):
+    expected = IMAGE.copy()
+    expected[~create_mask(41, 60, mask_type)] = 0
+    assert np.array_equal(apply_mask(IMAGE, mask_type), expected)
+
+    # Masking in place
+    image = IMAGE.copy()
+    assert apply_mask(image, mask_type, out=image) is image
+    assert np.array_equal(image, expected)
+
+def test_masks_are_cached_read_only():
+    mask = get_mask(41, 60, MaskType.HEART)
+    assert get_mask(41, 60, MaskType.HEART) is mask
+    assert not mask.flags.writeable
+
+@pytest.mark.parametrize("mask_type", list(MaskType))
+def test_antialiased_edge_blends_by_coverage(mask_type):
+    coverage = get_mask(41, 60, mask_type, antialias=True)
+    hard = create_mask(41, 60, mask_type)
+    # Coverage agrees with the hard mask away from the edge and is partial along it
+    assert (coverage[hard] > 0).mean() > 0.9 and (coverage[~hard] < 255).all()
+    assert ((coverage > 0) & (coverage < 255)).any()
+
+    expected = (IMAGE.astype(np.uint16) * coverage[:, :, np.newaxis] + 127) // 255
+    assert np.array_equal(apply_mask(IMAGE, mask_type, antialias=True), expected)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import tools.rotate
+from tools.rotate import get_new_dimensions, map_nbytes, right_angle_turns, rotate_image, rotation_map, \
+    CoordinateMapCache, Interpolation
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (45, 70, 3), dtype=np.uint8)
+
+def test_right_angle_turns():
+    assert [right_angle_turns(angle) for angle in (0, 90, 180, -90, 450, 30, 90.5)] == [0, 1, 2, 3, 1, None, None]
+
+@pytest.mark.parametrize("angle, turns", [(90, 1), (180, 2), (270, 3), (-90, 3), (360, 0)])
+def test_right_angle_rotation_is_exact(angle, turns):
+    rotated = rotate_image(IMAGE, angle)
+    assert np.array_equal(rotated, np.rot90(IMAGE, turns))
+    # No resampling and no copy
+    assert np.shares_memory(rotated, IMAGE)
+    assert get_new_dimensions(70, 45, angle) == rotated.shape[1::-1]
+
+def reference_rotation(image: np.ndarray, angle: float, interpolation: Interpolation) -> np.ndarray:
+    """Rotate one output pixel at a time by inverse mapping into the source."""
+    height, width = image.shape[:2]
+    new_width, new_height = get_new_dimensions(width, height, angle)
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    padded = np.pad(image.astype(np.float64), ((1, 1), (1, 1), (0, 0)))
+    output = np.zeros((new_height, new_width, image.shape[2]))
+    for row in range(new_height):
+        for column in range(new_width):
+            x, y = column - new_width // 2, row - new_height // 2
+            source_x = cos * x - sin * y + width // 2
+            source_y = sin * x + cos * y + height // 2
+            if interpolation == Interpolation.NEAREST:
+                sx, sy = int(np.floor(source_x + 0.5)), int(np.floor(source_y + 0.5))
+                if 0 <= sx < width and 0 <= sy < height:
+                    output[row, column] = image[sy, sx]
+            else:
+                x0, y0 = int(np.floor(source_x)), int(np.floor(source_y))
+                if -1 <= x0 < width and -1 <= y0 < height:
+                    fx, fy = source_x - x0, source_y - y0
+                    window = padded[y0 + 1:y0 + 3, x0 + 1:x0 + 3]
+                    top = window[0, 0] * (1 - fx) + window[0, 1] * fx
+                    bottom = window[1, 0] * (1 - fx) + window[1, 1] * fx
+                    output[row, column] = top * (1 - fy) + bottom * fy
+    return output
+
+@pytest.mark.parametrize("angle", [30, -17.5])
+@pytest.mark.parametrize("interpolation", list(Interpolation))
+def test_rotation_matches_per_pixel_reference(angle, interpolation):
+    rotated = rotate_image(IMAGE, angle, interpolation)
+    assert np.abs(rotated - reference_rotation(IMAGE, angle, interpolation)).max() <= 0.5
+
+def test_rotation_maps_are_cached():
+    assert rotation_map(45, 70, 30.0, Interpolation.NEAREST) is rotation_map(45, 70, 30.0, Interpolation.NEAREST)
+
+@pytest.mark.parametrize("interpolation", list(Interpolation))
+def test_chunked_maps_match_whole_map(monkeypatch, interpolation):
+    monkeypatch.setattr(tools.rotate, "coordinate_map_cache", CoordinateMapCache())
+    whole = rotate_image(IMAGE, 30, interpolation)
+
+    # Chunks of a few rows, some ending mid-row of the output
+    monkeypatch.setattr(tools.rotate, "MAP_CHUNK_PIXELS", 500)
+    monkeypatch.setattr(tools.rotate, "coordinate_map_cache", CoordinateMapCache())
+    assert len(rotation_map(45, 70, 30.0, interpolation)) > 1
+    assert np.array_equal(rotate_image(IMAGE, 30, interpolation), whole)
+
+def test_map_cache_is_bounded_by_bytes():
+    maps = rotation_map(100, 150, 30.0, Interpolation.BILINEAR)
+    assert all(chunk[0].dtype == np.int32 and chunk[2].dtype == np.float32 for chunk in maps)
+
+    builds = []
+    def build():
+        builds.append(1)
+        return maps
+
+    cache = CoordinateMapCache(budget_bytes=2 * map_nbytes(maps))
+    for angle in (10.0, 20.0, 30.0, 30.0):
+        cache.get(angle, build)
+    assert len(cache) == 2 and cache.nbytes == 2 * map_nbytes(maps) and len(builds) == 3
+
+    # The least recently used map was evicted
+    cache.get(10.0, build)
+    assert len(builds) == 4
@@ -0,0 +1,83 @@
+import numpy as np
+from tools.blur import BlurType
+from tools.pipeline import BlurStage, MaskStage, Pipeline
+from tools.reshape import MaskType
+from tools.stage_cache import StageCache, chain_key
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (48, 64, 3), dtype=np.uint8)
+
+def test_chain_key():
+    assert chain_key("a", "blur") == chain_key("a", "blur")
+    assert chain_key("a", "blur") != chain_key("b", "blur") != chain_key("a", "mask")
+
+def test_fingerprint_depends_on_the_content():
+    cache = StageCache()
+    assert cache.fingerprint(IMAGE) == cache.fingerprint(IMAGE.copy())
+    assert cache.fingerprint(IMAGE) != cache.fingerprint(IMAGE[::-1])
+    assert cache.fingerprint(IMAGE) != cache.fingerprint(IMAGE.astype(np.uint16))
+
+def test_least_recently_used_images_are_evicted():
+    image_bytes = IMAGE.nbytes
+    cache = StageCache(budget_bytes=2 * image_bytes)
+    first, second, third = (IMAGE + number for number in range(3))
+    cache.put("first", first)
+    cache.put("second", second)
+    assert not first.flags.writeable
+    assert cache.get("first") is first
+
+    cache.put("third", third)
+    assert cache.get("second") is None
+    assert cache.get("first") is first and cache.get("third") is third
+    assert cache.stats() == {"hits": 3, "misses": 1, "evictions": 1, "hit_rate": 0.75, "entries": 2,
+                             "nbytes": 2 * image_bytes}
+
+    # Images over the whole budget are returned without being stored
+    large = np.zeros(3 * image_bytes, np.uint8)
+    assert cache.put("large", large) is large and len(cache) == 2
+
+def test_cached_pipeline_matches_uncached():
+    stages = [BlurStage(BlurType.GAUSSIAN, 9), MaskStage(MaskType.HEART)]
+    cache = StageCache()
+    first = Pipeline(stages, cache)(IMAGE)
+    assert np.array_equal(first, Pipeline(stages)(IMAGE))
+    assert Pipeline(stages, cache)(IMAGE) is first
+
+def test_pipeline_resumes_after_the_cached_blur():
+    cache = StageCache()
+    Pipeline([BlurStage(BlurType.GAUSSIAN, 9), MaskStage(MaskType.HEART)], cache)(IMAGE)
+
+    pipeline = Pipeline([BlurStage(BlurType.GAUSSIAN, 9), MaskStage(MaskType.CIRCULAR)], cache)
+    result = pipeline(IMAGE)
+    assert pipeline.allocations == 1
+    assert np.array_equal(result, Pipeline(pipeline.stages)(IMAGE))
+
+def test_read_only_views_of_writable_images_are_hashed_again():
+    cache = StageCache()
+    image = IMAGE.copy()
+    turned = cache.put("turned", np.rot90(image))
+    before = cache.fingerprint(turned)
+    image[0, -1] += 1
+    assert cache.fingerprint(turned) != before
+
+    # An image the cache owns is known by the key it was stored under
+    stored = cache.put("stored", IMAGE.copy())
+    assert cache.fingerprint(stored) == "stored"
+    assert cache.fingerprint(turned) != "turned"
+
+def test_views_of_a_cached_buffer_are_charged_once():
+    cache = StageCache(budget_bytes=2 * IMAGE.nbytes)
+    image = cache.put("image", IMAGE.copy())
+    cache.put("turned", np.rot90(image))
+    assert cache.nbytes == IMAGE.nbytes
+
+    # Evicting one view keeps the buffer charged while the other still uses it
+    cache.put("other", IMAGE + 1)
+    cache.put("third", IMAGE + 2)
+    assert len(cache) == 2 and cache.nbytes == 2 * IMAGE.nbytes
+
+def test_pipeline_run_counts_one_lookup():
+    cache = StageCache()
+    Pipeline([BlurStage(BlurType.GAUSSIAN, 9), MaskStage(MaskType.HEART)], cache)(IMAGE)
+    assert (cache.hits, cache.misses) == (0, 1)
+    Pipeline([BlurStage(BlurType.GAUSSIAN, 9), MaskStage(MaskType.CIRCULAR)], cache)(IMAGE)
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from tools.blur import BlurType, ConvolutionMethod, select_blur_method
+from tools.image_filter_color import FilterType
+from tools.pipeline import Pipeline, BlurStage, FilterStage, GrayscaleStage, MaskStage, RotateStage
+from tools.reshape import MaskType
+from tools.tiling import TiledPipeline, create_image, open_image, parallel_apply, process_file, stage_halo, \
+    WORKING_BYTES_PER_SAMPLE
+
+SHAPE = (240, 320, 3)
+
+# Budget for strips of a few dozen rows, so every image is cut into several of them
+TILE_BYTES = 8 * 1024 * 1024
+
+STAGE_SETS = [
+    (GrayscaleStage(), BlurStage(BlurType.GAUSSIAN, 15), FilterStage(FilterType.WARM_TONE), MaskStage(MaskType.HEART)),
+    (BlurStage(BlurType.GAUSSIAN, 51), MaskStage(MaskType.CIRCULAR, True)),
+    (BlurStage(BlurType.VERTICAL, 75),),
+    (BlurStage(BlurType.BOX, 31), FilterStage(FilterType.OUTLINE)),
+    (BlurStage(BlurType.RECURSIVE_GAUSSIAN, sigma=2),),
+]
+
+@pytest.fixture(autouse=True)
+def one_kernel_thread(monkeypatch):
+    # The cost model picks the methods for one thread, so the large blurs use the FFT on every machine
+    monkeypatch.setattr("tools.blur.get_thread_count", lambda: 1)
+
+def random_image(channels):
+    shape = SHAPE[:2] + ((channels,) if channels > 1 else ())
+    return np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+
+def test_large_blur_uses_fft():
+    assert select_blur_method(SHAPE, BlurType.GAUSSIAN, 51) == ConvolutionMethod.FFT
+
+def test_stage_halo():
+    assert stage_halo(BlurStage(BlurType.GAUSSIAN, 15)) == 7
+    assert stage_halo(BlurStage(BlurType.RECURSIVE_GAUSSIAN, sigma=2)) == 32
+    assert stage_halo(FilterStage(FilterType.OUTLINE)) == 1
+    assert stage_halo(FilterStage(FilterType.INVERT)) == 0
+    with pytest.raises(ValueError):
+        stage_halo(RotateStage(30))
+
+def test_strips_fit_the_budget():
+    row_bytes = SHAPE[1] * 3 * WORKING_BYTES_PER_SAMPLE
+    rows = TiledPipeline([], TILE_BYTES, workers=1).rows_per_strip(*SHAPE, 10)
+    assert (rows + 20) * row_bytes <= TILE_BYTES < (rows + 21) * row_bytes
+
+    # The budget is shared by the workers, and each of them gets at least two strips
+    rows = TiledPipeline([], TILE_BYTES, workers=2).rows_per_strip(*SHAPE, 10)
+    assert (rows + 20) * row_bytes * 2 <= TILE_BYTES
+    assert TiledPipeline([], workers=4).rows_per_strip(*SHAPE, 10) == 30
+    assert TiledPipeline([], workers=4, strip_rows=7).rows_per_strip(*SHAPE, 10) == 7
+
+def test_halo_larger_than_the_budget_is_an_error():
+    # A recursive Gaussian with sigma 20 reads 320 rows on each side of a strip
+    tiled = TiledPipeline([BlurStage(BlurType.RECURSIVE_GAUSSIAN, sigma=20)], TILE_BYTES, workers=1)
+    with pytest.raises(ValueError, match="halo of 320 rows"):
+        tiled(random_image(3), np.empty(SHAPE, np.uint8))
+    assert TiledPipeline([], TILE_BYTES, workers=1, strip_rows=8).rows_per_strip(*SHAPE, 320) == 8
+
+@pytest.mark.parametrize("stages", STAGE_SETS)
+@pytest.mark.parametrize("channels", [1, 3])
+@pytest.mark.parametrize("workers", [1, 3])
+def test_tiled_matches_whole_image(stages, channels, workers):
+    image = random_image(channels)
+    tiled = TiledPipeline(stages, TILE_BYTES, workers)
+    output = np.empty(tiled.output_shape(image.shape), np.uint8)
+    assert np.array_equal(tiled(image, output), Pipeline(stages)(image))
+
+@pytest.mark.parametrize("strip_rows", [1, 37])
+def test_parallel_apply_matches_whole_image(strip_rows):
+    image = random_image(3)
+    stages = STAGE_SETS[3]
+    assert np.array_equal(parallel_apply(image, stages, workers=3, strip_rows=strip_rows), Pipeline(stages)(image))
+
+def test_process_file(tmp_path):
+    image = random_image(3)
+    np.save(tmp_path / "input.npy", image)
+    stages = [BlurStage(BlurType.BOX, 9), MaskStage(MaskType.HEART)]
+    process_file(str(tmp_path / "input.npy"), str(tmp_path / "output.npy"), stages, TILE_BYTES)
+    assert np.array_equal(open_image(str(tmp_path / "output.npy")), Pipeline(stages)(image))
+
+def test_failed_run_removes_the_output(tmp_path):
+    create_image(str(tmp_path / "input.raw"), SHAPE)[:] = 0
+    with pytest.raises(ValueError):
+        process_file(str(tmp_path / "input.raw"), str(tmp_path / "output.raw"), [RotateStage(30)], shape=SHAPE)
+    assert not (tmp_path / "output.raw").exists()
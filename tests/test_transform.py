@@ -0,0 +1,47 @@
+import numpy as np
+from tools.rotate import rotate_image, Interpolation
+from tools.transform import TransformStack
+
+IMAGE = np.random.default_rng(0).integers(0, 256, (45, 70, 3), dtype=np.uint8)
+
+def test_rotations_are_combined_into_one_resample():
+    stack = TransformStack()
+    stack.rotate(30)
+    stack.rotate(15)
+    assert np.isclose(stack.rotation_angle(), 45)
+    assert np.array_equal(stack.render(IMAGE, Interpolation.BILINEAR), rotate_image(IMAGE, 45, Interpolation.BILINEAR))
+
+def test_rotations_that_cancel_out():
+    stack = TransformStack()
+    stack.rotate(30)
+    stack.rotate(-30)
+    assert stack.is_identity()
+
+    for _ in range(4):
+        stack.rotate(90)
+    rendered = stack.render(IMAGE)
+    assert np.array_equal(rendered, IMAGE) and np.shares_memory(rendered, IMAGE)
+
+def test_flips_and_quarter_turns_are_exact():
+    stack = TransformStack()
+    stack.flip_horizontal()
+    stack.rotate(90)
+    assert stack.right_angle_decomposition() == (True, 1)
+    assert np.array_equal(stack.render(IMAGE), np.rot90(IMAGE[:, ::-1]))
+
+    stack.reset()
+    stack.flip_vertical()
+    assert np.array_equal(stack.render(IMAGE), IMAGE[::-1])
+
+def test_scale_resamples_onto_a_larger_canvas():
+    stack = TransformStack()
+    stack.scale(2)
+    assert stack.rotation_angle() is None
+    assert stack.render(IMAGE).shape == (90, 140, 3)
+
+def test_copy_is_independent():
+    stack = TransformStack()
+    stack.rotate(30)
+    copy = stack.copy()
+    stack.rotate(60)
+    assert np.isclose(copy.rotation_angle(), 30) and np.isclose(stack.rotation_angle(), 90)